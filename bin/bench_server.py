@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""Measure round-trip batch throughput against a local bloom filter server"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+
+import bloom_filter
+from bloom_filter import server as server_mod
+
+
+def main():
+    batch_size = int(sys.argv[1]) if sys.argv[1:] else 1000
+    batches_per_round_trip = int(sys.argv[2]) if sys.argv[2:] else 16
+    round_trips = int(sys.argv[3]) if sys.argv[3:] else 50
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'bloom.sock')
+    bloom = bloom_filter.BloomFilter(max_elements=batch_size * batches_per_round_trip, error_rate=0.01)
+    server = server_mod.BloomFilterServer(socket_path, {'bench': bloom})
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    client = server_mod.BloomFilterClient(socket_path)
+    batches = [[('key-%d-%d' % (batchno, keyno)).encode('ascii') for keyno in range(batch_size)]
+               for batchno in range(batches_per_round_trip)]
+    for batch in batches:
+        client.add('bench', batch)
+
+    time0 = time.time()
+    for dummy in range(round_trips):
+        client.check_batches('bench', batches)
+    delta_t = time.time() - time0
+
+    keys = batch_size * batches_per_round_trip * round_trips
+    print('%d keys in %d round trips of %d batches of %d: %.3f s, %.0f keys/s, %.2f ms/round trip' % (
+        keys, round_trips, batches_per_round_trip, batch_size, delta_t, keys / delta_t,
+        delta_t * 1000.0 / round_trips,
+    ))
+
+    client.close()
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+if __name__ == '__main__':
+    main()
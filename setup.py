@@ -3,10 +3,6 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from glob import glob
-from os.path import basename
-from os.path import splitext
-
 from setuptools import find_packages
 from setuptools import setup
 
@@ -16,7 +12,7 @@ setup(
     version="1.3",
     packages=find_packages('src'),
     package_dir={'': 'src'},
-    py_modules=[splitext(basename(path))[0] for path in glob('src/*.py')],
+    python_requires='>=3.8',
 
     # metadata for upload to PyPI
     author="Harshad Sharma",
@@ -24,8 +20,8 @@ setup(
     description='Pure Python Bloom Filter module',
     long_description="""
 A pure python bloom filter (low storage requirement, probabilistic
-set datastructure) is provided.  It is known to work on CPython 2.x,
-CPython 3.x, Pypy and Jython.
+set datastructure) is provided.  It needs Python 3.8 or later, and is
+known to work on CPython and Pypy.
 
 Includes mmap, in-memory and disk-seek backends.
 
@@ -63,7 +59,7 @@ Usage:
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
-        "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
     ],
 )
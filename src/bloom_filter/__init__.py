@@ -3,12 +3,42 @@
 
 from .bloom_filter import (
     BloomFilter,
+    FrozenBloomFilter,
     get_filter_bitno_probes,
     get_bitno_seed_rnd,
+    get_bitno_fnv64,
 )
+from .checkpoint import CheckpointError
+from .delta import DeltaError
+from .insert_log import DurableBloomFilter, InsertLogError
+from .planner import BloomFilterPlan
+from .bloom_index import BloomIndex
+from .key_codec import encode_key, register_key_codec
+from .tiered import TieredBloomFilter
+from .quotient_filter import QuotientFilter
+from .count_min import CountMinSketch
+from .pipeline import PipelineStats
+from .guarded_store import BloomGuardedStore
+from .placement import BackendPolicy
 
 __all__ = [
     'BloomFilter',
+    'FrozenBloomFilter',
     'get_filter_bitno_probes',
     'get_bitno_seed_rnd',
+    'get_bitno_fnv64',
+    'CheckpointError',
+    'DeltaError',
+    'DurableBloomFilter',
+    'InsertLogError',
+    'BloomFilterPlan',
+    'BloomIndex',
+    'encode_key',
+    'register_key_codec',
+    'TieredBloomFilter',
+    'QuotientFilter',
+    'CountMinSketch',
+    'PipelineStats',
+    'BloomGuardedStore',
+    'BackendPolicy',
 ]
@@ -15,10 +15,17 @@
 
 from __future__ import division
 import os
-#mport sys
+import abc
+import sys
 import math
+import time
 import array
 import random
+import threading
+import struct
+import pickle
+import hashlib
+import numbers
 
 try:
     import mmap as mmap_mod
@@ -32,7 +39,13 @@ else:
 #mport hashlib
 #mport numbers
 
-import python2x3
+from . import checkpoint as checkpoint_mod
+from . import planner as planner_mod
+from . import pipeline as pipeline_mod
+from . import delta as delta_mod
+from . import placement as placement_mod
+from .checkpoint import page_runs
+from .key_codec import encode_key
 
 # In the literature:
 # k is the number of probes - we call this num_probes_k
@@ -49,394 +62,1398 @@ def my_range(num_values):
         yield value
         value += 1
 
-# In the abstract, this is what we want &= and |= to do, but especially for disk-based filters, this is extremely slow
-#class Backend_set_operations:
-#    """Provide &= and |= for backends"""
-#    # pylint: disable=W0232
-#    # W0232: We don't need an __init__ method; we're never instantiated directly
-#    def __iand__(self, other):
-#        assert self.num_bits == other.num_bits
-#
-#        for bitno in my_range(num_bits):
-#            if self.is_set(bitno) and other.is_set(bitno):
-#                self[bitno].set()
-#            else:
-#                self[bitno].clear()
-#
-#    def __ior__(self, other):
-#        assert self.num_bits == other.num_bits
-#
-#        for bitno in xrange(num_bits):
-#            if self[bitno] or other[bitno]:
-#                self[bitno].set()
-#            else:
-#                self[bitno].clear()
+MERGE_BLOCK_BYTES = 2 ** 20
+
+# Bit masks by bit number within a byte, and their complements, so the hot paths index a tuple instead of shifting
+BIT_MASKS = tuple(1 << bit_within_byteno for bit_within_byteno in range(8))
+CLEAR_MASKS = tuple(0xff ^ mask for mask in BIT_MASKS)
+
+
+def read_fd_range(file_, offset, length, block_len=2 ** 17):
+    """Read length bytes starting at offset from an os-level file descriptor, in blocks"""
+    os.lseek(file_, offset, os.SEEK_SET)
+    blocks = []
+    remaining = length
+    while remaining > 0:
+        block = os.read(file_, min(block_len, remaining))
+        if not block:
+            break
+        blocks.append(block)
+        remaining -= len(block)
+    result = b''.join(blocks)
+    # A short file just means the tail was never written, so it's all zeros
+    return result + bytes(length - len(result))
+
+
+def write_fd_range(file_, offset, data):
+    """Write all of data at offset of an os-level file descriptor"""
+    os.lseek(file_, offset, os.SEEK_SET)
+    view = memoryview(data)
+    while view:
+        written = os.write(file_, view)
+        view = view[written:]
+
+
+COALESCE_GAP_BYTES = 2 ** 12
+
+
+def pread_fd(file_, length, offset):
+    """Read length bytes at offset of an os-level file descriptor in one call where we can; zeros past the end"""
+    if hasattr(os, 'pread'):
+        result = os.pread(file_, length, offset)
+    else:
+        result = read_fd_range(file_, offset, length)
+    return result + bytes(length - len(result))
+
+
+def pwrite_fd(file_, data, offset):
+    """Write all of data at offset of an os-level file descriptor, in one call where we can"""
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(file_, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        write_fd_range(file_, offset, data)
+
+
+def open_bits_file(filename, num_chars):
+    """Open, creating if need be, the file of a file backend, and make sure it's long enough for num_chars bytes"""
+    flags = os.O_RDWR | os.O_CREAT
+    if hasattr(os, 'O_BINARY'):
+        flags |= getattr(os, 'O_BINARY')
+    file_ = os.open(filename, flags)
+    pwrite_fd(file_, b'\0', num_chars + 1)
+    return file_
+
+
+def coalesce_bytenos(bytenos, max_gap=COALESCE_GAP_BYTES):
+    """Coalesce ascending byte numbers into (start, end) ranges, merging neighbours less than max_gap bytes apart"""
+    start = end = None
+    for byteno in bytenos:
+        if end is not None and byteno - end < max_gap:
+            end = byteno + 1
+            continue
+        if start is not None:
+            yield start, end
+        start, end = byteno, byteno + 1
+    if start is not None:
+        yield start, end
+
+
+def read_fd_bytes(file_, bytenos, fadvise=False):
+    """
+    Return a dict mapping each of bytenos to the value of that byte of an os-level file descriptor.  The byte
+    numbers are sorted, deduplicated and coalesced into ranges, so that a batch of scattered probes costs one
+    read per range rather than two syscalls per probe.  With fadvise, the kernel is told about every range before
+    we read the first, so it can fetch them all at once.
+    """
+    sorted_bytenos = sorted(set(bytenos))
+    ranges = list(coalesce_bytenos(sorted_bytenos))
+    if fadvise and hasattr(os, 'posix_fadvise'):
+        for start, end in ranges:
+            os.posix_fadvise(file_, start, end - start, os.POSIX_FADV_WILLNEED)
+    values = {}
+    index = 0
+    for start, end in ranges:
+        block = pread_fd(file_, end - start, start)
+        while index < len(sorted_bytenos) and sorted_bytenos[index] < end:
+            values[sorted_bytenos[index]] = block[sorted_bytenos[index] - start]
+            index += 1
+    return values
+
+
+def update_fd_bytes(file_, masks, operator):
+    """Apply operator(byte, mask) to the bytes of an os-level file descriptor in masks, a range at a time"""
+    sorted_bytenos = sorted(masks)
+    index = 0
+    for start, end in coalesce_bytenos(sorted_bytenos):
+        original = pread_fd(file_, end - start, start)
+        block = bytearray(original)
+        while index < len(sorted_bytenos) and sorted_bytenos[index] < end:
+            byteno = sorted_bytenos[index]
+            block[byteno - start] = operator(block[byteno - start], masks[byteno])
+            index += 1
+        if block != original:
+            pwrite_fd(file_, block, start)
+
+
+def write_fd_bytes(file_, values):
+    """Write values, a dict mapping byte numbers to byte values, to an os-level file descriptor, a run at a time"""
+    for start, end in coalesce_bytenos(sorted(values), max_gap=1):
+        pwrite_fd(file_, bytes(values[byteno] for byteno in range(start, end)), start)
+
+
+def or_fd_bytes(file_, masks):
+    """OR masks, a dict mapping byte numbers to bit masks, into an os-level file descriptor a range at a time"""
+    update_fd_bytes(file_, masks, lambda byte, mask: byte | mask)
+
+
+def clear_fd_bytes(file_, masks):
+    """Clear the bits of masks, a dict mapping byte numbers to bit masks, in an os-level file descriptor"""
+    update_fd_bytes(file_, masks, lambda byte, mask: byte & (0xff ^ mask))
+
+
+def bit_masks(bitnos):
+    """Return a dict mapping the byte numbers of bitnos to the mask of their bits within each byte"""
+    masks = {}
+    for bitno in bitnos:
+        byteno = bitno >> 3
+        masks[byteno] = masks.get(byteno, 0) | BIT_MASKS[bitno & 7]
+    return masks
+
+
+def test_and_set_bytes(values, bitno_lists):
+    """
+    Test and set each list of bit numbers in turn, in values, a dict mapping byte numbers to byte values.  Return a
+    list saying, for each list, whether it set any bit that wasn't already set, and a dict of the bytes it changed.
+    """
+    results = []
+    changed = {}
+    for bitnos in bitno_lists:
+        newly_set = False
+        for bitno in bitnos:
+            byteno = bitno >> 3
+            mask = BIT_MASKS[bitno & 7]
+            if not values[byteno] & mask:
+                values[byteno] |= mask
+                changed[byteno] = values[byteno]
+                newly_set = True
+        results.append(newly_set)
+    return results, changed
+
+
+# Array_backend keeps 64 bits in each word of an array('Q'), bit 0 of word 0 being bitno 0
+WORD_BITS = 64
+WORD_BYTES = WORD_BITS // 8
+
+
+def word_masks(bitnos):
+    """Return a dict mapping the 64 bit word numbers of bitnos to the mask of their bits within each word"""
+    masks = {}
+    for bitno in bitnos:
+        wordno = bitno >> 6
+        masks[wordno] = masks.get(wordno, 0) | (1 << (bitno & 63))
+    return masks
+
+
+def words_to_bytes(words):
+    """Convert 64 bit words, with bit 0 of word 0 first, to the equivalent little-endian bytes"""
+    if sys.byteorder == 'big':
+        words = array.array('Q', words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def bytes_to_words(data):
+    """Convert little-endian bytes, a whole number of words long, to 64 bit words, with bit 0 of word 0 first"""
+    words = array.array('Q')
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+CHECKPOINT_PAGE_BYTES = 2 ** 12
+
+
+class Dirty_page_map(object):
+    """
+    A compact bitmap, one bit per page, of the pages of an in-memory backend that have changed since the last
+    checkpoint.  We also note whether any bit was ever cleared, because then an in-place incremental
+    checkpoint would no longer be safe to interrupt.
+
+    Backends mark a page just before changing it, so this is also where watchers (copy-on-write snapshots) get
+    their chance to save a page's old contents.
+
+    Independently of checkpoints, each page is also stamped with the version current when it last changed, so
+    delta exports can find the pages changed since any earlier version.
+    """
+
+    def __init__(self, num_pages):
+        self.num_pages = num_pages
+        self.bitmap = bytearray((num_pages + 7) // 8)
+        self.monotone = True
+        # A tuple, so it can be replaced atomically while another thread iterates over it
+        self.watchers = ()
+        # Version 0 is "before anything changed"
+        self.version = 1
+        self.page_versions = array.array('Q', [0]) * num_pages
+
+    def mark(self, pageno):
+        """Note that page number pageno is about to change"""
+        self.bitmap[pageno >> 3] |= 1 << (pageno & 7)
+        self.page_versions[pageno] = self.version
+        if self.watchers:
+            for watcher in self.watchers:
+                watcher.preserve(pageno)
+
+    def mark_range(self, first_pageno, last_pageno):
+        """Note that pages first_pageno..last_pageno-1 are about to change"""
+        for pageno in my_range(last_pageno - first_pageno):
+            self.mark(first_pageno + pageno)
+
+    def mark_all(self):
+        """Note that every page is about to change"""
+        self.bitmap[:] = b'\xff' * len(self.bitmap)
+        self.page_versions = array.array('Q', [self.version]) * self.num_pages
+        for watcher in self.watchers:
+            for pageno in my_range(self.num_pages):
+                watcher.preserve(pageno)
+
+    def add_watcher(self, watcher):
+        """Have watcher.preserve(pageno) called before each page changes"""
+        self.watchers = self.watchers + (watcher,)
+
+    def remove_watcher(self, watcher):
+        """Stop notifying watcher"""
+        self.watchers = tuple(existing for existing in self.watchers if existing is not watcher)
+
+    def mark_cleared(self):
+        """Note that bits have been cleared, not just set"""
+        self.monotone = False
+
+    def reset(self):
+        """Forget all changes; called once they've been safely checkpointed"""
+        self.bitmap[:] = bytes(len(self.bitmap))
+        self.monotone = True
+
+    def take(self):
+        """
+        Return the changes so far as a new map, and forget them here, so that pages changed while a checkpoint is
+        writing the returned ones are still dirty for the next checkpoint
+        """
+        taken = Dirty_page_map(self.num_pages)
+        taken.bitmap, self.bitmap = self.bitmap, bytearray(len(self.bitmap))
+        taken.monotone, self.monotone = self.monotone, True
+        return taken
+
+    def put_back(self, taken):
+        """Undo take(), after a checkpoint of the pages it returned failed"""
+        for byteno, byte in enumerate(taken.bitmap):
+            self.bitmap[byteno] |= byte
+        self.monotone = self.monotone and taken.monotone
+
+    def next_version(self):
+        """Close the current version and return it; pages changed from now on are stamped with a later one"""
+        version = self.version
+        self.version += 1
+        return version
+
+    def changed_since(self, version):
+        """Generate the numbers of the pages changed after version, in ascending order"""
+        for pageno, page_version in enumerate(self.page_versions):
+            if page_version > version:
+                yield pageno
+
+    def __len__(self):
+        return popcount_bytes(self.bitmap)
+
+    def __iter__(self):
+        """Generate the numbers of the dirty pages, in ascending order"""
+        for byteno, byte in enumerate(self.bitmap):
+            if byte:
+                for bitno in range(8):
+                    if byte & (1 << bitno) and byteno * 8 + bitno < self.num_pages:
+                        yield byteno * 8 + bitno
+
+
+class Base_backend(abc.ABC):
+    """
+    The protocol every backend follows.  A backend must provide is_set, set, clear, read_block and write_block;
+    the batch methods, tobytes, &= and |= here are built on those, and are overridden where a backend can do better.
+    """
+
+    num_bits = 0
+    num_chars = 0
+    # Our name, as BloomFilter.migrate(), BackendPolicy and the planner know us
+    kind = None
+
+    @abc.abstractmethod
+    def is_set(self, bitno):
+        """Return true iff bit number bitno is set"""
+
+    @abc.abstractmethod
+    def set(self, bitno):
+        """set bit number bitno to true"""
+
+    @abc.abstractmethod
+    def clear(self, bitno):
+        """clear bit number bitno - set it to false"""
+
+    @abc.abstractmethod
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+
+    @abc.abstractmethod
+    def write_block(self, byteno, data):
+        """Overwrite bytes of the bit array starting at byte byteno"""
+
+    def is_set_many(self, bitnos, fadvise=False):
+        """Return a list saying, for each of bitnos in order, whether it is set"""
+        # pylint: disable=W0613
+        # W0613: fadvise only means something to the file backends
+        is_set = self.is_set
+        return [is_set(bitno) for bitno in bitnos]
+
+    def set_many(self, bitnos):
+        """Set every one of bitnos"""
+        for bitno in bitnos:
+            self.set(bitno)
+
+    def clear_many(self, bitnos):
+        """Clear every one of bitnos"""
+        for bitno in bitnos:
+            self.clear(bitno)
+
+    def test_and_set(self, bitnos):
+        """Set every one of bitnos, looking at each once; return true iff any of them wasn't already set"""
+        newly_set = False
+        for bitno in bitnos:
+            if not self.is_set(bitno):
+                self.set(bitno)
+                newly_set = True
+        return newly_set
+
+    def test_and_set_many(self, bitno_lists):
+        """test_and_set() each list of bit numbers in turn; return the list of results"""
+        return [self.test_and_set(bitnos) for bitnos in bitno_lists]
+
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        return self.read_block(0, self.num_chars)
+
+    def combine_blockwise(self, other, operator):
+        """Combine other's bits into ours a block at a time, each block as one big python integer; any backends"""
+        assert self.num_bits == other.num_bits
+        for byteno in range(0, self.num_chars, MERGE_BLOCK_BYTES):
+            length = min(MERGE_BLOCK_BYTES, self.num_chars - byteno)
+            ours = int.from_bytes(self.read_block(byteno, length), 'little')
+            theirs = int.from_bytes(other.read_block(byteno, length), 'little')
+            self.write_block(byteno, operator(ours, theirs).to_bytes(length, 'little'))
+
+    def or_block(self, byteno, data):
+        """OR data into the bit array starting at byte byteno; this only ever sets bits"""
+        length = len(data)
+        ours = int.from_bytes(self.read_block(byteno, length), 'little')
+        theirs = int.from_bytes(data, 'little')
+        if not theirs & ~ours:
+            return
+        dirty = getattr(self, 'dirty', None)
+        monotone = dirty is not None and dirty.monotone
+        self.write_block(byteno, (ours | theirs).to_bytes(length, 'little'))
+        if monotone:
+            # write_block has to assume bits were cleared; ORing never clears any
+            dirty.monotone = True
+
+    def __iand__(self, other):
+        self.combine_blockwise(other, lambda left, right: left & right)
+        return self
+
+    def __ior__(self, other):
+        self.combine_blockwise(other, lambda left, right: left | right)
+        return self
+
+    def close(self):
+        """Noop for compatibility with the file+seek backend"""
+        pass
 
 
 if HAVE_MMAP:
 
-    class Mmap_backend(object):
+    class Mmap_backend(Base_backend):
         """
         Backend storage for our "array of bits" using an mmap'd file.
         Please note that this has only been tested on Linux so far: 2    -11-01.
         """
 
-        effs = 2 ^ 8 - 1
+        kind = 'mmap'
 
         def __init__(self, num_bits, filename):
             self.num_bits = num_bits
             self.num_chars = (self.num_bits + 7) // 8
-            flags = os.O_RDWR | os.O_CREAT
-            if hasattr(os, 'O_BINARY'):
-                flags |= getattr(os, 'O_BINARY')
-            self.file_ = os.open(filename, flags)
-            os.lseek(self.file_, self.num_chars + 1, os.SEEK_SET)
-            os.write(self.file_, python2x3.null_byte)
+            self.filename = filename
+            self.file_ = open_bits_file(filename, self.num_chars)
             self.mmap = mmap_mod.mmap(self.file_, self.num_chars)
 
         def is_set(self, bitno):
             """Return true iff bit number bitno is set"""
-            byteno, bit_within_wordno = divmod(bitno, 8)
-            mask = 1 << bit_within_wordno
-            char = self.mmap[byteno]
-            if isinstance(char, str):
-                byte = ord(char)
-            else:
-                byte = int(char)
-            return byte & mask
+            return self.mmap[bitno >> 3] & BIT_MASKS[bitno & 7]
 
         def set(self, bitno):
             """set bit number bitno to true"""
-
-            byteno, bit_within_byteno = divmod(bitno, 8)
-            mask = 1 << bit_within_byteno
-            char = self.mmap[byteno]
-            byte = ord(char)
-            byte |= mask
-            self.mmap[byteno] = chr(byte)
+            self.mmap[bitno >> 3] |= BIT_MASKS[bitno & 7]
 
         def clear(self, bitno):
             """clear bit number bitno - set it to false"""
+            self.mmap[bitno >> 3] &= CLEAR_MASKS[bitno & 7]
 
-            byteno, bit_within_byteno = divmod(bitno, 8)
-            mask = 1 << bit_within_byteno
-            char = self.mmap[byteno]
-            byte = ord(char)
-            byte &= Mmap_backend.effs - mask
-            self.mmap[byteno] = chr(byte)
+        def is_set_many(self, bitnos, fadvise=False):
+            """Return a list saying, for each of bitnos in order, whether it is set"""
+            mmap_ = self.mmap
+            return [mmap_[bitno >> 3] & BIT_MASKS[bitno & 7] for bitno in bitnos]
 
-        def __iand__(self, other):
-            assert self.num_bits == other.num_bits
+        def set_many(self, bitnos):
+            """Set every one of bitnos, touching each byte once"""
+            mmap_ = self.mmap
+            for byteno, mask in bit_masks(bitnos).items():
+                mmap_[byteno] |= mask
 
-            for byteno in my_range(self.num_chars):
-                self.mmap[byteno] = chr(ord(self.mmap[byteno]) & ord(other.mmap[byteno]))
+        def clear_many(self, bitnos):
+            """Clear every one of bitnos, touching each byte once"""
+            mmap_ = self.mmap
+            for byteno, mask in bit_masks(bitnos).items():
+                mmap_[byteno] &= 0xff ^ mask
 
-            return self
+        def tobytes(self):
+            """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+            return self.mmap[:self.num_chars]
 
-        def __ior__(self, other):
-            assert self.num_bits == other.num_bits
+        def read_block(self, byteno, length):
+            """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+            return self.mmap[byteno:min(byteno + length, self.num_chars)]
 
-            for byteno in my_range(self.num_chars):
-                self.mmap[byteno] = chr(ord(self.mmap[byteno]) | ord(other.mmap[byteno]))
+        def write_block(self, byteno, data):
+            """Overwrite bytes of the bit array starting at byte byteno"""
+            self.mmap[byteno:byteno + len(data)] = data
 
-            return self
+        def __reduce_ex__(self, protocol):
+            # The bits are already in the file, so the other side just needs to map it too
+            return Mmap_backend, (self.num_bits, os.path.abspath(self.filename))
 
         def close(self):
-            """Close the file"""
+            """Unmap and close the file"""
+            self.mmap.close()
             os.close(self.file_)
 
 
-class File_seek_backend(object):
+class File_seek_backend(Base_backend):
     """Backend storage for our "array of bits" using a file in which we seek"""
 
-    effs = 2 ^ 8 - 1
+    kind = 'seek'
 
     def __init__(self, num_bits, filename):
         self.num_bits = num_bits
         self.num_chars = (self.num_bits + 7) // 8
-        flags = os.O_RDWR | os.O_CREAT
-        if hasattr(os, 'O_BINARY'):
-            flags |= getattr(os, 'O_BINARY')
-        self.file_ = os.open(filename, flags)
-        os.lseek(self.file_, self.num_chars + 1, os.SEEK_SET)
-        os.write(self.file_, python2x3.null_byte)
+        self.filename = filename
+        self.file_ = open_bits_file(filename, self.num_chars)
 
     def is_set(self, bitno):
         """Return true iff bit number bitno is set"""
-        byteno, bit_within_wordno = divmod(bitno, 8)
-        mask = 1 << bit_within_wordno
-        os.lseek(self.file_, byteno, os.SEEK_SET)
-        char = os.read(self.file_, 1)
-        if isinstance(char, str):
-            byte = ord(char)
-        else:
-            byte = char[0]
-        return byte & mask
+        return pread_fd(self.file_, 1, bitno >> 3)[0] & BIT_MASKS[bitno & 7]
 
     def set(self, bitno):
         """set bit number bitno to true"""
-
-        byteno, bit_within_byteno = divmod(bitno, 8)
-        mask = 1 << bit_within_byteno
-        os.lseek(self.file_, byteno, os.SEEK_SET)
-        char = os.read(self.file_, 1)
-        if isinstance(char, str):
-            byte = ord(char)
-            was_char = True
-        else:
-            byte = char[0]
-            was_char = False
-        byte |= mask
-        os.lseek(self.file_, byteno, os.SEEK_SET)
-        if was_char:
-            os.write(self.file_, chr(byte))
-        else:
-            char = python2x3.intlist_to_binary([byte])
-            os.write(self.file_, char)
+        byteno = bitno >> 3
+        pwrite_fd(self.file_, bytes((pread_fd(self.file_, 1, byteno)[0] | BIT_MASKS[bitno & 7],)), byteno)
 
     def clear(self, bitno):
         """clear bit number bitno - set it to false"""
-
-        byteno, bit_within_byteno = divmod(bitno, 8)
-        mask = 1 << bit_within_byteno
-        os.lseek(self.file_, byteno, os.SEEK_SET)
-        char = os.read(self.file_, 1)
-        if isinstance(char, str):
-            byte = ord(char)
-            was_char = True
-        else:
-            byte = int(char)
-            was_char = False
-        byte &= File_seek_backend.effs - mask
-        os.lseek(self.file_, byteno, os.SEEK_SET)
-        if was_char:
-            os.write(chr(byte))
-        else:
-            char = python2x3.intlist_to_binary([byte])
-            os.write(char)
-
-    # These are quite slow ways to do iand and ior, but they should work,
-    # and a faster version is going to take more time
-    def __iand__(self, other):
-        assert self.num_bits == other.num_bits
-
-        for bitno in my_range(self.num_bits):
-            if self.is_set(bitno) and other.is_set(bitno):
-                self.set(bitno)
-            else:
-                self.clear(bitno)
-
-        return self
-
-    def __ior__(self, other):
-        assert self.num_bits == other.num_bits
-
-        for bitno in my_range(self.num_bits):
-            if self.is_set(bitno) or other.is_set(bitno):
-                self.set(bitno)
-            else:
-                self.clear(bitno)
-
-        return self
+        byteno = bitno >> 3
+        pwrite_fd(self.file_, bytes((pread_fd(self.file_, 1, byteno)[0] & CLEAR_MASKS[bitno & 7],)), byteno)
+
+    def is_set_many(self, bitnos, fadvise=False):
+        """Return a list saying, for each of bitnos in order, whether it is set; reads in coalesced ranges"""
+        bitnos = list(bitnos)
+        values = read_fd_bytes(self.file_, [bitno >> 3 for bitno in bitnos], fadvise)
+        return [values[bitno >> 3] & BIT_MASKS[bitno & 7] for bitno in bitnos]
+
+    def set_many(self, bitnos):
+        """Set every one of bitnos, with one read-modify-write per coalesced range"""
+        or_fd_bytes(self.file_, bit_masks(bitnos))
+
+    def clear_many(self, bitnos):
+        """Clear every one of bitnos, with one read-modify-write per coalesced range"""
+        clear_fd_bytes(self.file_, bit_masks(bitnos))
+
+    def test_and_set(self, bitnos):
+        """Set every one of bitnos, reading each byte once and writing only the bytes that change"""
+        return self.test_and_set_many([bitnos])[0]
+
+    def test_and_set_many(self, bitno_lists):
+        """test_and_set() each list of bit numbers in turn, reading every byte they need in one coalesced pass"""
+        bitno_lists = [list(bitnos) for bitnos in bitno_lists]
+        values = read_fd_bytes(self.file_, [bitno >> 3 for bitnos in bitno_lists for bitno in bitnos])
+        results, changed = test_and_set_bytes(values, bitno_lists)
+        write_fd_bytes(self.file_, changed)
+        return results
+
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        return read_fd_range(self.file_, 0, self.num_chars)
+
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+        return read_fd_range(self.file_, byteno, min(length, self.num_chars - byteno))
+
+    def write_block(self, byteno, data):
+        """Overwrite bytes of the bit array starting at byte byteno"""
+        write_fd_range(self.file_, byteno, data)
+
+    def __reduce_ex__(self, protocol):
+        # Our file descriptor means nothing to another process; the file name does
+        return File_seek_backend, (self.num_bits, os.path.abspath(self.filename))
 
     def close(self):
         """Close the file"""
         os.close(self.file_)
 
 
-class Array_then_file_seek_backend(object):
+class Array_then_file_seek_backend(Base_backend):
     # pylint: disable=R0902
     # R0902: We kinda need a bunch of instance attributes
     """
-    Backend storage for our "array of bits" using a python array of integers up to some maximum number of bytes,
-    then spilling over to a file.  This is -not- a cache; we instead save the leftmost bits in RAM, and the
-    rightmost bits (if necessary) in a file.  On open, we read from the file to RAM.  On close, we write from RAM
-    to the file.
+    Backend storage for our "array of bits" using a bytearray up to some maximum number of bytes, then spilling
+    over to a file.  This is -not- a cache; we instead save the leftmost bits in RAM, and the rightmost bits (if
+    necessary) in a file.  On open, we read from the file to RAM.  On close, we write from RAM to the file.
     """
 
-    effs = 2 ** 8 - 1
+    kind = 'hybrid'
 
     def __init__(self, num_bits, filename, max_bytes_in_memory):
         self.num_bits = num_bits
         num_chars = (self.num_bits + 7) // 8
         self.filename = filename
         self.max_bytes_in_memory = max_bytes_in_memory
+        self.num_chars = num_chars
         self.bits_in_memory = min(num_bits, self.max_bytes_in_memory * 8)
         self.bits_in_file = max(self.num_bits - self.bits_in_memory, 0)
         self.bytes_in_memory = (self.bits_in_memory + 7) // 8
         self.bytes_in_file = (self.bits_in_file + 7) // 8
 
-        self.array_ = array.array('B', [0]) * self.bytes_in_memory
-        flags = os.O_RDWR | os.O_CREAT
-        if hasattr(os, 'O_BINARY'):
-            flags |= getattr(os, 'O_BINARY')
-        self.file_ = os.open(filename, flags)
-        os.lseek(self.file_, num_chars + 1, os.SEEK_SET)
-        os.write(self.file_, python2x3.null_byte)
+        self.file_ = open_bits_file(filename, num_chars)
+        self.array_ = bytearray(read_fd_range(self.file_, 0, self.bytes_in_memory))
 
-        os.lseek(self.file_, 0, os.SEEK_SET)
-        offset = 0
-        intended_block_len = 2 ** 17
-        while True:
-            if offset + intended_block_len < self.bytes_in_memory:
-                block = os.read(self.file_, intended_block_len)
-            elif offset < self.bytes_in_memory:
-                block = os.read(self.file_, self.bytes_in_memory - offset)
-            else:
-                break
-            for index_in_block, character in enumerate(block):
-                self.array_[offset + index_in_block] = ord(character)
-            offset += intended_block_len
+        self.page_bytes = CHECKPOINT_PAGE_BYTES
+        self.dirty = Dirty_page_map((self.bytes_in_memory + self.page_bytes - 1) // self.page_bytes)
 
     def is_set(self, bitno):
         """Return true iff bit number bitno is set"""
-        byteno, bit_within_byteno = divmod(bitno, 8)
-        mask = 1 << bit_within_byteno
+        byteno = bitno >> 3
         if byteno < self.bytes_in_memory:
-            return self.array_[byteno] & mask
-        else:
-            os.lseek(self.file_, byteno, os.SEEK_SET)
-            char = os.read(self.file_, 1)
-            if isinstance(char, str):
-                byte = ord(char)
-            else:
-                byte = int(char)
-            return byte & mask
+            return self.array_[byteno] & BIT_MASKS[bitno & 7]
+        return pread_fd(self.file_, 1, byteno)[0] & BIT_MASKS[bitno & 7]
 
     def set(self, bitno):
         """set bit number bitno to true"""
-        byteno, bit_within_byteno = divmod(bitno, 8)
-        mask = 1 << bit_within_byteno
+        byteno = bitno >> 3
         if byteno < self.bytes_in_memory:
-            self.array_[byteno] |= mask
+            self.dirty.mark(byteno // self.page_bytes)
+            self.array_[byteno] |= BIT_MASKS[bitno & 7]
         else:
-            os.lseek(self.file_, byteno, os.SEEK_SET)
-            char = os.read(self.file_, 1)
-            if isinstance(char, str):
-                byte = ord(char)
-                was_char = True
-            else:
-                byte = char
-                was_char = False
-            byte |= mask
-            os.lseek(self.file_, byteno, os.SEEK_SET)
-            if was_char:
-                os.write(self.file_, chr(byte))
-            else:
-                os.write(self.file_, byte)
+            pwrite_fd(self.file_, bytes((pread_fd(self.file_, 1, byteno)[0] | BIT_MASKS[bitno & 7],)), byteno)
 
     def clear(self, bitno):
         """clear bit number bitno - set it to false"""
-        byteno, bit_within_byteno = divmod(bitno, 8)
-        mask = Array_backend.effs - (1 << bit_within_byteno)
+        byteno = bitno >> 3
         if byteno < self.bytes_in_memory:
-            self.array_[byteno] &= mask
+            self.dirty.mark(byteno // self.page_bytes)
+            self.dirty.mark_cleared()
+            self.array_[byteno] &= CLEAR_MASKS[bitno & 7]
         else:
-            os.lseek(self.file_, byteno, os.SEEK_SET)
-            char = os.read(self.file_, 1)
-            if isinstance(char, str):
-                byte = ord(char)
-                was_char = True
+            pwrite_fd(self.file_, bytes((pread_fd(self.file_, 1, byteno)[0] & CLEAR_MASKS[bitno & 7],)), byteno)
+
+    def is_set_many(self, bitnos, fadvise=False):
+        """Return a list saying, for each of bitnos in order, whether it is set; the file part reads in ranges"""
+        bitnos = list(bitnos)
+        first_file_bitno = self.bytes_in_memory * 8
+        values = read_fd_bytes(self.file_, [bitno >> 3 for bitno in bitnos if bitno >= first_file_bitno], fadvise)
+        array_ = self.array_
+        return [
+            (array_[bitno >> 3] if bitno < first_file_bitno else values[bitno >> 3]) & BIT_MASKS[bitno & 7]
+            for bitno in bitnos
+        ]
+
+    def _split_masks(self, bitnos):
+        """Return bit_masks(bitnos) as (masks for the in-memory part, masks for the file part)"""
+        memory_masks = {}
+        file_masks = {}
+        for byteno, mask in bit_masks(bitnos).items():
+            if byteno < self.bytes_in_memory:
+                self.dirty.mark(byteno // self.page_bytes)
+                memory_masks[byteno] = mask
             else:
-                byte = int(char)
-                was_char = False
-            byte &= File_seek_backend.effs - mask
-            os.lseek(self.file_, byteno, os.SEEK_SET)
-            if was_char:
-                os.write(chr(byte))
+                file_masks[byteno] = mask
+        return memory_masks, file_masks
+
+    def set_many(self, bitnos):
+        """Set every one of bitnos; the file part gets one read-modify-write per coalesced range"""
+        memory_masks, file_masks = self._split_masks(bitnos)
+        array_ = self.array_
+        for byteno, mask in memory_masks.items():
+            array_[byteno] |= mask
+        or_fd_bytes(self.file_, file_masks)
+
+    def clear_many(self, bitnos):
+        """Clear every one of bitnos; the file part gets one read-modify-write per coalesced range"""
+        memory_masks, file_masks = self._split_masks(bitnos)
+        if memory_masks:
+            self.dirty.mark_cleared()
+        array_ = self.array_
+        for byteno, mask in memory_masks.items():
+            array_[byteno] &= 0xff ^ mask
+        clear_fd_bytes(self.file_, file_masks)
+
+    def test_and_set(self, bitnos):
+        """Set every one of bitnos, looking at each byte once; return true iff any of them wasn't already set"""
+        return self.test_and_set_many([bitnos])[0]
+
+    def test_and_set_many(self, bitno_lists):
+        """test_and_set() each list of bit numbers in turn; the file part is read in one coalesced pass"""
+        bitno_lists = [list(bitnos) for bitnos in bitno_lists]
+        bytenos = set(bitno >> 3 for bitnos in bitno_lists for bitno in bitnos)
+        array_ = self.array_
+        values = read_fd_bytes(self.file_, [byteno for byteno in bytenos if byteno >= self.bytes_in_memory])
+        values.update((byteno, array_[byteno]) for byteno in bytenos if byteno < self.bytes_in_memory)
+        results, changed = test_and_set_bytes(values, bitno_lists)
+        file_values = {}
+        for byteno, value in changed.items():
+            if byteno < self.bytes_in_memory:
+                self.dirty.mark(byteno // self.page_bytes)
+                array_[byteno] = value
             else:
-                os.write(byte)
+                file_values[byteno] = value
+        write_fd_bytes(self.file_, file_values)
+        return results
+
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        return bytes(self.array_) + read_fd_range(self.file_, self.bytes_in_memory, self.bytes_in_file)
+
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+        end = min(byteno + length, self.num_chars)
+        result = b''
+        if byteno < self.bytes_in_memory:
+            result = bytes(self.array_[byteno:min(end, self.bytes_in_memory)])
+        if end > self.bytes_in_memory:
+            start = max(byteno, self.bytes_in_memory)
+            result += read_fd_range(self.file_, start, end - start)
+        return result
+
+    def write_block(self, byteno, data):
+        """Overwrite bytes of the bit array starting at byte byteno"""
+        in_memory = max(0, min(len(data), self.bytes_in_memory - byteno))
+        if in_memory:
+            self.dirty.mark_range(byteno // self.page_bytes, (byteno + in_memory - 1) // self.page_bytes + 1)
+            self.dirty.mark_cleared()
+            self.array_[byteno:byteno + in_memory] = data[:in_memory]
+        if in_memory < len(data):
+            write_fd_range(self.file_, byteno + in_memory, data[in_memory:])
+
+    def flush(self):
+        """Write the changed pages of the in-memory portion to disk"""
+        memory = memoryview(self.array_)
+        for first_pageno, last_pageno in page_runs(self.dirty):
+            offset = first_pageno * self.page_bytes
+            write_fd_range(self.file_, offset, memory[offset:min(last_pageno * self.page_bytes, self.bytes_in_memory)])
+        self.dirty.reset()
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as a reference to the file, which must first hold the in-memory portion too
+        self.flush()
+        return Array_then_file_seek_backend, (
+            self.num_bits,
+            os.path.abspath(self.filename),
+            self.max_bytes_in_memory,
+        )
+
+    def close(self):
+        """Write the changed pages of the in-memory portion to disk, leave the already-on-disk portion unchanged"""
+        self.flush()
+        os.close(self.file_)
+
+
+class Array_backend(Base_backend):
+    """Backend storage for our "array of bits" using a python array of 64 bit integers"""
+
+    kind = 'array'
+
+    # Note that this has now been split out into a bits_mod for the benefit of other projects.
+    effs = 2 ** 64 - 1
+
+    def __init__(self, num_bits, page_bytes=CHECKPOINT_PAGE_BYTES, words=None):
+        if page_bytes <= 0 or page_bytes % WORD_BYTES != 0:
+            raise ValueError('page_bytes must be a positive multiple of %d' % WORD_BYTES)
+        self.num_bits = num_bits
+        self.num_chars = (self.num_bits + 7) // 8
+        self.num_words = (self.num_bits + WORD_BITS - 1) // WORD_BITS
+        if words is None:
+            self.array_ = array.array('Q', [0]) * self.num_words
+        elif len(words) != self.num_words:
+            raise ValueError('words has the wrong length for %d bits' % num_bits)
+        else:
+            self.array_ = words
+        self.page_bytes = page_bytes
+        self.words_per_page = page_bytes // WORD_BYTES
+        self.num_pages = (self.num_words + self.words_per_page - 1) // self.words_per_page
+        self.dirty = Dirty_page_map(self.num_pages)
+
+    def is_set(self, bitno):
+        """Return true iff bit number bitno is set"""
+        return self.array_[bitno >> 6] & (1 << (bitno & 63))
+
+    def set(self, bitno):
+        """set bit number bitno to true"""
+        wordno = bitno >> 6
+        self.dirty.mark(wordno // self.words_per_page)
+        self.array_[wordno] |= 1 << (bitno & 63)
+
+    def clear(self, bitno):
+        """clear bit number bitno - set it to false"""
+        wordno = bitno >> 6
+        self.dirty.mark(wordno // self.words_per_page)
+        self.dirty.mark_cleared()
+        self.array_[wordno] &= Array_backend.effs ^ (1 << (bitno & 63))
+
+    def is_set_many(self, bitnos, fadvise=False):
+        """Return a list saying, for each of bitnos in order, whether it is set"""
+        array_ = self.array_
+        return [array_[bitno >> 6] & (1 << (bitno & 63)) for bitno in bitnos]
+
+    def set_many(self, bitnos):
+        """Set every one of bitnos, touching each word once"""
+        array_ = self.array_
+        mark = self.dirty.mark
+        words_per_page = self.words_per_page
+        for wordno, mask in word_masks(bitnos).items():
+            mark(wordno // words_per_page)
+            array_[wordno] |= mask
+
+    def clear_many(self, bitnos):
+        """Clear every one of bitnos, touching each word once"""
+        array_ = self.array_
+        mark = self.dirty.mark
+        words_per_page = self.words_per_page
+        self.dirty.mark_cleared()
+        for wordno, mask in word_masks(bitnos).items():
+            mark(wordno // words_per_page)
+            array_[wordno] &= Array_backend.effs ^ mask
+
+    # The whole-array operations below convert a block of words at a time to one big python integer and back, so
+    # that the actual work is done a machine word at a time in C, rather than a word at a time in python, while the
+    # temporaries stay a few times MERGE_BLOCK_BYTES however big the filter is.
+
+    def _word_blocks(self, other):
+        """Generate (first wordno, end wordno, our block as an int, other's block as an int), a few pages at a time"""
+        words_per_block = max(1, MERGE_BLOCK_BYTES // self.page_bytes) * self.words_per_page
+        for first_wordno in range(0, self.num_words, words_per_block):
+            end_wordno = min(first_wordno + words_per_block, self.num_words)
+            yield (
+                first_wordno,
+                end_wordno,
+                int.from_bytes(words_to_bytes(self.array_[first_wordno:end_wordno]), 'little'),
+                int.from_bytes(words_to_bytes(other.array_[first_wordno:end_wordno]), 'little'),
+            )
+
+    def _combine_words(self, other, operator):
+        """Combine other's words into ours a block at a time, marking only the pages that change dirty"""
+        page_bytes = self.page_bytes
+        for first_wordno, end_wordno, ours, theirs in self._word_blocks(other):
+            value = operator(ours, theirs)
+            if value == ours:
+                continue
+            num_bytes = (end_wordno - first_wordno) * WORD_BYTES
+            changed = (value ^ ours).to_bytes(num_bytes, 'little')
+            first_pageno = first_wordno // self.words_per_page
+            for offset in range(0, num_bytes, page_bytes):
+                if any(changed[offset:offset + page_bytes]):
+                    self.dirty.mark(first_pageno + offset // page_bytes)
+            self.array_[first_wordno:end_wordno] = bytes_to_words(value.to_bytes(num_bytes, 'little'))
 
-    # These are quite slow ways to do iand and ior, but they should work,
-    # and a faster version is going to take more time
     def __iand__(self, other):
         assert self.num_bits == other.num_bits
 
-        for bitno in my_range(self.num_bits):
-            if self.is_set(bitno) and other.is_set(bitno):
-                self.set(bitno)
-            else:
-                self.clear(bitno)
+        if not isinstance(other, (Array_backend, Sparse_array_backend)):
+            return Base_backend.__iand__(self, other)
+        self.dirty.mark_cleared()
+        if isinstance(other, Sparse_array_backend):
+            other.and_into_dense(self)
+            return self
+
+        self._combine_words(other, lambda left, right: left & right)
 
         return self
 
     def __ior__(self, other):
         assert self.num_bits == other.num_bits
 
-        for bitno in my_range(self.num_bits):
-            if self.is_set(bitno) or other.is_set(bitno):
-                self.set(bitno)
-            else:
-                self.clear(bitno)
+        if not isinstance(other, (Array_backend, Sparse_array_backend)):
+            return Base_backend.__ior__(self, other)
+        if isinstance(other, Sparse_array_backend):
+            other.or_into_dense(self)
+            return self
+
+        self._combine_words(other, lambda left, right: left | right)
 
         return self
 
-    def close(self):
-        """Write the in-memory portion to disk, leave the already-on-disk portion unchanged"""
+    def __ixor__(self, other):
+        assert self.num_bits == other.num_bits
 
-        os.lseek(self.file_, 0, os.SEEK_SET)
-        for index in my_range(self.bytes_in_memory):
-            self.file_.write(self.array_[index])
+        self.dirty.mark_cleared()
+        self._combine_words(other, lambda left, right: left ^ right)
 
-        os.close(self.file_)
+        return self
 
+    def __eq__(self, other):
+        if not isinstance(other, Array_backend):
+            return NotImplemented
+        return self.num_bits == other.num_bits and self.array_ == other.array_
 
-class Array_backend(object):
-    """Backend storage for our "array of bits" using a python array of integers"""
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
-    # Note that this has now been split out into a bits_mod for the benefit of other projects.
-    effs = 2 ** 32 - 1
+    # We're mutable, so we mustn't be hashable
+    __hash__ = None
+
+    def issubset(self, other):
+        """Return true iff every bit set in us is also set in other"""
+        assert self.num_bits == other.num_bits
+        return all(ours | theirs == theirs for dummy, dummy, ours, theirs in self._word_blocks(other))
+
+    def issuperset(self, other):
+        """Return true iff every bit set in other is also set in us"""
+        return other.issubset(self)
+
+    def copy(self):
+        """Return a new Array_backend with the same bits as us"""
+        result = Array_backend(self.num_bits, self.page_bytes)
+        result.array_ = self.array_[:]
+        result.dirty.mark_all()
+        return result
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            # Expose our words as they are, so that a protocol 5 pickler can send them out of band without copying
+            return unpickle_array_backend, (self.num_bits, self.page_bytes, self.array_.itemsize, sys.byteorder,
+                                            pickle.PickleBuffer(self.array_), WORD_BITS)
+        return unpickle_array_backend, (self.num_bits, self.page_bytes, None, None, self.tobytes())
+
+    def clear_all(self):
+        """Clear every bit"""
+        self.dirty.mark_all()
+        self.dirty.mark_cleared()
+        self.array_ = array.array('Q', [0]) * self.num_words
+
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        return words_to_bytes(self.array_)[:self.num_chars]
+
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+        first_wordno, skip = divmod(byteno, WORD_BYTES)
+        end = min(byteno + length, self.num_chars)
+        last_wordno = (end + WORD_BYTES - 1) // WORD_BYTES
+        return words_to_bytes(self.array_[first_wordno:last_wordno])[skip:skip + end - byteno]
+
+    def write_block(self, byteno, data):
+        """Overwrite bytes of the bit array starting at byte byteno"""
+        first_wordno, skip = divmod(byteno, WORD_BYTES)
+        end = byteno + len(data)
+        last_wordno = (end + WORD_BYTES - 1) // WORD_BYTES
+        if skip or end % WORD_BYTES:
+            # Keep whatever bytes of the first and last words the caller didn't give us
+            head = self.read_block(byteno - skip, skip)
+            tail = self.read_block(end, last_wordno * WORD_BYTES - end)
+            data = head + bytes(data) + tail
+            data += bytes(-len(data) % WORD_BYTES)
+        self.dirty.mark_range(first_wordno // self.words_per_page, (last_wordno - 1) // self.words_per_page + 1)
+        self.dirty.mark_cleared()
+        self.array_[first_wordno:last_wordno] = bytes_to_words(data)
+
+    def frombytes(self, data):
+        """Replace the bit array with bytes in the layout tobytes() produces"""
+        self.dirty.mark_all()
+        self.dirty.mark_cleared()
+        self.array_ = bytes_to_words(bytes(data) + bytes(self.num_words * WORD_BYTES - len(data)))
+
+    def page_tobytes(self, pageno):
+        """Return page number pageno of the bit array as bytes, as tobytes() would lay it out"""
+        first_wordno = pageno * self.words_per_page
+        page = words_to_bytes(self.array_[first_wordno:first_wordno + self.words_per_page])
+        return page[:self.num_chars - pageno * self.page_bytes]
+
+
+DEFAULT_PAGE_BYTES = 2 ** 16
+
+
+def popcount_bytes(buffer_):
+    """Count the set bits in a bytes-like object"""
+    return bin(int.from_bytes(buffer_, 'little')).count('1')
+
+
+class Sparse_array_backend(Base_backend):
+    """
+    Backend storage for our "array of bits" using fixed-size pages of bytes that are only allocated on first
+    write.  Reads of pages that were never written return zero without allocating anything, so memory use
+    follows the actual fill of the filter rather than its worst case.
+    """
+
+    kind = 'sparse'
 
-    def __init__(self, num_bits):
+    def __init__(self, num_bits, page_bytes=DEFAULT_PAGE_BYTES):
+        if page_bytes <= 0 or page_bytes % 4 != 0:
+            raise ValueError('page_bytes must be a positive multiple of 4')
         self.num_bits = num_bits
-        self.num_words = (self.num_bits + 31) // 32
-        self.array_ = array.array('L', [0]) * self.num_words
+        self.num_chars = (self.num_bits + 7) // 8
+        self.page_bytes = page_bytes
+        self.page_bits = page_bytes * 8
+        self.num_pages = (self.num_chars + page_bytes - 1) // page_bytes
+        self.pages = {}
+        self.dirty = Dirty_page_map(self.num_pages)
+
+    def _get_page_for_write(self, pageno):
+        """Return page number pageno, allocating it if this is the first write to it"""
+        page = self.pages.get(pageno)
+        if page is None:
+            page = self.pages[pageno] = bytearray(self.page_bytes)
+        return page
 
     def is_set(self, bitno):
         """Return true iff bit number bitno is set"""
-        wordno, bit_within_wordno = divmod(bitno, 32)
-        mask = 1 << bit_within_wordno
-        return self.array_[wordno] & mask
+        pageno, bit_within_pageno = divmod(bitno, self.page_bits)
+        page = self.pages.get(pageno)
+        if page is None:
+            return 0
+        byteno, bit_within_byteno = divmod(bit_within_pageno, 8)
+        return page[byteno] & (1 << bit_within_byteno)
 
     def set(self, bitno):
         """set bit number bitno to true"""
-        wordno, bit_within_wordno = divmod(bitno, 32)
-        mask = 1 << bit_within_wordno
-        self.array_[wordno] |= mask
+        pageno, bit_within_pageno = divmod(bitno, self.page_bits)
+        byteno, bit_within_byteno = divmod(bit_within_pageno, 8)
+        self.dirty.mark(pageno)
+        self._get_page_for_write(pageno)[byteno] |= 1 << bit_within_byteno
 
     def clear(self, bitno):
         """clear bit number bitno - set it to false"""
-        wordno, bit_within_wordno = divmod(bitno, 32)
-        mask = Array_backend.effs - (1 << bit_within_wordno)
-        self.array_[wordno] &= mask
-
-    # It'd be nice to do __iand__ and __ior__ in a base class, but that'd be Much slower
+        pageno, bit_within_pageno = divmod(bitno, self.page_bits)
+        page = self.pages.get(pageno)
+        if page is None:
+            # Already zero, and there's no point allocating a page just to keep it that way
+            return
+        byteno, bit_within_byteno = divmod(bit_within_pageno, 8)
+        self.dirty.mark(pageno)
+        self.dirty.mark_cleared()
+        page[byteno] &= 0xff ^ (1 << bit_within_byteno)
+
+    def page_popcount(self, pageno):
+        """Return the number of set bits in page number pageno"""
+        page = self.pages.get(pageno)
+        if page is None:
+            return 0
+        return popcount_bytes(page)
+
+    def popcount(self):
+        """Return the number of set bits in the whole filter"""
+        return sum(popcount_bytes(page) for page in self.pages.values())
+
+    def resident_bytes(self):
+        """Return the number of bytes of bit storage actually allocated"""
+        return len(self.pages) * self.page_bytes
+
+    def _dense_page_bytes(self, pageno, dense):
+        """Return the bytes of an Array_backend that correspond to page number pageno, in our layout"""
+        packed = dense.read_block(pageno * self.page_bytes, self.page_bytes)
+        return packed + bytes(self.page_bytes - len(packed))
+
+    def or_into_dense(self, dense):
+        """OR our pages into an Array_backend; only pages we have allocated are visited"""
+        for pageno, page in self.pages.items():
+            byteno = pageno * self.page_bytes
+            dense.or_block(byteno, bytes(page[:self.num_chars - byteno]))
+
+    def and_into_dense(self, dense):
+        """AND our pages into an Array_backend; pages we never allocated zero the corresponding bytes"""
+        for pageno in my_range(self.num_pages):
+            byteno = pageno * self.page_bytes
+            length = min(self.page_bytes, self.num_chars - byteno)
+            page = self.pages.get(pageno)
+            if page is None:
+                dense.write_block(byteno, bytes(length))
+                continue
+            ours = int.from_bytes(dense.read_block(byteno, length), 'little')
+            value = ours & int.from_bytes(page[:length], 'little')
+            if value != ours:
+                dense.write_block(byteno, value.to_bytes(length, 'little'))
+
+    def _combine_pages(self, page, other_page, operator):
+        """Combine two pages a whole page at a time, using python's big integers"""
+        value = operator(int.from_bytes(page, 'little'), int.from_bytes(other_page, 'little'))
+        page[:] = value.to_bytes(self.page_bytes, 'little')
 
     def __iand__(self, other):
         assert self.num_bits == other.num_bits
 
-        for wordno in my_range(self.num_words):
-            self.array_[wordno] &= other.array_[wordno]
+        if not isinstance(other, (Array_backend, Sparse_array_backend)):
+            return Base_backend.__iand__(self, other)
+        self.dirty.mark_cleared()
+        for pageno in list(self.pages):
+            self.dirty.mark(pageno)
+            if isinstance(other, Sparse_array_backend):
+                other_page = other.pages.get(pageno)
+                if other_page is None:
+                    del self.pages[pageno]
+                    continue
+            else:
+                other_page = self._dense_page_bytes(pageno, other)
+            self._combine_pages(self.pages[pageno], other_page, lambda left, right: left & right)
+            if not any(self.pages[pageno]):
+                del self.pages[pageno]
 
         return self
 
+    def __ixor__(self, other):
+        assert self.num_bits == other.num_bits
+
+        self.dirty.mark_cleared()
+        if isinstance(other, Sparse_array_backend):
+            assert self.page_bytes == other.page_bytes
+            other_pages = other.pages.items()
+        else:
+            other_pages = ((pageno, self._dense_page_bytes(pageno, other)) for pageno in my_range(self.num_pages))
+        for pageno, other_page in other_pages:
+            if not any(other_page):
+                continue
+            self.dirty.mark(pageno)
+            self._combine_pages(self._get_page_for_write(pageno), other_page, lambda left, right: left ^ right)
+            if not any(self.pages[pageno]):
+                del self.pages[pageno]
+
+        return self
+
+    def copy(self):
+        """Return a new Sparse_array_backend with the same bits as us"""
+        result = Sparse_array_backend(self.num_bits, self.page_bytes)
+        result.pages = dict((pageno, bytearray(page)) for pageno, page in self.pages.items())
+        result.dirty.mark_all()
+        return result
+
+    def __reduce_ex__(self, protocol):
+        # Just the allocated pages: our dirty map and any snapshots watching it stay behind
+        if protocol >= 5:
+            pages = [(pageno, pickle.PickleBuffer(page)) for pageno, page in self.pages.items()]
+        else:
+            pages = list(self.pages.items())
+        return unpickle_sparse_array_backend, (self.num_bits, self.page_bytes, pages)
+
+    def clear_all(self):
+        """Clear every bit, releasing every page"""
+        self.dirty.mark_all()
+        self.dirty.mark_cleared()
+        self.pages = {}
+
     def __ior__(self, other):
         assert self.num_bits == other.num_bits
 
-        for wordno in my_range(self.num_words):
-            self.array_[wordno] |= other.array_[wordno]
+        if not isinstance(other, (Array_backend, Sparse_array_backend)):
+            return Base_backend.__ior__(self, other)
+        if isinstance(other, Sparse_array_backend):
+            assert self.page_bytes == other.page_bytes
+            for pageno, other_page in other.pages.items():
+                self.dirty.mark(pageno)
+                self._combine_pages(self._get_page_for_write(pageno), other_page, lambda left, right: left | right)
+        else:
+            for pageno in my_range(self.num_pages):
+                other_page = self._dense_page_bytes(pageno, other)
+                if not any(other_page):
+                    continue
+                self.dirty.mark(pageno)
+                self._combine_pages(self._get_page_for_write(pageno), other_page, lambda left, right: left | right)
 
         return self
 
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        empty_page = bytes(self.page_bytes)
+        result = b''.join(bytes(self.pages.get(pageno, empty_page)) for pageno in my_range(self.num_pages))
+        return result[:self.num_chars]
+
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+        end = min(byteno + length, self.num_chars)
+        parts = []
+        while byteno < end:
+            pageno, byte_within_pageno = divmod(byteno, self.page_bytes)
+            chunk_len = min(self.page_bytes - byte_within_pageno, end - byteno)
+            page = self.pages.get(pageno)
+            if page is None:
+                parts.append(bytes(chunk_len))
+            else:
+                parts.append(bytes(page[byte_within_pageno:byte_within_pageno + chunk_len]))
+            byteno += chunk_len
+        return b''.join(parts)
+
+    def write_block(self, byteno, data):
+        """Overwrite bytes of the bit array starting at byte byteno; zeros don't allocate untouched pages"""
+        offset = 0
+        while offset < len(data):
+            pageno, byte_within_pageno = divmod(byteno + offset, self.page_bytes)
+            chunk = data[offset:offset + self.page_bytes - byte_within_pageno]
+            if pageno in self.pages or any(chunk):
+                self.dirty.mark(pageno)
+                self._get_page_for_write(pageno)[byte_within_pageno:byte_within_pageno + len(chunk)] = chunk
+            offset += len(chunk)
+        self.dirty.mark_cleared()
+
+    def frombytes(self, data):
+        """Replace the bit array with bytes in the layout tobytes() produces; all-zero pages stay unallocated"""
+        self.dirty.mark_all()
+        self.dirty.mark_cleared()
+        self.pages = {}
+        for pageno in my_range(self.num_pages):
+            chunk = data[pageno * self.page_bytes:(pageno + 1) * self.page_bytes]
+            if any(chunk):
+                self.pages[pageno] = bytearray(chunk) + bytearray(self.page_bytes - len(chunk))
+
+    def page_tobytes(self, pageno):
+        """Return page number pageno of the bit array as bytes, as tobytes() would lay it out"""
+        page = self.pages.get(pageno)
+        length = min(self.page_bytes, self.num_chars - pageno * self.page_bytes)
+        if page is None:
+            return bytes(length)
+        return bytes(page[:length])
+
+
+def unpickle_array_backend(num_bits, page_bytes, itemsize, byteorder, data, word_bits=32):
+    """
+    Rebuild a pickled Array_backend: data is its raw words if itemsize is given, else its tobytes().  Pickles from
+    before words held 64 bits carry no word_bits, and their words hold 32 bits each, whatever their itemsize.
+    """
+    # pylint: disable=R0913
+    # R0913: We want a few arguments
+    # Out of band buffers come back as whatever the transport gave us, so look at them as plain bytes
+    data = memoryview(data).cast('B')
+    if itemsize is None:
+        result = Array_backend(num_bits, page_bytes)
+        result.frombytes(data)
+    elif word_bits == WORD_BITS and itemsize == WORD_BYTES:
+        words = array.array('Q')
+        words.frombytes(data)
+        if byteorder != sys.byteorder:
+            words.byteswap()
+        result = Array_backend(num_bits, page_bytes, words)
+    else:
+        foreign = array.array({4: 'I', 8: 'Q'}[itemsize])
+        foreign.frombytes(data)
+        if byteorder != sys.byteorder:
+            foreign.byteswap()
+        old_words = array.array('I', foreign)
+        if sys.byteorder == 'big':
+            old_words.byteswap()
+        result = Array_backend(num_bits, page_bytes)
+        result.frombytes(old_words.tobytes())
+    result.dirty.mark_all()
+    return result
+
+
+def unpickle_sparse_array_backend(num_bits, page_bytes, pages):
+    """Rebuild a pickled Sparse_array_backend from its (page number, page) pairs"""
+    result = Sparse_array_backend(num_bits, page_bytes)
+    result.pages = dict(
+        (pageno, page if isinstance(page, bytearray) else bytearray(memoryview(page))) for pageno, page in pages
+    )
+    result.dirty.mark_all()
+    return result
+
+
+class Snapshot_backend(Base_backend):
+    """
+    A read-only, copy-on-write view of an Array_backend or Sparse_array_backend, as it was when the snapshot was
+    taken.  We share every page with the live backend, until the live backend is about to change a page: then we
+    keep a copy of that page as it was.  Call release() once done, so the live backend stops paying for copies.
+    """
+
+    kind = 'snapshot'
+
+    def __init__(self, live):
+        self.live = live
+        self.num_bits = live.num_bits
+        self.num_chars = live.num_chars
+        self.page_bytes = live.page_bytes
+        self.preserved = {}
+        live.dirty.add_watcher(self)
+
+    def preserve(self, pageno):
+        """Called by the live backend just before it changes page pageno"""
+        if pageno not in self.preserved:
+            self.preserved[pageno] = self.live.page_tobytes(pageno)
+
+    def is_set(self, bitno):
+        """Return true iff bit number bitno was set when the snapshot was taken"""
+        byteno = bitno >> 3
+        pageno, byte_within_pageno = divmod(byteno, self.page_bytes)
+        page = self.preserved.get(pageno)
+        if page is None:
+            result = self.live.is_set(bitno)
+            # Pages are preserved before they change, so if the live page changed under us, it's here now
+            page = self.preserved.get(pageno)
+            if page is None:
+                return result
+        return page[byte_within_pageno] & (1 << (bitno & 7))
+
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+        end = min(byteno + length, self.num_chars)
+        parts = []
+        while byteno < end:
+            pageno, byte_within_pageno = divmod(byteno, self.page_bytes)
+            chunk_len = min(self.page_bytes - byte_within_pageno, end - byteno)
+            page = self.preserved.get(pageno)
+            if page is None:
+                chunk = self.live.read_block(byteno, chunk_len)
+                page = self.preserved.get(pageno)
+            if page is not None:
+                chunk = page[byte_within_pageno:byte_within_pageno + chunk_len]
+            parts.append(chunk)
+            byteno += chunk_len
+        return b''.join(parts)
+
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        return self.read_block(0, self.num_chars)
+
+    def set(self, bitno):
+        """Snapshots are read-only"""
+        raise TypeError('Cannot modify a snapshot')
+
+    def clear(self, bitno):
+        """Snapshots are read-only"""
+        raise TypeError('Cannot modify a snapshot')
+
+    def write_block(self, byteno, data):
+        """Snapshots are read-only"""
+        raise TypeError('Cannot modify a snapshot')
+
+    def overhead_bytes(self):
+        """Return the number of bytes of pages we've had to copy so far"""
+        return sum(len(page) for page in list(self.preserved.values()))
+
+    def release(self):
+        """Stop tracking the live backend, and drop our copied pages.  The snapshot can't be read afterward."""
+        self.live.dirty.remove_watcher(self)
+        self.preserved = {}
+        self.live = None
+
     def close(self):
-        """Noop for compatibility with the file+seek backend"""
-        pass
+        """Same as release(), for compatibility with the other backends"""
+        if self.live is not None:
+            self.release()
+
+
+class Migrating_backend(Base_backend):
+    """
+    Stands in for a backend while BloomFilter.migrate() copies its bits to another.  Reads come from the source,
+    which has every bit; writes go to both.  Writes and block copies take turns under a lock, so a bit set in the
+    target while copy_block() is ORing into it can't be written over.
+    """
+
+    kind = 'migrating'
+
+    def __init__(self, source, target):
+        assert source.num_bits == target.num_bits
+        self.source = source
+        self.target = target
+        self.num_bits = source.num_bits
+        self.num_chars = source.num_chars
+        self.lock = threading.Lock()
+
+    def is_set(self, bitno):
+        """Return true iff bit number bitno is set"""
+        return self.source.is_set(bitno)
+
+    def is_set_many(self, bitnos, fadvise=False):
+        """Return a list saying, for each of bitnos in order, whether it is set"""
+        return self.source.is_set_many(bitnos, fadvise)
+
+    def read_block(self, byteno, length):
+        """Return length bytes of the bit array starting at byte byteno, as tobytes() would lay them out"""
+        return self.source.read_block(byteno, length)
+
+    def set(self, bitno):
+        """set bit number bitno to true, in both backends"""
+        with self.lock:
+            self.source.set(bitno)
+            self.target.set(bitno)
+
+    def clear(self, bitno):
+        """clear bit number bitno, in both backends"""
+        with self.lock:
+            self.source.clear(bitno)
+            self.target.clear(bitno)
+
+    def set_many(self, bitnos):
+        """Set every one of bitnos, in both backends"""
+        bitnos = list(bitnos)
+        with self.lock:
+            self.source.set_many(bitnos)
+            self.target.set_many(bitnos)
+
+    def clear_many(self, bitnos):
+        """Clear every one of bitnos, in both backends"""
+        bitnos = list(bitnos)
+        with self.lock:
+            self.source.clear_many(bitnos)
+            self.target.clear_many(bitnos)
+
+    def test_and_set(self, bitnos):
+        """Test and set bitnos in the source, and set them in the target"""
+        bitnos = list(bitnos)
+        with self.lock:
+            result = self.source.test_and_set(bitnos)
+            self.target.set_many(bitnos)
+        return result
+
+    def test_and_set_many(self, bitno_lists):
+        """test_and_set() each list of bit numbers in turn; return the list of results"""
+        bitno_lists = [list(bitnos) for bitnos in bitno_lists]
+        with self.lock:
+            results = self.source.test_and_set_many(bitno_lists)
+            self.target.set_many(bitno for bitnos in bitno_lists for bitno in bitnos)
+        return results
+
+    def write_block(self, byteno, data):
+        """Overwrite bytes of the bit array starting at byte byteno, in both backends"""
+        with self.lock:
+            self.source.write_block(byteno, data)
+            self.target.write_block(byteno, data)
+
+    def copy_block(self, byteno, length):
+        """OR length bytes of the source, starting at byte byteno, into the target"""
+        with self.lock:
+            self.target.or_block(byteno, self.source.read_block(byteno, length))
+
+
+def new_backend(kind, num_bits, filename=None, start_fresh=False):
+    """Create a backend of the given kind - 'array', 'sparse', 'mmap' or 'seek' - for num_bits bits"""
+    if kind == 'array':
+        return Array_backend(num_bits)
+    if kind == 'sparse':
+        return Sparse_array_backend(num_bits)
+    if kind not in ('mmap', 'seek'):
+        raise ValueError('Unknown backend: %r' % (kind,))
+    if kind == 'mmap' and not HAVE_MMAP:
+        raise ValueError('mmap is not available here')
+    if filename is None:
+        raise ValueError('a %s backend needs a filename' % kind)
+    if start_fresh:
+        try_unlink(filename)
+    if kind == 'mmap':
+        return Mmap_backend(num_bits, filename)
+    return File_seek_backend(num_bits, filename)
 
 
 def get_bitno_seed_rnd(bloom_filter, key):
     """Apply num_probes_k hash functions to key.  Generate the array index and bitmask corresponding to each result"""
 
-    # We're using key as a seed to a pseudorandom number generator
+    # We're using key as a seed to a pseudorandom number generator, which only takes a few types as seeds
+    if not isinstance(key, (int, float, str, bytes, bytearray)):
+        key = encode_key(key)
     hasher = random.Random(key).randrange
     for dummy in range(bloom_filter.num_probes_k):
         bitno = hasher(bloom_filter.num_bits_m)
@@ -465,25 +1482,35 @@ def hash2(int_list):
     return simple_hash(int_list, MERSENNES2[0], MERSENNES2[1], MERSENNES2[2])
 
 
-def get_filter_bitno_probes(bloom_filter, key):
-    """Apply num_probes_k hash functions to key.  Generate the array index and bitmask corresponding to each result"""
-
-    # This one assumes key is either bytes or str (or other list of integers)
+def key_to_int_list(key):
+    """Return the list of integers (or bytes) that get_filter_bitno_probes hashes for key"""
 
-    # I'd love to check for long too, but that doesn't exist in 3.2, and 2.5 doesn't have the numbers.Integral base type
-    if hasattr(key, '__divmod__'):
+    # str, bytes, non-negative integers and sequences of integers are hashed just as they always have been, so that
+    # existing filters keep working.  Everything else goes through a key codec, straight to bytes.
+    if isinstance(key, numbers.Integral) and key >= 0:
         int_list = []
         temp = key
         while temp:
             quotient, remainder = divmod(temp, 256)
             int_list.append(remainder)
             temp = quotient
-    elif hasattr(key[0], '__divmod__'):
-        int_list = key
-    elif isinstance(key[0], str):
-        int_list = [ord(char) for char in key]
-    else:
-        raise TypeError('Sorry, I do not know how to hash this type')
+        return int_list
+    elif isinstance(key, str):
+        return [ord(char) for char in key]
+    elif isinstance(key, (bytes, bytearray, memoryview)):
+        return key
+    elif isinstance(key, (list, tuple)) and key:
+        if all(isinstance(element, numbers.Integral) for element in key):
+            return key
+        if all(isinstance(element, str) and len(element) == 1 for element in key):
+            return [ord(char) for char in key]
+    return encode_key(key)
+
+
+def get_filter_bitno_probes(bloom_filter, key):
+    """Apply num_probes_k hash functions to key.  Generate the array index and bitmask corresponding to each result"""
+
+    int_list = key_to_int_list(key)
 
     hash_value1 = hash1(int_list)
     hash_value2 = hash2(int_list)
@@ -496,6 +1523,52 @@ def get_filter_bitno_probes(bloom_filter, key):
         yield probe_value % bloom_filter.num_bits_m
 
 
+MASK64 = 2 ** 64 - 1
+FNV64_OFFSET = 0xcbf29ce484222325
+FNV64_PRIME = 0x100000001b3
+GOLDEN64 = 0x9e3779b97f4a7c15
+
+
+def mix64(value):
+    """The splitmix64 finalizer: scramble a 64 bit integer so that every input bit affects every output bit"""
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK64
+    return value ^ (value >> 31)
+
+
+def fnv1a64(data):
+    """Return the 64 bit FNV-1a hash of a bytes-like object"""
+    result = FNV64_OFFSET
+    for byte in bytes(data):
+        result = ((result ^ byte) * FNV64_PRIME) & MASK64
+    return result
+
+
+def key_to_hash64(key):
+    """Return the 64 bit hash get_bitno_fnv64 probes with for key"""
+    # Integers that fit in 64 bits are mixed as they are, str is hashed as utf-8, so that numpy integer columns and
+    # Arrow string and binary columns can be hashed the same way without going via python objects
+    if isinstance(key, numbers.Integral) and -2 ** 63 <= key <= MASK64:
+        return mix64(int(key) & MASK64)
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif not isinstance(key, (bytes, bytearray, memoryview)):
+        key = encode_key(key)
+    return mix64(fnv1a64(key))
+
+
+def get_bitno_fnv64(bloom_filter, key):
+    """
+    Apply num_probes_k hash functions to key, by double hashing a 64 bit hash of it.  Unlike
+    get_filter_bitno_probes, this can be computed for a whole numpy or Arrow column at once, which
+    BloomFilter.add_array and contains_array do for filters that use it.
+    """
+    hash_value1 = key_to_hash64(key)
+    hash_value2 = mix64(hash_value1 ^ GOLDEN64) | 1
+    for probeno in range(bloom_filter.num_probes_k):
+        yield ((hash_value1 + probeno * hash_value2) & MASK64) % bloom_filter.num_bits_m
+
+
 def try_unlink(filename):
     """unlink a file.  Don't complain if it's not there"""
     try:
@@ -507,12 +1580,18 @@ def try_unlink(filename):
 
 class BloomFilter(object):
     """Probabilistic set membership testing for large sets"""
+
+    # With backend='auto' or a BackendPolicy, the policy that places our bits, and every placement decision so far
+    policy = None
+    placement_decisions = ()
+
     def __init__(self,
                  max_elements=10000,
                  error_rate=0.1,
                  probe_bitnoer=get_filter_bitno_probes,
                  filename=None,
-                 start_fresh=False):
+                 start_fresh=False,
+                 backend=None):
         # pylint: disable=R0913
         # R0913: We want a few arguments
         if max_elements <= 0:
@@ -530,7 +1609,26 @@ class BloomFilter(object):
         real_num_bits_m = numerator / denominator
         self.num_bits_m = int(math.ceil(real_num_bits_m))
 
-        if filename is None:
+        # AKA num_offsetters
+        # Verified against http://en.wikipedia.org/wiki/Bloom_filter#Probability_of_false_positives
+        real_num_probes_k = (self.num_bits_m / self.ideal_num_elements_n) * math.log(2)
+        self._setup(int(math.ceil(real_num_probes_k)), probe_bitnoer, filename, start_fresh, backend)
+
+    def _setup(self, num_probes_k, probe_bitnoer, filename, start_fresh, backend):
+        """Create our backend for num_bits_m bits, and remember how to probe it"""
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        if backend == 'auto' or isinstance(backend, placement_mod.BackendPolicy):
+            # filename is where the policy may put our bits on disk, not a backend choice of its own
+            self.policy = placement_mod.BackendPolicy(path=filename) if backend == 'auto' else backend
+            kind, reason = self.policy.choose(self.num_bits_m)
+            self.backend = new_backend(kind, self.num_bits_m, self.policy.path, start_fresh)
+            self._record_placement(None, kind, reason, 0.0)
+        elif backend == 'sparse':
+            self.backend = Sparse_array_backend(self.num_bits_m)
+        elif backend is not None:
+            raise ValueError('Unknown backend: %r' % (backend,))
+        elif filename is None:
             self.backend = Array_backend(self.num_bits_m)
         elif isinstance(filename, tuple) and isinstance(filename[1], int):
             if start_fresh:
@@ -544,12 +1642,71 @@ class BloomFilter(object):
                 try_unlink(filename)
             self.backend = File_seek_backend(self.num_bits_m, filename)
 
-        # AKA num_offsetters
-        # Verified against http://en.wikipedia.org/wiki/Bloom_filter#Probability_of_false_positives
-        real_num_probes_k = (self.num_bits_m / self.ideal_num_elements_n) * math.log(2)
-        self.num_probes_k = int(math.ceil(real_num_probes_k))
+        self.num_probes_k = num_probes_k
         self.probe_bitnoer = probe_bitnoer
 
+    @classmethod
+    def _from_layout(cls,
+                     max_elements,
+                     error_rate,
+                     num_bits_m,
+                     num_probes_k,
+                     probe_bitnoer=get_filter_bitno_probes,
+                     filename=None,
+                     start_fresh=False,
+                     backend=None):
+        """Create a filter with an explicit num_bits_m and num_probes_k, rather than deriving them"""
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.ideal_num_elements_n = max_elements
+        bloom_filter.error_rate_p = error_rate
+        bloom_filter.num_bits_m = num_bits_m
+        bloom_filter._setup(num_probes_k, probe_bitnoer, filename, start_fresh, backend)
+        return bloom_filter
+
+    @staticmethod
+    def plan(max_elements, memory_bytes=None, error_rate=None, max_probes=None, backend=None):
+        """
+        Work out num_bits_m and num_probes_k from whichever constraints matter to you: a memory budget, a target
+        error rate, a limit on probes per lookup, or a combination.  The returned BloomFilterPlan also predicts the
+        error rate, memory and I/O per lookup on each backend; pass it to from_plan() to build the filter.
+        """
+        return planner_mod.plan(
+            max_elements,
+            memory_bytes=memory_bytes,
+            error_rate=error_rate,
+            max_probes=max_probes,
+            backend=backend,
+        )
+
+    @classmethod
+    def from_plan(cls, plan, probe_bitnoer=get_filter_bitno_probes, filename=None, start_fresh=False, backend=None):
+        """
+        Create a filter laid out as a BloomFilter.plan() result says.  A plan for the 'mmap' or 'seek' backend needs
+        filename, which is where its bits go.
+        """
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        if backend is None:
+            if plan.backend == 'sparse':
+                backend = 'sparse'
+            elif plan.backend in ('mmap', 'seek'):
+                if filename is None:
+                    raise ValueError('A plan for the %s backend needs a filename' % (plan.backend,))
+                if plan.backend == 'mmap':
+                    filename = (filename, -1)
+        return cls._from_layout(
+            plan.max_elements,
+            plan.predicted_error_rate,
+            plan.num_bits_m,
+            plan.num_probes_k,
+            probe_bitnoer=probe_bitnoer,
+            filename=filename,
+            start_fresh=start_fresh,
+            backend=backend,
+        )
+
     def __repr__(self):
         return 'BloomFilter(ideal_num_elements_n=%d, error_rate_p=%f, num_bits_m=%d)' % (
             self.ideal_num_elements_n,
@@ -572,9 +1729,17 @@ class BloomFilter(object):
                 and self.num_probes_k == bloom_filter.num_probes_k
                 and self.probe_bitnoer == bloom_filter.probe_bitnoer)
 
+    def _in_memory_pair(self, bloom_filter):
+        """Return true iff both backends are in-memory ones, which know how to combine with each other directly"""
+        in_memory = (Array_backend, Sparse_array_backend)
+        return isinstance(self.backend, in_memory) and isinstance(bloom_filter.backend, in_memory)
+
     def union(self, bloom_filter):
         """Compute the set union of two bloom filters"""
-        self.backend |= bloom_filter.backend
+        if self._in_memory_pair(bloom_filter):
+            self.backend |= bloom_filter.backend
+        else:
+            self.backend.combine_blockwise(bloom_filter.backend, lambda left, right: left | right)
 
     def __ior__(self, bloom_filter):
         self.union(bloom_filter)
@@ -582,14 +1747,483 @@ class BloomFilter(object):
 
     def intersection(self, bloom_filter):
         """Compute the set intersection of two bloom filters"""
-        self.backend &= bloom_filter.backend
+        if self._in_memory_pair(bloom_filter):
+            self.backend &= bloom_filter.backend
+        else:
+            self.backend.combine_blockwise(bloom_filter.backend, lambda left, right: left & right)
 
     def __iand__(self, bloom_filter):
         self.intersection(bloom_filter)
         return self
 
+    def _check_template(self, bloom_filter):
+        """Raise ValueError unless bloom_filter has the same layout as us"""
+        if not self._match_template(bloom_filter):
+            raise ValueError('Filters must have the same num_bits_m, num_probes_k and probe_bitnoer')
+
+    def _blocks(self, bloom_filter, block_bytes=MERGE_BLOCK_BYTES):
+        """Generate (byteno, our block as an int, their block as an int) for any pair of backends"""
+        num_chars = (self.num_bits_m + 7) // 8
+        for byteno in range(0, num_chars, block_bytes):
+            length = min(block_bytes, num_chars - byteno)
+            yield (
+                byteno,
+                int.from_bytes(self.backend.read_block(byteno, length), 'little'),
+                int.from_bytes(bloom_filter.backend.read_block(byteno, length), 'little'),
+            )
+
+    def _same_backend_type(self, bloom_filter):
+        """Return true iff both of us use the same in-memory backend class, for the whole-buffer fast paths"""
+        return type(self.backend) is type(bloom_filter.backend) and hasattr(self.backend, 'copy')
+
+    def _record_placement(self, from_kind, to_kind, reason, seconds):
+        """Note a placement decision; the tuple is replaced, never changed, so readers always see a whole one"""
+        self.placement_decisions = self.placement_decisions + ({
+            'time': time.time(),
+            'from': from_kind,
+            'to': to_kind,
+            'reason': reason,
+            'seconds': seconds,
+        },)
+
+    def migrate(self, to_backend, filename=None, close_old=False, reason='requested'):
+        """
+        Move our bits to to_backend - 'array', 'sparse', 'mmap' or 'seek' (the last two at filename), or a backend
+        for num_bits_m bits - copying them a block at a time while lookups and adds carry on, then switching over
+        in one step.  Bits cleared during the copy may survive it.  Returns the old backend, which lookups already
+        under way on other threads finish on, so it is left open: close it once they are done, or pass
+        close_old=True if no other thread can be using the filter.
+        """
+        source = self.backend
+        if isinstance(source, Migrating_backend):
+            raise ValueError('already migrating')
+        if isinstance(to_backend, Base_backend):
+            if to_backend.num_bits != self.num_bits_m:
+                raise ValueError('to_backend has %d bits, not %d' % (to_backend.num_bits, self.num_bits_m))
+            target = to_backend
+        else:
+            if to_backend in ('mmap', 'seek') and filename == getattr(source, 'filename', None):
+                raise ValueError('cannot migrate onto the file we are migrating from')
+            target = new_backend(to_backend, self.num_bits_m, filename, start_fresh=True)
+        started = time.time()
+        migrating = Migrating_backend(source, target)
+        self.backend = migrating
+        # A thread that fetched self.backend just before we replaced it may still write to the source alone, after
+        # its block was copied.  A second pass picks those bits up; it only ORs in what the first one missed.
+        for dummy in range(2):
+            for byteno in range(0, source.num_chars, MERGE_BLOCK_BYTES):
+                migrating.copy_block(byteno, min(MERGE_BLOCK_BYTES, source.num_chars - byteno))
+        self.backend = target
+        self._record_placement(source.kind, target.kind, reason, time.time() - started)
+        if close_old:
+            source.close()
+        return source
+
+    def rebalance(self, hot=None):
+        """
+        Ask our policy where our bits belong now, telling it whether we're hot (busy), if the caller knows, and migrate
+        them there if that's somewhere else.  Return the old backend if we migrated, for the caller to close as
+        migrate() describes, or None if we didn't.
+        """
+        if self.policy is None:
+            raise ValueError("only filters created with backend='auto' or a BackendPolicy can rebalance")
+        kind, reason = self.policy.choose(self.num_bits_m, hot)
+        if kind == self.backend.kind:
+            return None
+        return self.migrate(kind, self.policy.path, reason=reason)
+
+    def placement_stats(self):
+        """Describe where our bits live, the policy placing them, and every placement decision so far"""
+        return {
+            'backend': self.backend.kind,
+            'num_bytes': (self.num_bits_m + 7) // 8,
+            'policy': repr(self.policy) if self.policy is not None else None,
+            'migrations': sum(1 for decision in self.placement_decisions if decision['from'] is not None),
+            'decisions': list(self.placement_decisions),
+        }
+
+    def _with_backend(self, backend):
+        """Return a new filter with our template, over backend"""
+        result = type(self).__new__(type(self))
+        result.ideal_num_elements_n = self.ideal_num_elements_n
+        result.error_rate_p = self.error_rate_p
+        result.num_bits_m = self.num_bits_m
+        result.num_probes_k = self.num_probes_k
+        result.probe_bitnoer = self.probe_bitnoer
+        result.backend = backend
+        return result
+
+    def copy(self):
+        """Return a new, independent filter with the same template and contents"""
+        if not hasattr(self.backend, 'copy'):
+            return type(self).union_all([self])
+        return self._with_backend(self.backend.copy())
+
+    def snapshot(self):
+        """
+        Return a read-only filter showing our contents as they are now, without copying them: pages are only
+        copied when we next change them.  Only the in-memory backends support this.  Call
+        snapshot.backend.release() when done with it.
+        """
+        if not hasattr(self.backend, 'dirty') or not hasattr(self.backend, 'page_tobytes'):
+            raise ValueError('%s does not support snapshots' % type(self.backend).__name__)
+        return self._with_backend(Snapshot_backend(self.backend))
+
+    def snapshot_overhead_bytes(self):
+        """Return the bytes our live snapshots are currently using for copied pages"""
+        watchers = getattr(getattr(self.backend, 'dirty', None), 'watchers', ())
+        return sum(watcher.overhead_bytes() for watcher in watchers)
+
+    def clear(self):
+        """Remove every element"""
+        if hasattr(self.backend, 'clear_all'):
+            self.backend.clear_all()
+            return
+        num_chars = (self.num_bits_m + 7) // 8
+        zeros = bytes(MERGE_BLOCK_BYTES)
+        for byteno in range(0, num_chars, MERGE_BLOCK_BYTES):
+            self.backend.write_block(byteno, zeros[:min(MERGE_BLOCK_BYTES, num_chars - byteno)])
+
+    def __eq__(self, bloom_filter):
+        if not isinstance(bloom_filter, BloomFilter):
+            return NotImplemented
+        if not self._match_template(bloom_filter):
+            return False
+        if isinstance(self.backend, Array_backend) and isinstance(bloom_filter.backend, Array_backend):
+            return self.backend == bloom_filter.backend
+        return all(ours == theirs for dummy, ours, theirs in self._blocks(bloom_filter))
+
+    def __ne__(self, bloom_filter):
+        result = self.__eq__(bloom_filter)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    # We're mutable, so we mustn't be hashable; freeze() us if you need that
+    __hash__ = None
+
+    def issubset(self, bloom_filter):
+        """Return true iff every bit we have set is also set in bloom_filter"""
+        self._check_template(bloom_filter)
+        if isinstance(self.backend, Array_backend) and isinstance(bloom_filter.backend, Array_backend):
+            return self.backend.issubset(bloom_filter.backend)
+        return all(ours | theirs == theirs for dummy, ours, theirs in self._blocks(bloom_filter))
+
+    def issuperset(self, bloom_filter):
+        """Return true iff every bit set in bloom_filter is also set in us"""
+        return bloom_filter.issubset(self)
+
+    def __le__(self, bloom_filter):
+        return self.issubset(bloom_filter)
+
+    def __ge__(self, bloom_filter):
+        return self.issuperset(bloom_filter)
+
+    def symmetric_difference_update(self, bloom_filter):
+        """
+        Keep just the bits set in exactly one of us and bloom_filter.  This isn't a bloom filter of anything in
+        particular any more, but it's empty iff the two filters were equal, and it shows where they differ.
+        """
+        self._check_template(bloom_filter)
+        if self._same_backend_type(bloom_filter) or \
+                (isinstance(self.backend, Sparse_array_backend) and isinstance(bloom_filter.backend, Array_backend)):
+            self.backend ^= bloom_filter.backend
+        else:
+            self.backend.combine_blockwise(bloom_filter.backend, lambda left, right: left ^ right)
+
+    def __ixor__(self, bloom_filter):
+        self.symmetric_difference_update(bloom_filter)
+        return self
+
+    def symmetric_difference(self, bloom_filter):
+        """Return a new filter with the bits set in exactly one of us and bloom_filter"""
+        result = self.copy()
+        result.symmetric_difference_update(bloom_filter)
+        return result
+
+    def __xor__(self, bloom_filter):
+        return self.symmetric_difference(bloom_filter)
+
+    def __or__(self, bloom_filter):
+        self._check_template(bloom_filter)
+        result = self.copy()
+        result.union(bloom_filter)
+        return result
+
+    def __and__(self, bloom_filter):
+        self._check_template(bloom_filter)
+        result = self.copy()
+        result.intersection(bloom_filter)
+        return result
+
+    def popcount(self):
+        """Return the number of bits set; zero iff the filter is empty"""
+        num_chars = (self.num_bits_m + 7) // 8
+        return sum(
+            popcount_bytes(self.backend.read_block(byteno, min(MERGE_BLOCK_BYTES, num_chars - byteno)))
+            for byteno in range(0, num_chars, MERGE_BLOCK_BYTES)
+        )
+
+    @classmethod
+    def _combine_all(cls, filters, operator, block_bytes, filename, backend):
+        """
+        Combine many same-template filters into a new one, a block at a time: each block of the result is computed
+        from the corresponding block of every input while it's hot in cache, and only one block of each input is
+        ever in memory, so file- and mmap-backed inputs are streamed.
+        """
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        filters = list(filters)
+        if not filters:
+            raise ValueError('Need at least one filter')
+        first = filters[0]
+        for bloom_filter in filters[1:]:
+            if not first._match_template(bloom_filter):
+                raise ValueError('Filters must have the same num_bits_m, num_probes_k and probe_bitnoer')
+        # Keep blocks aligned to Array_backend's 64 bit words
+        block_bytes = max(WORD_BYTES, block_bytes - block_bytes % WORD_BYTES)
+
+        result = cls._from_layout(
+            first.ideal_num_elements_n,
+            first.error_rate_p,
+            first.num_bits_m,
+            first.num_probes_k,
+            probe_bitnoer=first.probe_bitnoer,
+            filename=filename,
+            start_fresh=True,
+            backend=backend,
+        )
+        num_chars = (first.num_bits_m + 7) // 8
+        for byteno in range(0, num_chars, block_bytes):
+            length = min(block_bytes, num_chars - byteno)
+            value = int.from_bytes(first.backend.read_block(byteno, length), 'little')
+            for bloom_filter in filters[1:]:
+                value = operator(value, int.from_bytes(bloom_filter.backend.read_block(byteno, length), 'little'))
+            result.backend.write_block(byteno, value.to_bytes(length, 'little'))
+        return result
+
+    @classmethod
+    def union_all(cls, filters, block_bytes=MERGE_BLOCK_BYTES, filename=None, backend=None):
+        """Return a new filter holding the set union of many filters, computed in one blocked pass"""
+        return cls._combine_all(filters, lambda left, right: left | right, block_bytes, filename, backend)
+
+    @classmethod
+    def intersection_all(cls, filters, block_bytes=MERGE_BLOCK_BYTES, filename=None, backend=None):
+        """Return a new filter holding the set intersection of many filters, computed in one blocked pass"""
+        return cls._combine_all(filters, lambda left, right: left & right, block_bytes, filename, backend)
+
     def __contains__(self, key):
         for bitno in self.probe_bitnoer(self, key):
             if not self.backend.is_set(bitno):
                 return False
         return True
+
+    def add_many(self, keys):
+        """Add many elements; the file backends write all their bits in one sorted, coalesced pass"""
+        bitnos = [bitno for key in keys for bitno in self.probe_bitnoer(self, key)]
+        self.backend.set_many(bitnos)
+
+    def add_if_absent(self, key):
+        """
+        Add key, computing its probes once and looking at each probe bit once; return true iff it wasn't already
+        (probably) in the filter.  This is not atomic across threads: DurableBloomFilter's and TieredBloomFilter's are.
+        """
+        return self.backend.test_and_set(list(self.probe_bitnoer(self, key)))
+
+    def add_if_absent_many(self, keys):
+        """
+        add_if_absent() each of keys in turn, returning a list of bools; a key repeated within keys is only absent the
+        first time.  The file backends read every probe of the batch in one sorted, coalesced pass.
+        """
+        return self.backend.test_and_set_many([list(self.probe_bitnoer(self, key)) for key in keys])
+
+    def contains_many(self, keys, fadvise=False):
+        """
+        Return a list of bools saying, for each of keys, whether it is (probably) in the filter.  The file backends
+        read every probe of the batch in one sorted, coalesced pass; fadvise tells the kernel about it up front.
+        """
+        probes = [list(self.probe_bitnoer(self, key)) for key in keys]
+        bitnos = [bitno for key_probes in probes for bitno in key_probes]
+        results = self.backend.is_set_many(bitnos, fadvise=fadvise)
+        answers = []
+        offset = 0
+        for key_probes in probes:
+            answers.append(all(results[offset:offset + len(key_probes)]))
+            offset += len(key_probes)
+        return answers
+
+    def filter_iter(self, iterable, key=None, batch_rows=pipeline_mod.DEFAULT_BATCH_ROWS, workers=0, stats=None):
+        """
+        Generate the items of iterable whose key(item), or the item itself, is probably in the filter, testing
+        batch_rows of them at a time.  See pipeline.py for workers and stats.
+        """
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        return pipeline_mod.filter_iter(self, iterable, key, batch_rows, workers, stats)
+
+    def partition_iter(self, iterable, key=None, batch_rows=pipeline_mod.DEFAULT_BATCH_ROWS, workers=0, stats=None):
+        """Generate (probably in the filter, item) for every item of iterable, testing batch_rows at a time"""
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        return pipeline_mod.partition_iter(self, iterable, key, batch_rows, workers, stats)
+
+    def filter_lines(self, path, key_extractor, batch_rows=pipeline_mod.DEFAULT_BATCH_ROWS, workers=0, stats=None,
+                     encoding='utf-8'):
+        """Generate the lines of the file at path whose key_extractor(line) is probably in the filter"""
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        return pipeline_mod.filter_lines(self, path, key_extractor, batch_rows, workers, stats, encoding)
+
+    def add_array(self, column):
+        """
+        Add every element of a numpy array or Arrow array/chunked array.  With probe_bitnoer=get_bitno_fnv64,
+        integer, string and binary columns are hashed and set without making a python object per element.
+        """
+        from . import columnar as columnar_mod
+        columnar_mod.add_array(self, column)
+
+    def contains_array(self, column):
+        """Return a numpy array of bools saying, for each element of column, whether it is (probably) in the filter"""
+        from . import columnar as columnar_mod
+        return columnar_mod.contains_array(self, column)
+
+    def _template(self):
+        """Return the parameters that determine our layout, as recorded in checkpoint headers"""
+        return {
+            'num_bits_m': self.num_bits_m,
+            'ideal_num_elements_n': self.ideal_num_elements_n,
+            'error_rate_p': self.error_rate_p,
+            'num_probes_k': self.num_probes_k,
+        }
+
+    def checkpoint(self, path, dirty=None):
+        """
+        Write our bits to path, crash-safely.  After the first checkpoint to a path, only the pages that changed since
+        are written.  Only the in-memory backends support this.  Returns the number of pages written.  Pass dirty,
+        from an earlier backend.dirty.take(), to write the pages that had changed by then.
+        """
+        if not hasattr(self.backend, 'page_tobytes'):
+            raise ValueError('%s does not support checkpoints' % type(self.backend).__name__)
+        return checkpoint_mod.write_checkpoint(self.backend, path, self._template(), dirty)
+
+    def export_delta(self, stream, since_version=0):
+        """
+        Write the pages changed since since_version to the binary stream, for a replica's apply_delta().  Returns the
+        version to pass as since_version next time.  Only the in-memory backends support this.
+        """
+        if not hasattr(self.backend, 'dirty') or not hasattr(self.backend, 'page_tobytes'):
+            raise ValueError('%s does not support delta export' % type(self.backend).__name__)
+        return delta_mod.write_delta(self.backend, stream, self._template(), since_version,
+                                     Snapshot_backend(self.backend))
+
+    def apply_delta(self, stream):
+        """OR a delta read from the binary stream into our bits; returns the version it brings us up to"""
+        return delta_mod.apply_delta(self.backend, stream, self._template())
+
+    @classmethod
+    def from_checkpoint(cls, path, probe_bitnoer=get_filter_bitno_probes, backend=None):
+        """Load a filter from a checkpoint; further checkpoints to the same path will be incremental"""
+        generation, template, bits = checkpoint_mod.read_checkpoint(path)
+        bloom_filter = cls._from_layout(
+            template['ideal_num_elements_n'],
+            template['error_rate_p'],
+            template['num_bits_m'],
+            template['num_probes_k'],
+            probe_bitnoer=probe_bitnoer,
+            backend=backend,
+        )
+        bloom_filter.backend.frombytes(bits)
+        bloom_filter.backend.dirty.reset()
+        bloom_filter.backend.checkpoint_state = (os.path.abspath(path), generation)
+        return bloom_filter
+
+    def freeze(self):
+        """Return an immutable FrozenBloomFilter holding a copy of our current contents"""
+        return FrozenBloomFilter(self, self.backend.tobytes())
+
+
+class FrozenBloomFilter(object):
+    """
+    An immutable, query-only bloom filter over a read-only copy of the bits of a BloomFilter.
+    Membership tests index straight into the bytes with no backend dispatch, and since nothing can change,
+    one of these can be shared between threads without any locking.
+    """
+
+    __slots__ = ('ideal_num_elements_n', 'error_rate_p', 'num_bits_m', 'num_probes_k', 'probe_bitnoer',
+                 'bits', '_digest')
+
+    def __init__(self, bloom_filter, bits):
+        if len(bits) != (bloom_filter.num_bits_m + 7) // 8:
+            raise ValueError('bits has the wrong length for this filter')
+        setter = object.__setattr__
+        setter(self, 'ideal_num_elements_n', bloom_filter.ideal_num_elements_n)
+        setter(self, 'error_rate_p', bloom_filter.error_rate_p)
+        setter(self, 'num_bits_m', bloom_filter.num_bits_m)
+        setter(self, 'num_probes_k', bloom_filter.num_probes_k)
+        setter(self, 'probe_bitnoer', bloom_filter.probe_bitnoer)
+        setter(self, 'bits', memoryview(bytes(bits)).toreadonly())
+        digest = hashlib.sha256(struct.pack('<QQ', self.num_bits_m, self.num_probes_k))
+        digest.update(self.bits)
+        setter(self, '_digest', digest.digest())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenBloomFilter is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('FrozenBloomFilter is immutable')
+
+    def __repr__(self):
+        return 'FrozenBloomFilter(ideal_num_elements_n=%d, error_rate_p=%f, num_bits_m=%d)' % (
+            self.ideal_num_elements_n,
+            self.error_rate_p,
+            self.num_bits_m,
+        )
+
+    def __contains__(self, key):
+        bits = self.bits
+        for bitno in self.probe_bitnoer(self, key):
+            if not bits[bitno >> 3] & (1 << (bitno & 7)):
+                return False
+        return True
+
+    def _match_template(self, bloom_filter):
+        """Compare a sort of signature for two bloom filters.  Used in preparation for binary operations"""
+        return (self.num_bits_m == bloom_filter.num_bits_m
+                and self.num_probes_k == bloom_filter.num_probes_k
+                and self.probe_bitnoer == bloom_filter.probe_bitnoer)
+
+    def digest(self):
+        """Return a sha256 digest of our template and contents"""
+        return self._digest
+
+    def tobytes(self):
+        """Return the bit array as bytes, bit 0 being the low bit of byte 0"""
+        return self.bits.tobytes()
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenBloomFilter):
+            return NotImplemented
+        return self._digest == other._digest and self._match_template(other) and self.bits == other.bits
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._digest)
+
+    def __reduce_ex__(self, protocol):
+        template = (self.ideal_num_elements_n, self.error_rate_p, self.num_bits_m, self.num_probes_k,
+                    self.probe_bitnoer)
+        return unpickle_frozen_bloom_filter, (template, pickle.PickleBuffer(self.bits) if protocol >= 5 else
+                                              self.bits.tobytes())
+
+
+def unpickle_frozen_bloom_filter(template, bits):
+    """Rebuild a pickled FrozenBloomFilter"""
+    bloom_filter = BloomFilter.__new__(BloomFilter)
+    (bloom_filter.ideal_num_elements_n, bloom_filter.error_rate_p, bloom_filter.num_bits_m, bloom_filter.num_probes_k,
+     bloom_filter.probe_bitnoer) = template
+    return FrozenBloomFilter(bloom_filter, memoryview(bits).cast('B'))
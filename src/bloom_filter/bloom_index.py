@@ -0,0 +1,204 @@
+# coding=utf-8
+
+"""Bit-sliced signature index: ask which of many same-template bloom filters may contain a key, in k row reads"""
+
+# Picture the filters as the columns of a matrix, one column per filter and one row per bit number.  A BloomFilter
+# stores a column contiguously; we store the rows contiguously instead.  Row b has one bit per filter, set iff that
+# filter has bit b set.  A key's num_probes_k probe bit numbers then name num_probes_k rows, and ANDing those rows
+# gives the bitmap of filters that may contain the key - whether there are ten filters or ten thousand.
+#
+# The rows live in a bytearray, or in an mmap of filename.  The filter names and the template live in a small JSON
+# sidecar, filename + '.meta', which is replaced atomically after every add_filter().
+
+import os
+import json
+import math
+
+try:
+    import mmap as mmap_mod
+except ImportError:
+    # Jython lacks mmap()
+    HAVE_MMAP = False
+else:
+    HAVE_MMAP = True
+
+from .bloom_filter import get_filter_bitno_probes
+
+INDEX_MAGIC = 'bloom-index-1'
+
+
+class BloomIndex(object):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    An index over up to capacity BloomFilters that share one template (num_bits_m, num_probes_k, probe_bitnoer).
+    The template is given the same way as for BloomFilter.  With a filename, the index is persisted there via mmap,
+    and reopened if it already exists and start_fresh is false.
+    """
+
+    def __init__(self,
+                 max_elements=10000,
+                 error_rate=0.1,
+                 capacity=1024,
+                 probe_bitnoer=get_filter_bitno_probes,
+                 filename=None,
+                 start_fresh=False):
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        if capacity <= 0:
+            raise ValueError('capacity must be > 0')
+        self.probe_bitnoer = probe_bitnoer
+        self.filename = filename
+        self.names = []
+
+        if filename is not None and not start_fresh and os.path.exists(filename):
+            self._load_meta()
+        else:
+            if max_elements <= 0:
+                raise ValueError('ideal_num_elements_n must be > 0')
+            if not (0 < error_rate < 1):
+                raise ValueError('error_rate_p must be between 0 and 1 exclusive')
+            # The same sizing BloomFilter.__init__ does, so that default-sized filters fit
+            self.ideal_num_elements_n = max_elements
+            self.error_rate_p = error_rate
+            self.num_bits_m = int(math.ceil(-1 * max_elements * math.log(error_rate) / math.log(2) ** 2))
+            self.num_probes_k = int(math.ceil((self.num_bits_m / max_elements) * math.log(2)))
+            self.capacity = capacity
+
+        self.row_bytes = (self.capacity + 7) // 8
+        self.rows, self._file = self._open_rows(filename is not None and (start_fresh or not os.path.exists(filename)))
+        if filename is not None and not os.path.exists(self._meta_path()):
+            self._save_meta()
+
+    def _meta_path(self):
+        """Return the path of our metadata sidecar"""
+        return '%s.meta' % self.filename
+
+    def _load_meta(self):
+        """Read the template, capacity and filter names of an existing index"""
+        with open(self._meta_path(), 'r') as file_:
+            meta = json.load(file_)
+        if meta.get('magic') != INDEX_MAGIC:
+            raise ValueError('%s is not a bloom filter index' % self.filename)
+        self.ideal_num_elements_n = meta['ideal_num_elements_n']
+        self.error_rate_p = meta['error_rate_p']
+        self.num_bits_m = meta['num_bits_m']
+        self.num_probes_k = meta['num_probes_k']
+        self.capacity = meta['capacity']
+        self.names = meta['names']
+
+    def _save_meta(self):
+        """Atomically replace our metadata sidecar"""
+        meta = {
+            'magic': INDEX_MAGIC,
+            'ideal_num_elements_n': self.ideal_num_elements_n,
+            'error_rate_p': self.error_rate_p,
+            'num_bits_m': self.num_bits_m,
+            'num_probes_k': self.num_probes_k,
+            'capacity': self.capacity,
+            'names': self.names,
+        }
+        temp_path = '%s.tmp' % self._meta_path()
+        with open(temp_path, 'w') as file_:
+            json.dump(meta, file_)
+            file_.flush()
+            os.fsync(file_.fileno())
+        os.replace(temp_path, self._meta_path())
+
+    def _open_rows(self, fresh):
+        """Return (rows, file descriptor or None): a bytearray, or an mmap of filename"""
+        size = self.num_bits_m * self.row_bytes
+        if self.filename is None:
+            return bytearray(size), None
+        if not HAVE_MMAP:
+            raise ValueError('Persisting a BloomIndex needs mmap')
+        flags = os.O_RDWR | os.O_CREAT
+        if fresh:
+            flags |= os.O_TRUNC
+            if os.path.exists(self._meta_path()):
+                os.unlink(self._meta_path())
+        file_ = os.open(self.filename, flags, 0o666)
+        if os.fstat(file_).st_size != size:
+            # Never-written rows read back as zeros, and on most filesystems don't take up space either
+            os.ftruncate(file_, size)
+        return mmap_mod.mmap(file_, size), file_
+
+    def _match_template(self, bloom_filter):
+        """Check that bloom_filter has the same layout as the filters we index"""
+        return (self.num_bits_m == bloom_filter.num_bits_m
+                and self.num_probes_k == bloom_filter.num_probes_k
+                and self.probe_bitnoer == bloom_filter.probe_bitnoer)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_filter(self, name, bloom_filter):
+        """Add bloom_filter to the index under name; returns its column number"""
+        if not self._match_template(bloom_filter):
+            raise ValueError('Filter does not match the index template')
+        if len(self.names) >= self.capacity:
+            raise ValueError('Index is full: capacity is %d filters' % self.capacity)
+
+        column = len(self.names)
+        column_byteno, column_bitno = divmod(column, 8)
+        column_mask = 1 << column_bitno
+        rows = self.rows
+        row_bytes = self.row_bytes
+
+        bits = bloom_filter.backend.tobytes()
+        block_bytes = 2 ** 12
+        for block_start in range(0, len(bits), block_bytes):
+            block = bits[block_start:block_start + block_bytes]
+            if not any(block):
+                continue
+            for byteno, byte in enumerate(block, block_start):
+                while byte:
+                    lowest = byte & -byte
+                    bitno = byteno * 8 + lowest.bit_length() - 1
+                    rows[bitno * row_bytes + column_byteno] |= column_mask
+                    byte ^= lowest
+
+        self.names.append(name)
+        if self.filename is not None:
+            self.rows.flush()
+            self._save_meta()
+        return column
+
+    def query_bitmap(self, key):
+        """Return an int with bit i set iff the filter in column i may contain key"""
+        rows = self.rows
+        row_bytes = self.row_bytes
+        result = None
+        for bitno in self.probe_bitnoer(self, key):
+            row = int.from_bytes(rows[bitno * row_bytes:(bitno + 1) * row_bytes], 'little')
+            result = row if result is None else result & row
+            if not result:
+                return 0
+        return result
+
+    def _names_for_bitmap(self, bitmap):
+        """Return the names of the filters whose bits are set in bitmap"""
+        names = []
+        while bitmap:
+            lowest = bitmap & -bitmap
+            column = lowest.bit_length() - 1
+            if column < len(self.names):
+                names.append(self.names[column])
+            bitmap ^= lowest
+        return names
+
+    def query(self, key):
+        """Return the names of the filters that may contain key"""
+        return self._names_for_bitmap(self.query_bitmap(key))
+
+    def query_many(self, keys):
+        """Return, for each key, the names of the filters that may contain it"""
+        return [self._names_for_bitmap(self.query_bitmap(key)) for key in keys]
+
+    def close(self):
+        """Flush and release the mmap, if any"""
+        if self._file is not None:
+            self.rows.flush()
+            self.rows.close()
+            os.close(self._file)
+            self._file = None
@@ -0,0 +1,214 @@
+# coding=utf-8
+
+"""Incremental, crash-safe checkpoints of the in-memory bloom filter backends"""
+
+# A checkpoint file is a HEADER_BYTES header followed by the filter's bits, in the layout backend.tobytes() uses.
+#
+# The header holds two slots.  Each slot describes one generation of the checkpoint and carries its own crc32, and
+# the slot with the highest valid generation wins.  A checkpoint writes its pages first, fsyncs, and only then
+# writes the slot for the next generation into whichever slot does not hold the current one, and fsyncs again.  A
+# crash before the slot write leaves the previous slot in charge; a torn slot write fails its crc and is ignored.
+#
+# Writing pages in place before the header is only safe because, between checkpoints, bits are normally only ever
+# set: a page that is half old and half new is then still a superset of what the previous generation promised.
+# Backends note whenever a bit is cleared, and then we instead write a whole new file and rename it into place.
+
+import os
+import zlib
+import struct
+
+MAGIC = b'BLOOMCK1'
+HEADER_BYTES = 2 ** 12
+SLOT_BYTES = 64
+
+# magic, generation, num_bits_m, ideal_num_elements_n, error_rate_p, num_probes_k
+_SLOT = struct.Struct('<8sQQQdI')
+_CRC = struct.Struct('<I')
+
+WRITE_BLOCK_BYTES = 2 ** 20
+
+
+class CheckpointError(Exception):
+    """Raised when a checkpoint file is missing, corrupt, or doesn't match the filter"""
+    pass
+
+
+def page_runs(pagenos):
+    """Coalesce ascending page numbers into (first_pageno, last_pageno + 1) runs of consecutive pages"""
+    first_pageno = previous_pageno = None
+    for pageno in pagenos:
+        if previous_pageno is not None and pageno == previous_pageno + 1:
+            previous_pageno = pageno
+            continue
+        if first_pageno is not None:
+            yield first_pageno, previous_pageno + 1
+        first_pageno = previous_pageno = pageno
+    if first_pageno is not None:
+        yield first_pageno, previous_pageno + 1
+
+
+def _pack_slot(generation, template):
+    """Build a header slot for generation of a filter with the given template"""
+    slot = _SLOT.pack(
+        MAGIC,
+        generation,
+        template['num_bits_m'],
+        template['ideal_num_elements_n'],
+        template['error_rate_p'],
+        template['num_probes_k'],
+    )
+    slot += _CRC.pack(zlib.crc32(slot) & 0xffffffff)
+    return slot + bytes(SLOT_BYTES - len(slot))
+
+
+def _unpack_slot(slot):
+    """Return the (generation, template) a header slot describes, or None if it isn't a valid slot"""
+    body = slot[:_SLOT.size]
+    (crc,) = _CRC.unpack_from(slot, _SLOT.size)
+    if zlib.crc32(body) & 0xffffffff != crc:
+        return None
+    magic, generation, num_bits_m, ideal_num_elements_n, error_rate_p, num_probes_k = _SLOT.unpack(body)
+    if magic != MAGIC:
+        return None
+    return generation, {
+        'num_bits_m': num_bits_m,
+        'ideal_num_elements_n': ideal_num_elements_n,
+        'error_rate_p': error_rate_p,
+        'num_probes_k': num_probes_k,
+    }
+
+
+def _read_header(file_):
+    """Return (generation, template) for the newest valid slot of an open checkpoint file"""
+    header = os.pread(file_, 2 * SLOT_BYTES, 0)
+    if len(header) != 2 * SLOT_BYTES:
+        raise CheckpointError('checkpoint header is truncated')
+    slots = [_unpack_slot(header[slotno * SLOT_BYTES:(slotno + 1) * SLOT_BYTES]) for slotno in range(2)]
+    slots = [slot for slot in slots if slot is not None]
+    if not slots:
+        raise CheckpointError('checkpoint header has no valid slot')
+    return max(slots, key=lambda slot: slot[0])
+
+
+def _commit(file_, generation, template):
+    """Make generation the current one: write its header slot, then fsync"""
+    os.pwrite(file_, _pack_slot(generation, template), (generation % 2) * SLOT_BYTES)
+    os.fsync(file_)
+
+
+def fsync_directory(path):
+    """fsync the directory holding path, so a rename into it is durable"""
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        # Some platforms and filesystems won't fsync a directory
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def _write_pages(file_, backend, pagenos):
+    """pwrite the given pages of backend, coalescing runs of adjacent pages into large writes"""
+    pages_per_write = max(1, WRITE_BLOCK_BYTES // backend.page_bytes)
+    for first_pageno, last_pageno in page_runs(pagenos):
+        for block_first_pageno in range(first_pageno, last_pageno, pages_per_write):
+            block_last_pageno = min(block_first_pageno + pages_per_write, last_pageno)
+            block = b''.join(backend.page_tobytes(pageno) for pageno in range(block_first_pageno, block_last_pageno))
+            os.pwrite(file_, block, HEADER_BYTES + block_first_pageno * backend.page_bytes)
+
+
+def _write_full(backend, path, generation, template):
+    """Write a complete checkpoint to a temporary file, then atomically rename it over path"""
+    temp_path = '%s.tmp' % path
+    file_ = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        # Never-written regions of the file read back as zeros, so all-zero pages needn't be written at all
+        os.ftruncate(file_, HEADER_BYTES + backend.num_chars)
+        nonzero_pagenos = (pageno for pageno in range(backend.num_pages) if any(backend.page_tobytes(pageno)))
+        _write_pages(file_, backend, nonzero_pagenos)
+        os.fsync(file_)
+        _commit(file_, generation, template)
+    finally:
+        os.close(file_)
+    os.replace(temp_path, path)
+    fsync_directory(path)
+
+
+def _write_incremental(backend, dirty, path, generation, template):
+    """Write just the dirty pages in place, then commit a new header slot"""
+    file_ = os.open(path, os.O_RDWR)
+    try:
+        _write_pages(file_, backend, dirty)
+        os.fsync(file_)
+        _commit(file_, generation, template)
+    finally:
+        os.close(file_)
+
+
+def _current_generation(path, template):
+    """Return the committed generation of the checkpoint at path, or None if it isn't a checkpoint of template"""
+    try:
+        file_ = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        generation, file_template = _read_header(file_)
+    except CheckpointError:
+        return None
+    finally:
+        os.close(file_)
+    if file_template != template:
+        return None
+    return generation
+
+
+def write_checkpoint(backend, path, template, dirty=None):
+    """
+    Checkpoint an in-memory backend to path.  If path holds the checkpoint this backend last wrote, and no bits have
+    been cleared since, only the pages changed since then are written.  Returns the number of pages written.
+    dirty, if given, is what backend.dirty.take() returned earlier, for a checkpoint of the changes up to then.
+    """
+    path = os.path.abspath(path)
+    last_path, last_generation = getattr(backend, 'checkpoint_state', (None, None))
+    generation = _current_generation(path, template)
+    # Take the dirty pages before writing any, so a page changed while we write is still dirty next time
+    if dirty is None:
+        dirty = backend.dirty.take()
+    try:
+        if path == last_path and generation == last_generation and dirty.monotone:
+            pages_written = len(dirty)
+            _write_incremental(backend, dirty, path, generation + 1, template)
+        else:
+            pages_written = backend.num_pages
+            _write_full(backend, path, (generation or 0) + 1, template)
+    except BaseException:
+        backend.dirty.put_back(dirty)
+        raise
+    backend.checkpoint_state = (path, (generation or 0) + 1)
+    return pages_written
+
+
+def read_checkpoint(path):
+    """Return (generation, template, bits) from the checkpoint at path"""
+    try:
+        file_ = os.open(path, os.O_RDONLY)
+    except OSError as exc:
+        raise CheckpointError('cannot open checkpoint %s: %s' % (path, exc))
+    try:
+        generation, template = _read_header(file_)
+        num_chars = (template['num_bits_m'] + 7) // 8
+        blocks = []
+        offset = 0
+        while offset < num_chars:
+            block = os.pread(file_, min(WRITE_BLOCK_BYTES, num_chars - offset), HEADER_BYTES + offset)
+            if not block:
+                raise CheckpointError('checkpoint %s is truncated' % path)
+            blocks.append(block)
+            offset += len(block)
+    finally:
+        os.close(file_)
+    return generation, template, b''.join(blocks)
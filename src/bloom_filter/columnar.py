@@ -0,0 +1,227 @@
+# coding=utf-8
+
+"""Add and look up whole numpy and Arrow columns of keys, hashing and probing them with vectorized numpy code"""
+
+# BloomFilter.add() makes a trip through the interpreter per key, and per probe.  For a filter whose probe_bitnoer
+# is get_bitno_fnv64, add_array and contains_array do the same work a batch of rows at a time: integer columns are
+# hashed by mixing their values, string and binary columns by running FNV-1a over every row at once, one byte
+# position at a time, straight from the Arrow offsets and data buffers.  The probes of the whole batch are then set or
+# tested in one numpy operation on the backend's buffer.  Every step gives exactly the bits get_bitno_fnv64 would,
+# so keys added one way can be looked up the other.
+#
+# The array and mmap backends, and the in-memory part of the hybrid backend, are updated in place through numpy
+# views of their buffers; the other backends get the batch's bit numbers through set_many and is_set_many.  Other
+# probe_bitnoers, and columns of other types, still work, but each element becomes a python object first.
+#
+# Nulls in Arrow columns are never added, and are never found.
+
+try:
+    import numpy
+except ImportError:
+    HAVE_NUMPY = False
+else:
+    HAVE_NUMPY = True
+
+try:
+    import pyarrow
+except ImportError:
+    HAVE_ARROW = False
+else:
+    HAVE_ARROW = True
+
+from . import bloom_filter as bloom_filter_mod
+from .bloom_filter import (
+    Array_backend,
+    Array_then_file_seek_backend,
+    get_bitno_fnv64,
+    FNV64_OFFSET,
+    FNV64_PRIME,
+    GOLDEN64,
+)
+
+# Rows hashed and probed at a time, which bounds our temporary arrays to a few hundred megabytes
+BATCH_ROWS = 2 ** 20
+
+
+def _mix64(values):
+    """The splitmix64 finalizer, as bloom_filter.mix64, for a numpy array of uint64"""
+    values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(0x94d049bb133111eb)
+    return values ^ (values >> numpy.uint64(31))
+
+
+def _int_hashes(values):
+    """Return the 64 bit hashes of a numpy array of integers: their low 64 bits, mixed"""
+    if values.dtype.kind == 'i':
+        return _mix64(values.astype(numpy.int64).view(numpy.uint64))
+    return _mix64(values.astype(numpy.uint64))
+
+
+def _binary_hashes(offsets, data):
+    """Return the 64 bit hashes of the rows of a variable-width binary column: the FNV-1a of each row, mixed"""
+    starts = offsets[:-1].astype(numpy.int64)
+    lengths = offsets[1:].astype(numpy.int64) - starts
+    # With the rows longest first, the rows that still have a byte at any given position are a prefix
+    order = numpy.argsort(-lengths, kind='stable')
+    starts = starts[order]
+    descending_lengths = lengths[order]
+    hashes = numpy.full(len(starts), FNV64_OFFSET, dtype=numpy.uint64)
+    prime = numpy.uint64(FNV64_PRIME)
+    max_length = int(descending_lengths[0]) if len(descending_lengths) else 0
+    for position in range(max_length):
+        num_rows = int(numpy.searchsorted(-descending_lengths, -position, side='left'))
+        hashes[:num_rows] = (hashes[:num_rows] ^ data[starts[:num_rows] + position]) * prime
+    result = numpy.empty_like(hashes)
+    result[order] = hashes
+    return _mix64(result)
+
+
+def _is_arrow(column):
+    """Return true iff column is an Arrow array or chunked array"""
+    return HAVE_ARROW and isinstance(column, (pyarrow.Array, pyarrow.ChunkedArray))
+
+
+def _is_large_binary(type_):
+    """Return true iff an Arrow type is a string or binary type with 64 bit offsets"""
+    return pyarrow.types.is_large_string(type_) or pyarrow.types.is_large_binary(type_)
+
+
+def _vectorizable(column):
+    """Return true iff we can hash column without making python objects of its elements"""
+    if isinstance(column, numpy.ndarray):
+        return column.ndim == 1 and column.dtype.kind in 'iub'
+    if _is_arrow(column):
+        type_ = column.type
+        return (pyarrow.types.is_integer(type_) or pyarrow.types.is_string(type_) or
+                pyarrow.types.is_binary(type_) or _is_large_binary(type_))
+    return False
+
+
+def _arrow_hashes(chunk):
+    """Return the hashes of an Arrow array, and a numpy array saying which rows aren't null (None if all)"""
+    valid = chunk.is_valid().to_numpy(zero_copy_only=False) if chunk.null_count else None
+    if pyarrow.types.is_integer(chunk.type):
+        return _int_hashes(chunk.fill_null(0).to_numpy()), valid
+    offsets_dtype = numpy.int64 if _is_large_binary(chunk.type) else numpy.int32
+    dummy, offsets_buffer, data_buffer = chunk.buffers()
+    offsets = numpy.frombuffer(offsets_buffer, dtype=offsets_dtype)[chunk.offset:chunk.offset + len(chunk) + 1]
+    if data_buffer is None:
+        data = numpy.zeros(0, dtype=numpy.uint8)
+    else:
+        data = numpy.frombuffer(data_buffer, dtype=numpy.uint8)
+    return _binary_hashes(offsets, data), valid
+
+
+def _hash_batches(column):
+    """Generate (hashes, valid rows or None) for column, BATCH_ROWS rows at a time"""
+    chunks = column.chunks if HAVE_ARROW and isinstance(column, pyarrow.ChunkedArray) else [column]
+    for chunk in chunks:
+        for start in range(0, len(chunk), BATCH_ROWS):
+            if isinstance(chunk, numpy.ndarray):
+                yield _int_hashes(chunk[start:start + BATCH_ROWS]), None
+            else:
+                yield _arrow_hashes(chunk.slice(start, BATCH_ROWS))
+
+
+def _probes(bloom_filter, hashes):
+    """Return a len(hashes) x num_probes_k array of the bit numbers get_bitno_fnv64 gives for each hash"""
+    hashes2 = _mix64(hashes ^ numpy.uint64(GOLDEN64)) | numpy.uint64(1)
+    probenos = numpy.arange(bloom_filter.num_probes_k, dtype=numpy.uint64)
+    probes = (hashes[:, None] + probenos[None, :] * hashes2[:, None]) % numpy.uint64(bloom_filter.num_bits_m)
+    return probes.astype(numpy.int64)
+
+
+def _bit_view(backend):
+    """
+    Return (numpy view of backend's in-memory bits, bits per element, bits the view covers, elements per dirty page
+    or None), or None if backend doesn't keep its bits in one buffer
+    """
+    if isinstance(backend, Array_backend):
+        return numpy.frombuffer(backend.array_, dtype=numpy.uint64), 64, backend.num_bits, backend.words_per_page
+    if bloom_filter_mod.HAVE_MMAP and isinstance(backend, bloom_filter_mod.Mmap_backend):
+        return numpy.frombuffer(backend.mmap, dtype=numpy.uint8), 8, backend.num_bits, None
+    if isinstance(backend, Array_then_file_seek_backend):
+        return numpy.frombuffer(backend.array_, dtype=numpy.uint8), 8, backend.bits_in_memory, backend.page_bytes
+    return None
+
+
+def _set_bitnos(backend, bitnos):
+    """Set every one of a numpy array of bit numbers"""
+    view = _bit_view(backend)
+    if view is None:
+        backend.set_many(bitnos.tolist())
+        return
+    elements, element_bits, covered_bits, elements_per_page = view
+    in_view = bitnos < covered_bits
+    rest = bitnos[~in_view]
+    bitnos = bitnos[in_view]
+    indexes = bitnos // element_bits
+    if elements_per_page is not None:
+        for pageno in numpy.unique(indexes // elements_per_page).tolist():
+            backend.dirty.mark(pageno)
+    masks = numpy.left_shift(elements.dtype.type(1), (bitnos % element_bits).astype(elements.dtype))
+    numpy.bitwise_or.at(elements, indexes, masks)
+    if len(rest):
+        backend.set_many(rest.tolist())
+
+
+def _test_bitnos(backend, bitnos):
+    """Return a numpy array of bools saying which of a numpy array of bit numbers are set"""
+    view = _bit_view(backend)
+    if view is None:
+        return numpy.array(backend.is_set_many(bitnos.tolist()), dtype=bool)
+    elements, element_bits, covered_bits, dummy = view
+    in_view = bitnos < covered_bits
+    result = numpy.zeros(len(bitnos), dtype=bool)
+    viewed = bitnos[in_view]
+    shifts = (viewed % element_bits).astype(elements.dtype)
+    result[in_view] = (elements[viewed // element_bits] >> shifts) & 1
+    if not in_view.all():
+        result[~in_view] = numpy.array(backend.is_set_many(bitnos[~in_view].tolist()), dtype=bool)
+    return result
+
+
+def _python_values(column):
+    """Return the elements of column as a list of python objects, None for nulls"""
+    if _is_arrow(column):
+        return column.to_pylist()
+    if isinstance(column, numpy.ndarray):
+        return column.tolist()
+    return list(column)
+
+
+def _check_numpy():
+    """Raise ValueError unless numpy is available"""
+    if not HAVE_NUMPY:
+        raise ValueError('add_array and contains_array need numpy')
+
+
+def add_array(bloom_filter, column):
+    """Add every element of a numpy array or Arrow array/chunked array to bloom_filter"""
+    _check_numpy()
+    if bloom_filter.probe_bitnoer is not get_bitno_fnv64 or not _vectorizable(column):
+        bloom_filter.add_many(value for value in _python_values(column) if value is not None)
+        return
+    for hashes, valid in _hash_batches(column):
+        if valid is not None:
+            hashes = hashes[valid]
+        _set_bitnos(bloom_filter.backend, _probes(bloom_filter, hashes).ravel())
+
+
+def contains_array(bloom_filter, column):
+    """Return a numpy array of bools saying, for each element of column, whether it is (probably) in bloom_filter"""
+    _check_numpy()
+    if bloom_filter.probe_bitnoer is not get_bitno_fnv64 or not _vectorizable(column):
+        values = _python_values(column)
+        present = [index for index, value in enumerate(values) if value is not None]
+        result = numpy.zeros(len(values), dtype=bool)
+        result[present] = bloom_filter.contains_many([values[index] for index in present])
+        return result
+    results = [numpy.zeros(0, dtype=bool)]
+    for hashes, valid in _hash_batches(column):
+        probes = _probes(bloom_filter, hashes)
+        found = _test_bitnos(bloom_filter.backend, probes.ravel()).reshape(probes.shape).all(axis=1)
+        if valid is not None:
+            found &= valid
+        results.append(found)
+    return numpy.concatenate(results)
@@ -0,0 +1,341 @@
+# coding=utf-8
+
+"""Count-Min sketches: approximate per-key frequencies of a stream, hashed the same way as our bloom filters"""
+
+# A sketch is depth rows of width counters.  Adding a key bumps one counter per row, chosen by the same probe
+# functions BloomFilter uses: the sketch passes itself to probe_bitnoer with num_probes_k = depth and
+# num_bits_m = width, so probe i picks the counter in row i.  A key's estimate is the smallest of its counters,
+# which is never below its true count, and, with probability 1 - failure_rate, no more than error_rate times the
+# total of all counts above it.
+#
+# With conservative updates, an add only raises each of the key's counters as far as its new estimate needs,
+# which gives much tighter estimates for skewed streams.  Merging by adding counters still never underestimates,
+# whether or not either sketch was conservative.
+#
+# The counters live in an array, in an mmap of filename, or in a named multiprocessing shared memory block.  The
+# latter two are COUNTER_HEADER followed by the counters as little-endian uint64s, row by row.
+#
+# Adding reads a counter, then writes it back, so two processes (or threads) adding to the same counters at once
+# can lose one of the adds, and then a key's estimate can fall below its true count.  Either have just one writer,
+# or give every writer the same lock - a multiprocessing.Lock for processes sharing a file or shared memory block.
+# Estimating needs no lock.
+#
+# Heavy hitters are kept per sketch object, in a dict of key to estimate plus a min-heap of (estimate, key) entries
+# so the smallest can be found without scanning them all.  A key's heap entry goes stale when its estimate grows;
+# stale entries are skipped when they reach the top, and the heap is rebuilt once they outnumber the live ones.
+
+import os
+import sys
+import math
+import heapq
+import array
+import struct
+import itertools
+import contextlib
+
+try:
+    import mmap as mmap_mod
+except ImportError:
+    # Jython lacks mmap()
+    HAVE_MMAP = False
+else:
+    HAVE_MMAP = True
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    HAVE_SHARED_MEMORY = False
+else:
+    HAVE_SHARED_MEMORY = True
+
+from .bloom_filter import get_filter_bitno_probes
+
+SKETCH_MAGIC = b'BLOOMCM1'
+COUNTER_HEADER = struct.Struct('<8sQQQ')
+HEADER_BYTES = 64
+
+
+class CountMinSketch(object):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    Estimate how often each key has been added, to within error_rate times the total count, with probability
+    1 - failure_rate.  Give filename to keep the counters in a file via mmap, or shared_memory_name to keep them
+    in a shared memory block other processes can attach to by name; either is reopened if it already exists and
+    start_fresh is false.  top_k > 0 tracks that many of the most frequent keys seen.  If more than one process or
+    thread adds to the same counters, give each the same lock (a multiprocessing.Lock, say), so no add is lost.
+    """
+
+    def __init__(self,
+                 error_rate=0.001,
+                 failure_rate=0.01,
+                 probe_bitnoer=get_filter_bitno_probes,
+                 filename=None,
+                 shared_memory_name=None,
+                 start_fresh=False,
+                 conservative=False,
+                 top_k=0,
+                 lock=None):
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        if not (0 < error_rate < 1):
+            raise ValueError('error_rate must be between 0 and 1 exclusive')
+        if not (0 < failure_rate < 1):
+            raise ValueError('failure_rate must be between 0 and 1 exclusive')
+        if filename is not None and shared_memory_name is not None:
+            raise ValueError('Please give filename or shared_memory_name, not both')
+
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.width = int(math.ceil(math.e / error_rate))
+        self.depth = int(math.ceil(math.log(1.0 / failure_rate)))
+        self.probe_bitnoer = probe_bitnoer
+        self.conservative = conservative
+        self.top_k = top_k
+        self.filename = filename
+        self.shared_memory_name = shared_memory_name
+        self.lock = lock
+        self._write_lock = contextlib.nullcontext() if lock is None else lock
+        self._sequence = itertools.count()
+        self._reset_top()
+
+        self._mmap = self._file = self._shared_memory = None
+        if filename is not None:
+            self._header, self.counters = self._open_file(start_fresh)
+        elif shared_memory_name is not None:
+            self._header, self.counters = self._open_shared_memory(start_fresh)
+        else:
+            self._header = None
+            self.counters = array.array('Q', [0]) * (self.width * self.depth)
+            self._total = 0
+
+    # The probe functions take a bloom filter, and look at just these two attributes of it
+    @property
+    def num_probes_k(self):
+        """The number of rows, and so of probes per key"""
+        return self.depth
+
+    @property
+    def num_bits_m(self):
+        """The number of counters per row"""
+        return self.width
+
+    def _storage_bytes(self):
+        """Return the size of a file or shared memory block holding our header and counters"""
+        return HEADER_BYTES + self.width * self.depth * 8
+
+    def _attach(self, buffer_, fresh, name):
+        """Return (header view, counters view) over buffer_, initializing or checking its header"""
+        if sys.byteorder == 'big':
+            raise ValueError('Shared counters need a little-endian machine')
+        view = memoryview(buffer_)
+        if fresh:
+            view[:COUNTER_HEADER.size] = COUNTER_HEADER.pack(SKETCH_MAGIC, self.width, self.depth, 0)
+        else:
+            magic, width, depth, dummy = COUNTER_HEADER.unpack_from(view, 0)
+            if magic != SKETCH_MAGIC or (width, depth) != (self.width, self.depth):
+                view.release()
+                raise ValueError('%s is not a count-min sketch with width %d and depth %d' % (name, self.width,
+                                                                                               self.depth))
+        header = view[:HEADER_BYTES]
+        counters = view[HEADER_BYTES:self._storage_bytes()].cast('Q')
+        view.release()
+        return header, counters
+
+    def _open_file(self, start_fresh):
+        """Map our counters from filename, creating it if need be"""
+        if not HAVE_MMAP:
+            raise ValueError('A file-backed CountMinSketch needs mmap')
+        fresh = start_fresh or not os.path.exists(self.filename)
+        flags = os.O_RDWR | os.O_CREAT
+        if fresh:
+            flags |= os.O_TRUNC
+        self._file = os.open(self.filename, flags, 0o666)
+        if fresh:
+            os.ftruncate(self._file, self._storage_bytes())
+        elif os.fstat(self._file).st_size != self._storage_bytes():
+            os.close(self._file)
+            raise ValueError('%s is not a count-min sketch of this size' % self.filename)
+        self._mmap = mmap_mod.mmap(self._file, self._storage_bytes())
+        return self._attach(self._mmap, fresh, self.filename)
+
+    def _open_shared_memory(self, start_fresh):
+        """Create or attach to our shared memory block"""
+        if not HAVE_SHARED_MEMORY:
+            raise ValueError('A shared memory CountMinSketch needs multiprocessing.shared_memory')
+        try:
+            self._shared_memory = shared_memory.SharedMemory(self.shared_memory_name, create=True,
+                                                             size=self._storage_bytes())
+            fresh = True
+        except FileExistsError:
+            self._shared_memory = shared_memory.SharedMemory(self.shared_memory_name)
+            if self._shared_memory.size < self._storage_bytes():
+                self._shared_memory.close()
+                raise ValueError('%s is not a count-min sketch of this size' % self.shared_memory_name)
+            fresh = start_fresh
+            if fresh:
+                self._shared_memory.buf[:self._storage_bytes()] = bytes(self._storage_bytes())
+        return self._attach(self._shared_memory.buf, fresh, self.shared_memory_name)
+
+    @property
+    def total(self):
+        """The sum of all counts added"""
+        if self._header is None:
+            return self._total
+        return COUNTER_HEADER.unpack_from(self._header, 0)[3]
+
+    def _add_to_total(self, count):
+        """Account for count more occurrences; the write lock must be held"""
+        if self._header is None:
+            self._total += count
+        else:
+            struct.pack_into('<Q', self._header, 24, self.total + count)
+
+    def __repr__(self):
+        return 'CountMinSketch(width=%d, depth=%d, total=%d)' % (self.width, self.depth, self.total)
+
+    def probes(self, key):
+        """Return the counter numbers key maps to, one per row"""
+        width = self.width
+        return [rowno * width + probe for rowno, probe in enumerate(self.probe_bitnoer(self, key))]
+
+    def add_probes(self, key, probes, count=1):
+        """Add count occurrences of key, whose counter numbers (from probes()) are already known"""
+        if count < 0:
+            raise ValueError('count must be >= 0')
+        counters = self.counters
+        with self._write_lock:
+            if self.conservative:
+                estimate = min(counters[counterno] for counterno in probes) + count
+                for counterno in probes:
+                    if counters[counterno] < estimate:
+                        counters[counterno] = estimate
+            else:
+                for counterno in probes:
+                    counters[counterno] += count
+                estimate = None
+            self._add_to_total(count)
+            if self.top_k:
+                if estimate is None:
+                    estimate = min(counters[counterno] for counterno in probes)
+                self._track(key, estimate)
+
+    def add(self, key, count=1):
+        """Add count occurrences of key"""
+        self.add_probes(key, self.probes(key), count)
+
+    def __iadd__(self, key):
+        self.add(key)
+        return self
+
+    def add_many(self, keys, counts=None):
+        """Add each of keys once, or as many times as the corresponding element of counts"""
+        if counts is None:
+            for key in keys:
+                self.add_probes(key, self.probes(key))
+        else:
+            for key, count in zip(keys, counts):
+                self.add_probes(key, self.probes(key), count)
+
+    def estimate_probes(self, probes):
+        """Return the estimated count for the key with these counter numbers"""
+        counters = self.counters
+        return min(counters[counterno] for counterno in probes)
+
+    def estimate(self, key):
+        """Return an estimate of how many times key has been added: never too low, rarely much too high"""
+        return self.estimate_probes(self.probes(key))
+
+    def __getitem__(self, key):
+        return self.estimate(key)
+
+    def estimate_many(self, keys):
+        """Return a list of estimates, one per key"""
+        return [self.estimate_probes(self.probes(key)) for key in keys]
+
+    def _reset_top(self):
+        """Forget our heavy hitters"""
+        self._top = {}
+        self._top_heap = []
+
+    def _push_top(self, key, estimate):
+        """Record key's estimate as a heavy hitter; the sequence number keeps keys themselves from being compared"""
+        self._top[key] = estimate
+        heapq.heappush(self._top_heap, (estimate, next(self._sequence), key))
+        if len(self._top_heap) > 2 * self.top_k + 16:
+            self._top_heap = [(estimate_, next(self._sequence), key_) for key_, estimate_ in self._top.items()]
+            heapq.heapify(self._top_heap)
+
+    def _track(self, key, estimate):
+        """Keep key among our heavy hitters if its estimate is among the top_k seen"""
+        top = self._top
+        if key in top or len(top) < self.top_k:
+            self._push_top(key, estimate)
+            return
+        heap = self._top_heap
+        while top.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        if estimate > heap[0][0]:
+            del top[heapq.heappop(heap)[2]]
+            self._push_top(key, estimate)
+
+    def heavy_hitters(self):
+        """Return up to top_k (key, estimate) pairs for the most frequent keys seen, most frequent first"""
+        return sorted(self._top.items(), key=lambda item: item[1], reverse=True)
+
+    def _check_template(self, sketch):
+        """Raise ValueError unless sketch has the same layout as us"""
+        if (self.width, self.depth, self.probe_bitnoer) != (sketch.width, sketch.depth, sketch.probe_bitnoer):
+            raise ValueError('Sketches must have the same width, depth and probe_bitnoer')
+
+    def merge(self, sketch):
+        """Add sketch's counts to ours, as if we had seen its stream too"""
+        self._check_template(sketch)
+        counters = self.counters
+        theirs = sketch.counters
+        with self._write_lock:
+            for counterno in range(len(counters)):
+                if theirs[counterno]:
+                    counters[counterno] += theirs[counterno]
+            self._add_to_total(sketch.total)
+            if self.top_k:
+                candidates = set(self._top).union(sketch._top)
+                self._reset_top()
+                for key in candidates:
+                    self._track(key, self.estimate(key))
+
+    def __ior__(self, sketch):
+        self.merge(sketch)
+        return self
+
+    def clear(self):
+        """Forget every count"""
+        counters = self.counters
+        with self._write_lock:
+            for counterno in range(len(counters)):
+                counters[counterno] = 0
+            self._add_to_total(-self.total)
+            self._reset_top()
+
+    def close(self):
+        """Release a file-backed or shared memory sketch; the file or shared memory block itself stays"""
+        if self._header is None:
+            return
+        # Keep the total, so it and repr() still work once closed
+        self._total = self.total
+        self.counters.release()
+        self._header.release()
+        self._header = None
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            os.close(self._file)
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+
+    def unlink(self):
+        """Destroy our shared memory block, once every process is done with it"""
+        block = self._shared_memory
+        if block is not None:
+            self.close()
+            block.unlink()
@@ -0,0 +1,156 @@
+# coding=utf-8
+
+"""Keep replica filters in sync by shipping only the pages that changed since a replica last caught up"""
+
+# The in-memory backends stamp each page they change with the current version of their dirty page map.
+# export_delta(since_version) closes the current version, then writes every page stamped later than since_version:
+# exactly the pages a replica that has applied everything up to since_version may be missing.  apply_delta() ORs those
+# pages into the replica's bits, and returns the closed version, which the replica passes as since_version next time.
+#
+# Pages are coarse: a page that gained one bit may hold hundreds of set words.  So each export also takes a
+# copy-on-write snapshot of the backend as its baseline, kept under the version the export closed.  A delta since a
+# version whose baseline is still kept sends only the words that differ from it, and bandwidth scales with inserts
+# rather than filter size.  The last MAX_BASELINES baselines are kept, so that many replicas exporting in turn each
+# get word-level deltas; a delta since an older version sends every nonzero word of each changed page.  Each
+# baseline costs a copy of each page changed since its export, which BloomFilter.snapshot_overhead_bytes() counts.
+#
+# Bloom filters only ever gain bits, so ORing is all a replica needs: applying a delta twice, applying deltas out of
+# order, or applying one that overlaps what the replica already has all leave the same bits, and replicas converge.
+# Bits cleared on the source (clear(), &=) are not replicated.
+#
+# A delta is a _HEADER, then one record per changed page, then an END record.  Each record is a _RECORD header
+# followed by either the page's bytes (RAW) or, when that is smaller, its changed 64 bit little-endian words as
+# (word number, word) pairs (WORDS).  Each record carries the crc32 of its payload, and a corrupt record is refused
+# rather than ORed in.  The records before it will already have been applied, which is harmless.  Deltas are
+# written and read strictly in order, so any byte stream will do: a file, a pipe, a socket's makefile().
+
+import zlib
+import struct
+import itertools
+
+MAGIC = b'BLOOMDL1'
+
+MAX_BASELINES = 4
+
+# magic, num_bits_m, num_probes_k, since_version, version, page_bytes
+_HEADER = struct.Struct('<8sQIQQI')
+# pageno, encoding, payload length, payload crc32
+_RECORD = struct.Struct('<QBII')
+# word number within the page, word
+_WORD = struct.Struct('<IQ')
+
+END = 0
+RAW = 1
+WORDS = 2
+
+
+class DeltaError(Exception):
+    """Raised when a delta stream is truncated, corrupt, or for a different filter"""
+    pass
+
+
+def _words(page):
+    """Return a page as a tuple of 64 bit little-endian words, zero-padding a short last page"""
+    padded = page + bytes(-len(page) % 8)
+    return struct.unpack('<%dQ' % (len(padded) // 8), padded)
+
+
+def _encode_page(page, baseline_page):
+    """
+    Return (encoding, payload) for the smaller encoding of the words of page that differ from baseline_page (or
+    that are nonzero, if baseline_page is None), or (None, None) if there are none
+    """
+    words = _words(page)
+    baseline_words = itertools.repeat(0) if baseline_page is None else _words(baseline_page)
+    changed = [
+        (wordno, word) for wordno, (word, baseline_word) in enumerate(zip(words, baseline_words))
+        if word != baseline_word
+    ]
+    if not changed:
+        return None, None
+    if len(changed) * _WORD.size < len(page):
+        return WORDS, b''.join(_WORD.pack(wordno, word) for wordno, word in changed)
+    return RAW, page
+
+
+def _decode_page(encoding, payload, length):
+    """Return the length bytes of page a record describes"""
+    if encoding == RAW:
+        if len(payload) != length:
+            raise DeltaError('delta page has %d bytes, expected %d' % (len(payload), length))
+        return payload
+    if encoding == WORDS:
+        page = bytearray(length + 8)
+        for wordno, word in _WORD.iter_unpack(payload):
+            if wordno * 8 >= length:
+                raise DeltaError('delta word %d is past the end of its page' % wordno)
+            struct.pack_into('<Q', page, wordno * 8, word)
+        return bytes(page[:length])
+    raise DeltaError('unknown delta record encoding %d' % encoding)
+
+
+def _read_exactly(stream, length):
+    """Read exactly length bytes from stream, however it chooses to chunk them"""
+    chunks = []
+    remaining = length
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            raise DeltaError('delta stream is truncated')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def write_delta(backend, stream, template, since_version, snapshot):
+    """
+    Write the pages of an in-memory backend changed since since_version to stream; return the version closed.
+    snapshot, a fresh Snapshot_backend of backend, becomes the baseline for deltas since that version.
+    """
+    version = backend.dirty.next_version()
+    if not hasattr(backend, 'delta_baselines'):
+        # Oldest first
+        backend.delta_baselines = {}
+    baselines = backend.delta_baselines
+    baseline = baselines.get(since_version)
+    baseline_pages = {} if baseline is None else baseline.preserved
+    baselines[version] = snapshot
+    if len(baselines) > MAX_BASELINES:
+        # baseline_pages may be the oldest's, and is only read from here on, so releasing it now is fine
+        oldest_version = next(iter(baselines))
+        baselines.pop(oldest_version).release()
+    stream.write(_HEADER.pack(
+        MAGIC,
+        template['num_bits_m'],
+        template['num_probes_k'],
+        since_version,
+        version,
+        backend.page_bytes,
+    ))
+    for pageno in backend.dirty.changed_since(since_version):
+        encoding, payload = _encode_page(backend.page_tobytes(pageno), baseline_pages.get(pageno))
+        if encoding is not None:
+            stream.write(_RECORD.pack(pageno, encoding, len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+    stream.write(_RECORD.pack(0, END, 0, 0))
+    return version
+
+
+def apply_delta(backend, stream, template):
+    """OR the pages of a delta read from stream into backend; return the version the delta brings it up to"""
+    magic, num_bits_m, num_probes_k, dummy, version, page_bytes = _HEADER.unpack(_read_exactly(stream, _HEADER.size))
+    if magic != MAGIC:
+        raise DeltaError('not a bloom filter delta')
+    if (num_bits_m, num_probes_k) != (template['num_bits_m'], template['num_probes_k']):
+        raise DeltaError('delta is for a filter of %d bits and %d probes' % (num_bits_m, num_probes_k))
+    num_chars = (num_bits_m + 7) // 8
+    while True:
+        pageno, encoding, length, crc = _RECORD.unpack(_read_exactly(stream, _RECORD.size))
+        if encoding == END:
+            return version
+        payload = _read_exactly(stream, length)
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise DeltaError('delta record for page %d is corrupt' % pageno)
+        byteno = pageno * page_bytes
+        if byteno >= num_chars:
+            raise DeltaError('delta page %d is past the end of the filter' % pageno)
+        backend.or_block(byteno, _decode_page(encoding, payload, min(page_bytes, num_chars - byteno)))
@@ -0,0 +1,177 @@
+# coding=utf-8
+
+"""A key-value store with a bloom filter of its keys in front, so that most lookups of missing keys never reach it"""
+
+# BloomGuardedStore wraps any MutableMapping - a dbm, a shelve, a sqlite-backed dict - and adds each key written to
+# a BloomFilter before writing it to the store.  __getitem__, get() and __contains__ ask the filter first, and only
+# go to the store when the filter says the key may be there.  Deleting a key leaves its bits behind, so it becomes a
+# false positive until rebuild(), which refills a fresh filter from the store's keys a batch at a time.
+#
+# With a filter_path, the filter is checkpointed there by save() and close(), and loaded back on the next open.  A
+# marker file, filter_path + '.open', exists while the store is open: if it is still there at the next open, the last
+# session never saved its filter, which may then be missing keys, so the filter is rebuilt rather than trusted.
+#
+# dbm stores str keys as their utf-8 bytes, and gives them back as bytes.  So the filter is given str keys as utf-8
+# bytes too, and a key finds the same bits whether it was written as str or read back from keys() as bytes.
+
+import os
+import itertools
+import collections.abc
+
+from .bloom_filter import BloomFilter, get_filter_bitno_probes
+from .checkpoint import CheckpointError
+
+DEFAULT_BATCH_KEYS = 2 ** 14
+
+
+def _filter_key(key):
+    """Return the key we give the filter for a store key"""
+    if isinstance(key, str):
+        return key.encode('utf-8')
+    return key
+
+
+class BloomGuardedStore(collections.abc.MutableMapping):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    The MutableMapping mapping_factory() returns, with a BloomFilter of its keys short-circuiting lookups of keys it
+    doesn't have.  max_elements, error_rate, probe_bitnoer and backend ('sparse' or None) size a new filter; a filter
+    loaded from filter_path keeps the sizing it was saved with.
+    """
+
+    def __init__(self,
+                 mapping_factory,
+                 filter_path=None,
+                 max_elements=10000,
+                 error_rate=0.01,
+                 probe_bitnoer=get_filter_bitno_probes,
+                 backend=None,
+                 batch_size=DEFAULT_BATCH_KEYS):
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        self.store = mapping_factory()
+        self.filter_path = filter_path
+        self.batch_size = batch_size
+        self._backend = backend
+
+        self.lookups = 0
+        self.lookups_avoided = 0
+        self.false_positives = 0
+        self.deletes = 0
+        self.rebuilds = 0
+
+        self.bloom = None
+        if filter_path is not None and os.path.exists(filter_path) and not os.path.exists(self._marker_path()):
+            try:
+                self.bloom = BloomFilter.from_checkpoint(filter_path, probe_bitnoer=probe_bitnoer, backend=backend)
+            except CheckpointError:
+                pass
+        if self.bloom is None:
+            self.bloom = self._filled_filter(max_elements, error_rate, probe_bitnoer)
+        if filter_path is not None:
+            with open(self._marker_path(), 'wb'):
+                pass
+
+    def _marker_path(self):
+        """Return the path of the file that exists while we're open"""
+        return '%s.open' % self.filter_path
+
+    def _maybe_present(self, key):
+        """Count a lookup, and return false iff the filter says key is definitely not in the store"""
+        self.lookups += 1
+        if _filter_key(key) in self.bloom:
+            return True
+        self.lookups_avoided += 1
+        return False
+
+    def __getitem__(self, key):
+        if not self._maybe_present(key):
+            raise KeyError(key)
+        try:
+            return self.store[key]
+        except KeyError:
+            self.false_positives += 1
+            raise
+
+    def __contains__(self, key):
+        if not self._maybe_present(key):
+            return False
+        if key in self.store:
+            return True
+        self.false_positives += 1
+        return False
+
+    def __setitem__(self, key, value):
+        # Filter first: a key in the store must never be missing from the filter
+        self.bloom.add(_filter_key(key))
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+        self.deletes += 1
+
+    def __iter__(self):
+        # Not every dbm can be iterated over directly, but they all have keys()
+        return iter(self.store.keys())
+
+    def __len__(self):
+        return len(self.store)
+
+    def _filled_filter(self, max_elements, error_rate, probe_bitnoer):
+        """Return a new filter holding the store's keys, added batch_size keys at a time"""
+        bloom = BloomFilter(
+            max_elements=max_elements,
+            error_rate=error_rate,
+            probe_bitnoer=probe_bitnoer,
+            backend=self._backend,
+        )
+        keys = iter(self.store.keys())
+        while True:
+            batch = [_filter_key(key) for key in itertools.islice(keys, self.batch_size)]
+            if not batch:
+                break
+            bloom.add_many(batch)
+        self.deletes = 0
+        self.rebuilds += 1
+        return bloom
+
+    def rebuild(self, max_elements=None, error_rate=None):
+        """
+        Replace the filter with a fresh one built from the store's keys, dropping the bits of deleted keys.  Pass
+        max_elements or error_rate to resize the filter too, e.g. once the store has outgrown it.
+        """
+        # Meanwhile, lookups keep using the old filter, which has every key the new one will have
+        self.bloom = self._filled_filter(
+            max_elements or self.bloom.ideal_num_elements_n,
+            error_rate or self.bloom.error_rate_p,
+            self.bloom.probe_bitnoer,
+        )
+
+    def stats(self):
+        """
+        Return our lookup counters as a dict.  rebuilds counts every time the filter was built from the store's keys,
+        including when opening without a cleanly saved filter.
+        """
+        return {
+            'lookups': self.lookups,
+            'lookups_avoided': self.lookups_avoided,
+            'false_positives': self.false_positives,
+            'store_lookups': self.lookups - self.lookups_avoided,
+            'avoided_fraction': self.lookups_avoided / self.lookups if self.lookups else 0.0,
+            'deletes_since_rebuild': self.deletes,
+            'rebuilds': self.rebuilds,
+        }
+
+    def save(self):
+        """Checkpoint the filter to filter_path, if we have one"""
+        if self.filter_path is not None:
+            self.bloom.checkpoint(self.filter_path)
+
+    def close(self):
+        """Save the filter, close the store, and note that we shut down cleanly"""
+        self.save()
+        if hasattr(self.store, 'close'):
+            self.store.close()
+        if self.filter_path is not None:
+            os.unlink(self._marker_path())
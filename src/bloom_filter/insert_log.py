@@ -0,0 +1,312 @@
+# coding=utf-8
+
+"""Durable bloom filters: inserts go to an in-memory filter and an append-only log, with periodic compaction"""
+
+# A DurableBloomFilter at path keeps two files:
+#   path.snapshot - a checkpoint (see checkpoint.py) of the filter as of the last compaction
+#   path.log      - every insert since then, as the probe bit numbers each key hashed to
+#
+# The log starts with a LOG_HEADER naming the filter's num_bits_m and num_probes_k, followed by records.  Each record
+# is a group commit of many inserts: a 4 byte length, a 4 byte crc32 of the payload, and the payload itself, which is
+# num_probes_k little-endian 64 bit bit numbers per insert.  Logging bit numbers rather than keys means replay needs
+# neither the keys nor the probe function.
+#
+# On open we load the snapshot and replay the log onto it, stopping (and truncating) at the first torn record.
+# Compaction notes how long the log is and which pages have changed, checkpoints those pages over the snapshot while
+# inserts carry on, then replaces the log with the records logged since.  Setting a bit twice is harmless, so a crash
+# between those two steps just means some of the log gets replayed onto a snapshot that already has it.
+#
+# A flusher thread writes and fsyncs pending inserts once the oldest is fsync_interval seconds old, so that bounds
+# how much a crash can lose even when inserts stop before a batch fills up.
+#
+# Two locks keep inserts from waiting on the disk.  The insert lock covers the filter's bits and the pending inserts;
+# the log lock covers the log file, and is always taken first.  Writing a batch takes the pending inserts under both,
+# then writes and fsyncs them holding just the log lock, so other threads' adds carry on meanwhile.
+
+import os
+import time
+import zlib
+import struct
+import threading
+
+from .bloom_filter import BloomFilter, get_filter_bitno_probes
+from .checkpoint import fsync_directory
+
+LOG_MAGIC = b'BLOOMLG1'
+LOG_HEADER = struct.Struct('<8sQI')
+RECORD_HEADER = struct.Struct('<II')
+
+
+class InsertLogError(Exception):
+    """Raised when an insert log doesn't belong to the filter it's being replayed onto"""
+    pass
+
+
+class DurableBloomFilter(object):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    A BloomFilter whose inserts survive a crash, at close to in-memory speed.  Inserts are group-committed to an
+    append-only log: a batch is written once batch_size inserts are pending, and fsynced at most every
+    fsync_interval seconds (0 means fsync every batch).  Either way, every insert is fsynced within about
+    fsync_interval seconds.  Once the log passes compact_bytes it is folded into the snapshot, in a background
+    thread if background_compaction is true.
+    """
+
+    def __init__(self,
+                 path,
+                 max_elements=10000,
+                 error_rate=0.1,
+                 probe_bitnoer=get_filter_bitno_probes,
+                 backend=None,
+                 batch_size=1024,
+                 fsync_interval=1.0,
+                 compact_bytes=2 ** 26,
+                 background_compaction=False):
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        self.path = path
+        self.snapshot_path = '%s.snapshot' % path
+        self.log_path = '%s.log' % path
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.background_compaction = background_compaction
+
+        if os.path.exists(self.snapshot_path):
+            self.bloom = BloomFilter.from_checkpoint(self.snapshot_path, probe_bitnoer=probe_bitnoer, backend=backend)
+        else:
+            self.bloom = BloomFilter(
+                max_elements=max_elements,
+                error_rate=error_rate,
+                probe_bitnoer=probe_bitnoer,
+                backend=backend,
+            )
+        self._record_format = struct.Struct('<%dQ' % self.bloom.num_probes_k)
+
+        # The insert lock: our filter's bits, the pending inserts and _oldest_unsynced
+        self._lock = threading.RLock()
+        self._pending = []
+        # When the oldest insert not yet fsynced was made, or None if there is none
+        self._oldest_unsynced = None
+        # The log lock: the log file, _log_bytes, _last_fsync and _unsynced.  Take it before the insert lock.
+        self._log_lock = threading.RLock()
+        self._last_fsync = time.time()
+        self._unsynced = False
+        self._closed = False
+        self._flush_due = threading.Condition(self._lock)
+        # Compactions take this before the other locks, and only one runs at a time
+        self._compaction_lock = threading.Lock()
+        self._compactor = None
+
+        self.records_replayed = 0
+        self.inserts_replayed = 0
+        self._log_file = self._open_log()
+
+        self._flusher = threading.Thread(target=self._flush_when_due, name='bloom-filter-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _open_log(self):
+        """Open (creating if need be) the log, replay it onto our filter, and position for appending"""
+        file_ = os.open(self.log_path, os.O_RDWR | os.O_CREAT, 0o666)
+        header = LOG_HEADER.pack(LOG_MAGIC, self.bloom.num_bits_m, self.bloom.num_probes_k)
+        existing = os.pread(file_, LOG_HEADER.size, 0)
+        if len(existing) < LOG_HEADER.size:
+            # New, or torn while writing the header: either way, nothing was logged yet
+            os.ftruncate(file_, 0)
+            os.pwrite(file_, header, 0)
+            os.fsync(file_)
+            self._log_bytes = LOG_HEADER.size
+        elif existing != header:
+            os.close(file_)
+            raise InsertLogError('%s belongs to a different filter' % self.log_path)
+        else:
+            self._log_bytes = self._replay(file_)
+            os.ftruncate(file_, self._log_bytes)
+        os.lseek(file_, self._log_bytes, os.SEEK_SET)
+        return file_
+
+    def _replay(self, file_):
+        """Set the bits recorded in the log; return the offset just past the last intact record"""
+        offset = LOG_HEADER.size
+        backend = self.bloom.backend
+        record_size = self._record_format.size
+        while True:
+            record_header = os.pread(file_, RECORD_HEADER.size, offset)
+            if len(record_header) < RECORD_HEADER.size:
+                break
+            length, crc = RECORD_HEADER.unpack(record_header)
+            payload = os.pread(file_, length, offset + RECORD_HEADER.size)
+            if len(payload) < length or length % record_size or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            for bitnos in self._record_format.iter_unpack(payload):
+                for bitno in bitnos:
+                    backend.set(bitno)
+            self.records_replayed += 1
+            self.inserts_replayed += length // record_size
+            offset += RECORD_HEADER.size + length
+        return offset
+
+    def add(self, key):
+        """Add an element to the filter; it becomes durable at the next group commit"""
+        bitnos = list(self.bloom.probe_bitnoer(self.bloom, key))
+        with self._lock:
+            for bitno in bitnos:
+                self.bloom.backend.set(bitno)
+            batch_full = self._add_pending([bitnos])
+        if batch_full:
+            self._write_pending(False)
+        self._maybe_compact()
+
+    def __iadd__(self, key):
+        self.add(key)
+        return self
+
+    def add_if_absent(self, key):
+        """Add key; return true iff it wasn't already (probably) in the filter.  Atomic with respect to other adds."""
+        return self.add_if_absent_many([key])[0]
+
+    def add_if_absent_many(self, keys):
+        """add_if_absent() each of keys in turn, returning a list of bools; only the keys that were absent are logged"""
+        bitno_lists = [list(self.bloom.probe_bitnoer(self.bloom, key)) for key in keys]
+        with self._lock:
+            results = self.bloom.backend.test_and_set_many(bitno_lists)
+            batch_full = self._add_pending([bitnos for bitnos, newly_set in zip(bitno_lists, results) if newly_set])
+        if batch_full:
+            self._write_pending(False)
+        self._maybe_compact()
+        return results
+
+    def __contains__(self, key):
+        return key in self.bloom
+
+    def _add_pending(self, bitno_lists):
+        """Queue inserts for the log; return true iff a batch is now full.  Insert lock must be held."""
+        if not bitno_lists:
+            return False
+        self._pending.extend(self._record_format.pack(*bitnos) for bitnos in bitno_lists)
+        if self._oldest_unsynced is None:
+            self._oldest_unsynced = time.time()
+            self._flush_due.notify()
+        return len(self._pending) >= self.batch_size
+
+    def _write_pending(self, force_sync):
+        """
+        Append the pending inserts to the log as one record, and fsync it if force_sync is true or fsync_interval has
+        elapsed.  Only the log lock is held while writing, so adds carry on meanwhile.
+        """
+        with self._log_lock:
+            with self._lock:
+                payload = b''.join(self._pending)
+                self._pending = []
+                sync = bool(payload or self._unsynced) and (force_sync or
+                                                             time.time() - self._last_fsync >= self.fsync_interval)
+                if sync:
+                    # Anything added from here on isn't covered by the fsync below
+                    self._oldest_unsynced = None
+            if payload:
+                os.write(self._log_file, RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+                self._log_bytes += RECORD_HEADER.size + len(payload)
+                self._unsynced = True
+            if sync:
+                os.fsync(self._log_file)
+                self._last_fsync = time.time()
+                self._unsynced = False
+
+    def flush(self):
+        """Write and fsync all pending inserts, making every add so far durable"""
+        self._write_pending(True)
+
+    def _flush_when_due(self):
+        """Run by the flusher thread: flush once the oldest insert not yet fsynced is fsync_interval seconds old"""
+        while True:
+            with self._lock:
+                while not self._closed:
+                    if self._oldest_unsynced is None:
+                        self._flush_due.wait()
+                        continue
+                    remaining = self._oldest_unsynced + self.fsync_interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self._flush_due.wait(remaining)
+                if self._closed:
+                    return
+            # Not holding the insert lock, which must be taken after the log lock
+            self.flush()
+
+    def _maybe_compact(self):
+        """Compact if the log has outgrown compact_bytes; hold neither lock, as compaction takes them after its own"""
+        if self._log_bytes >= self.compact_bytes:
+            if self.background_compaction:
+                self._start_background_compaction()
+            else:
+                self.compact()
+
+    def compact(self):
+        """Fold the log into the snapshot now, on this thread.  Inserts carry on while the snapshot is written."""
+        with self._compaction_lock:
+            if self._log_file is None:
+                return
+            with self._log_lock:
+                self.flush()
+                with self._lock:
+                    logged_bytes = self._log_bytes
+                    dirty = self.bloom.backend.dirty.take()
+            # Anything added from here on is logged past logged_bytes, and its pages are dirty for next time
+            self.bloom.checkpoint(self.snapshot_path, dirty=dirty)
+            with self._log_lock:
+                self._drop_log_records(logged_bytes)
+
+    def _drop_log_records(self, logged_bytes):
+        """Replace the log with one holding just the records past logged_bytes; log lock must be held"""
+        self.flush()
+        if self._log_bytes == logged_bytes:
+            os.ftruncate(self._log_file, LOG_HEADER.size)
+            os.fsync(self._log_file)
+        else:
+            # Copying the newer records over the older ones in place could tear them, so write a new log
+            newer = os.pread(self._log_file, self._log_bytes - logged_bytes, logged_bytes)
+            temp_path = '%s.tmp' % self.log_path
+            file_ = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                os.write(file_, os.pread(self._log_file, LOG_HEADER.size, 0) + newer)
+                os.fsync(file_)
+            except BaseException:
+                os.close(file_)
+                raise
+            os.replace(temp_path, self.log_path)
+            fsync_directory(self.log_path)
+            os.close(self._log_file)
+            self._log_file = file_
+        self._log_bytes = LOG_HEADER.size + self._log_bytes - logged_bytes
+        os.lseek(self._log_file, self._log_bytes, os.SEEK_SET)
+
+    def _start_background_compaction(self):
+        """Compact on a separate thread, unless that's already happening"""
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name='bloom-filter-compaction')
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def log_bytes(self):
+        """Return the current size of the log, in bytes"""
+        return self._log_bytes
+
+    def close(self):
+        """Flush pending inserts and close the log; the snapshot is left as is.  Closing twice is harmless."""
+        if self._log_file is None:
+            return
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            self._closed = True
+            self._flush_due.notify()
+        self._flusher.join()
+        with self._compaction_lock:
+            with self._log_lock:
+                self.flush()
+                os.close(self._log_file)
+                self._log_file = None
+        self.bloom.backend.close()
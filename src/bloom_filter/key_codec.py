@@ -0,0 +1,135 @@
+# coding=utf-8
+
+"""Turn structured keys (tuples, UUIDs, datetimes, numbers, ...) into bytes for hashing, without going via str"""
+
+# Every encoding is a one byte type tag followed by a payload, so keys of different types can't collide just
+# because their payloads happen to match.  These encodings are part of the on-disk format of every filter that
+# holds such keys: they must never change.  CODEC_VERSION is here so that, if they ever must, old and new can be
+# told apart.
+#
+# Tags 0x01-0x7f are ours.  Tags 0x80-0xff are for register_key_codec().
+#
+# Note that str, bytes, ints and sequences of ints are NOT encoded here by get_filter_bitno_probes: it hashes those
+# the way it always has, so that existing filters keep working.
+
+import uuid
+import struct
+import decimal
+import datetime
+
+CODEC_VERSION = 1
+
+TAG_NONE = 0x01
+TAG_BOOL = 0x02
+TAG_INT = 0x03
+TAG_FLOAT = 0x04
+TAG_STR = 0x05
+TAG_BYTES = 0x06
+TAG_UUID = 0x07
+TAG_DATETIME = 0x08
+TAG_DATE = 0x09
+TAG_SEQUENCE = 0x0a
+TAG_DECIMAL = 0x0b
+
+FIRST_USER_TAG = 0x80
+
+_DOUBLE = struct.Struct('<d')
+
+
+def encode_varint(value):
+    """Encode a non-negative integer in 7 bit groups, least significant first"""
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def _encode_int(value):
+    """Minimal little-endian two's complement"""
+    value = int(value)
+    return value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+
+
+def _encode_float(value):
+    """IEEE 754 double; -0.0 is 0.0, as python considers them equal"""
+    if value == 0.0:
+        value = 0.0
+    return _DOUBLE.pack(value)
+
+
+def _encode_datetime(value):
+    """ISO 8601; aware datetimes are converted to UTC first, so that equal instants encode the same"""
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return value.isoformat().encode('ascii')
+
+
+def _encode_decimal(value):
+    """Normalized, so that Decimal('1.0') and Decimal('1.00') encode the same"""
+    return str(value.normalize()).encode('ascii')
+
+
+def _encode_sequence(value):
+    """An element count, then each element's length and tagged encoding"""
+    parts = [encode_varint(len(value))]
+    for element in value:
+        encoded = encode_key(element)
+        parts.append(encode_varint(len(encoded)))
+        parts.append(encoded)
+    return b''.join(parts)
+
+
+# type -> (tag, encoder).  bool must be looked up before int, which the exact-type lookup in _find_codec ensures.
+_CODECS = {
+    type(None): (TAG_NONE, lambda value: b''),
+    bool: (TAG_BOOL, lambda value: b'\x01' if value else b'\x00'),
+    int: (TAG_INT, _encode_int),
+    float: (TAG_FLOAT, _encode_float),
+    str: (TAG_STR, lambda value: value.encode('utf-8')),
+    bytes: (TAG_BYTES, bytes),
+    bytearray: (TAG_BYTES, bytes),
+    memoryview: (TAG_BYTES, lambda value: value.tobytes()),
+    uuid.UUID: (TAG_UUID, lambda value: value.bytes),
+    datetime.datetime: (TAG_DATETIME, _encode_datetime),
+    datetime.date: (TAG_DATE, lambda value: value.isoformat().encode('ascii')),
+    tuple: (TAG_SEQUENCE, _encode_sequence),
+    list: (TAG_SEQUENCE, _encode_sequence),
+    decimal.Decimal: (TAG_DECIMAL, _encode_decimal),
+}
+
+
+def register_key_codec(type_, tag, encoder):
+    """
+    Teach encode_key about type_.  encoder(value) must return bytes, and must give the same bytes for equal values
+    in every process and every version of your code.  tag is a number from 0x80 to 0xff identifying type_; it
+    becomes part of every encoded key, so never reuse a tag for a different type.
+    """
+    if not FIRST_USER_TAG <= tag <= 0xff:
+        raise ValueError('tag must be between 0x%x and 0xff' % FIRST_USER_TAG)
+    for existing_type, (existing_tag, dummy) in _CODECS.items():
+        if existing_tag == tag and existing_type is not type_:
+            raise ValueError('tag 0x%x is already registered for %s' % (tag, existing_type.__name__))
+    _CODECS[type_] = (tag, encoder)
+
+
+def _find_codec(type_):
+    """Return the (tag, encoder) for type_ or its nearest registered base class"""
+    try:
+        return _CODECS[type_]
+    except KeyError:
+        pass
+    for base in type_.__mro__[1:]:
+        if base in _CODECS:
+            return _CODECS[base]
+    raise TypeError('Sorry, I do not know how to hash this type: %s' % type_.__name__)
+
+
+def encode_key(key):
+    """Return a deterministic, type-tagged byte encoding of key"""
+    tag, encoder = _find_codec(type(key))
+    return bytes([tag]) + encoder(key)
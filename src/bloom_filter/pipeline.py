@@ -0,0 +1,154 @@
+# coding=utf-8
+
+"""Streaming prefilters: drop the rows of a huge input whose keys are definitely not in a filter, a batch at a time"""
+
+# A semi-join prefilter asks the filter about every row of its input.  Asking one key at a time makes a trip through
+# the probes and the backend per row; these helpers instead cut the input into batches of batch_rows rows, and ask
+# about each batch with one contains_many() call, which the file backends turn into one sorted, coalesced pass.  At
+# most two batches are held at once, however big the input.
+#
+# With workers > 0, a thread pool extracts the keys of the next batch while the current one is being tested and
+# consumed.  That only helps when the key function spends its time outside the interpreter lock (C parsers,
+# decompression, I/O); for pure python key functions, leave it at 0.
+#
+# Pass a PipelineStats as stats to see how many rows went in and came out, and how fast; it is updated after every
+# batch, so it can be read while the pipeline is still running.
+
+import time
+import itertools
+import concurrent.futures
+
+DEFAULT_BATCH_ROWS = 2 ** 12
+
+
+class PipelineStats(object):
+    """Rows seen and passed by a pipeline helper, and the time it has taken so far"""
+
+    def __init__(self):
+        self.rows_in = 0
+        self.rows_out = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self._started = None
+
+    def _start(self):
+        """Start the clock, before the first batch is read; later runs with the same stats keep adding to it"""
+        if self._started is None:
+            self._started = time.monotonic()
+
+    def _record(self, rows_in, rows_out):
+        """Account for one more batch"""
+        self.rows_in += rows_in
+        self.rows_out += rows_out
+        self.batches += 1
+        self.seconds = time.monotonic() - self._started
+
+    @property
+    def rows_per_second(self):
+        """Input rows processed per second"""
+        if not self.seconds:
+            return 0.0
+        return self.rows_in / self.seconds
+
+    @property
+    def selectivity(self):
+        """The fraction of input rows that passed"""
+        if not self.rows_in:
+            return 0.0
+        return self.rows_out / self.rows_in
+
+    def __repr__(self):
+        return 'PipelineStats(rows_in=%d, rows_out=%d, rows_per_second=%.0f, selectivity=%.4f)' % (
+            self.rows_in,
+            self.rows_out,
+            self.rows_per_second,
+            self.selectivity,
+        )
+
+
+def _batches(iterable, batch_rows):
+    """Generate lists of up to batch_rows consecutive items of iterable"""
+    if batch_rows <= 0:
+        raise ValueError('batch_rows must be > 0')
+    iterator = iter(iterable)
+    while True:
+        rows = list(itertools.islice(iterator, batch_rows))
+        if not rows:
+            return
+        yield rows
+
+
+def _submit_keys(executor, rows, key, workers):
+    """Start extracting the keys of rows, split across workers; return a function that waits for them"""
+    slice_rows = (len(rows) + workers - 1) // workers
+    futures = [
+        executor.submit(lambda part: [key(row) for row in part], rows[start:start + slice_rows])
+        for start in range(0, len(rows), slice_rows)
+    ]
+    return lambda: [key_ for future in futures for key_ in future.result()]
+
+
+def _keyed_batches(iterable, key, batch_rows, workers):
+    """Generate (rows, keys) a batch at a time; with workers, the next batch's keys are extracted meanwhile"""
+    if key is None or not workers:
+        for rows in _batches(iterable, batch_rows):
+            yield rows, rows if key is None else [key(row) for row in rows]
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = None
+        for rows in _batches(iterable, batch_rows):
+            keys = _submit_keys(executor, rows, key, workers)
+            if pending is not None:
+                yield pending[0], pending[1]()
+            pending = (rows, keys)
+        if pending is not None:
+            yield pending[0], pending[1]()
+
+
+def _tested_batches(bloom_filter, iterable, key, batch_rows, workers, stats):
+    """Generate (rows, answers) a batch at a time, answers saying which rows' keys are probably in bloom_filter"""
+    # pylint: disable=R0913
+    # R0913: We want a few arguments
+    if stats is not None:
+        stats._start()
+    for rows, keys in _keyed_batches(iterable, key, batch_rows, workers):
+        answers = bloom_filter.contains_many(keys)
+        if stats is not None:
+            stats._record(len(rows), sum(1 for answer in answers if answer))
+        yield rows, answers
+
+
+def filter_iter(bloom_filter, iterable, key=None, batch_rows=DEFAULT_BATCH_ROWS, workers=0, stats=None):
+    """Generate the items of iterable whose key(item), or the item itself, is probably in bloom_filter, in order"""
+    # pylint: disable=R0913
+    # R0913: We want a few arguments
+    for rows, answers in _tested_batches(bloom_filter, iterable, key, batch_rows, workers, stats):
+        for row, answer in zip(rows, answers):
+            if answer:
+                yield row
+
+
+def partition_iter(bloom_filter, iterable, key=None, batch_rows=DEFAULT_BATCH_ROWS, workers=0, stats=None):
+    """Generate (probably in bloom_filter, item) for every item of iterable, in order"""
+    # pylint: disable=R0913
+    # R0913: We want a few arguments
+    for rows, answers in _tested_batches(bloom_filter, iterable, key, batch_rows, workers, stats):
+        for row, answer in zip(rows, answers):
+            yield bool(answer), row
+
+
+def filter_lines(bloom_filter, path, key_extractor, batch_rows=DEFAULT_BATCH_ROWS, workers=0, stats=None,
+                 encoding='utf-8'):
+    """
+    Generate the lines of the file at path whose key_extractor(line) is probably in bloom_filter.  Lines keep their
+    line endings, so they can be written straight out again.  With encoding=None, lines are bytes.
+    """
+    # pylint: disable=R0913
+    # R0913: We want a few arguments
+    if encoding is None:
+        file_ = open(path, 'rb')
+    else:
+        file_ = open(path, 'r', encoding=encoding, newline='')
+    with file_:
+        for line in filter_iter(bloom_filter, file_, key_extractor, batch_rows, workers, stats):
+            yield line
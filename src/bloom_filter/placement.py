@@ -0,0 +1,58 @@
+# coding=utf-8
+
+"""Decide where a filter's bits live - in memory or on disk - from its size and a memory budget"""
+
+# BloomFilter(..., backend='auto', filename=path) asks a BackendPolicy where its bits should live, instead of taking
+# that from the overloaded filename argument: in an array while they fit memory_budget_bytes, otherwise in an mmap
+# of path (or a file we seek in, where there's no mmap).  Pass a BackendPolicy as backend to set the budget.
+#
+# Placement isn't fixed after that.  BloomFilter.migrate() copies the bits to another backend a block at a time while
+# the filter stays in use, then switches over in one step.  BloomFilter.rebalance(hot) asks the policy again - a
+# hot filter that fits the budget belongs in memory, a cold one on disk - and migrates if the answer has changed.
+# Subclass BackendPolicy and override choose() for other rules.  Each decision, with its reason, is kept in
+# BloomFilter.placement_stats().
+
+try:
+    # pylint: disable=W0611
+    # W0611: We only want to know whether there is an mmap
+    import mmap
+except ImportError:
+    # Jython lacks mmap()
+    HAVE_MMAP = False
+else:
+    HAVE_MMAP = True
+
+DEFAULT_MEMORY_BUDGET_BYTES = 2 ** 30
+
+
+class BackendPolicy(object):
+    """Place a filter's bits in memory while they fit memory_budget_bytes, and at path on disk otherwise"""
+
+    def __init__(self, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES, path=None):
+        if memory_budget_bytes < 0:
+            raise ValueError('memory_budget_bytes must be >= 0')
+        self.memory_budget_bytes = memory_budget_bytes
+        self.path = path
+
+    def disk_kind(self):
+        """Return the kind of backend we use on disk"""
+        return 'mmap' if HAVE_MMAP else 'seek'
+
+    def choose(self, num_bits, hot=None):
+        """
+        Return (kind, reason): the kind of backend - 'array', 'sparse', 'mmap' or 'seek' - a filter of num_bits bits
+        belongs in, and why.  hot says whether the filter is busy, or is None if the caller doesn't know.
+        """
+        num_bytes = (num_bits + 7) // 8
+        if self.path is None:
+            return 'array', 'no path to put it on disk'
+        if num_bytes > self.memory_budget_bytes:
+            return self.disk_kind(), '%d bytes exceeds the memory budget of %d' % (num_bytes, self.memory_budget_bytes)
+        if hot is False:
+            return self.disk_kind(), 'cold'
+        if hot:
+            return 'array', 'hot, and %d bytes fits the memory budget' % num_bytes
+        return 'array', '%d bytes fits the memory budget of %d' % (num_bytes, self.memory_budget_bytes)
+
+    def __repr__(self):
+        return 'BackendPolicy(memory_budget_bytes=%d, path=%r)' % (self.memory_budget_bytes, self.path)
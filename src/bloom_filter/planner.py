@@ -0,0 +1,151 @@
+# coding=utf-8
+
+"""Choose bloom filter parameters from a memory budget, an error rate, a probe limit, or a combination"""
+
+# With m bits, k probes and n elements, the fraction of bits set when full is about
+#   fill = 1 - e ** (-k * n / m)
+# and the false positive rate is about
+#   fpr = fill ** k
+# A lookup of a key that's present costs all k probes.  A lookup of an absent key stops at the first clear bit, so
+# it costs 1 + fill + fill ** 2 + ... + fill ** (k - 1) probes on average.  On the disk backends, every probe is a
+# random read, which is why fewer probes can be worth a little more memory.
+
+from __future__ import division
+
+import math
+
+OS_PAGE_BYTES = 2 ** 12
+
+BACKENDS = ('array', 'sparse', 'mmap', 'seek')
+
+
+def fill_fraction(num_bits_m, num_probes_k, num_elements_n):
+    """Return the expected fraction of bits set after num_elements_n adds"""
+    return 1.0 - math.exp(-num_probes_k * num_elements_n / num_bits_m)
+
+
+def false_positive_rate(num_bits_m, num_probes_k, num_elements_n):
+    """Return the expected false positive rate after num_elements_n adds"""
+    return fill_fraction(num_bits_m, num_probes_k, num_elements_n) ** num_probes_k
+
+
+def expected_probes_for_miss(num_bits_m, num_probes_k, num_elements_n):
+    """Return the expected number of probes a lookup of an absent key makes before finding a clear bit"""
+    fill = fill_fraction(num_bits_m, num_probes_k, num_elements_n)
+    return sum(fill ** probeno for probeno in range(num_probes_k))
+
+
+def bits_for_error_rate(num_elements_n, error_rate, num_probes_k):
+    """Return the fewest bits that reach error_rate with exactly num_probes_k probes"""
+    return int(math.ceil(-num_probes_k * num_elements_n / math.log(1.0 - error_rate ** (1.0 / num_probes_k))))
+
+
+def best_probes_for_bits(num_bits_m, num_elements_n, max_probes=None):
+    """Return the number of probes giving the lowest false positive rate for num_bits_m bits, up to max_probes"""
+    ideal = num_bits_m / num_elements_n * math.log(2)
+    candidates = set([max(1, int(math.floor(ideal))), max(1, int(math.ceil(ideal)))])
+    if max_probes is not None:
+        candidates = set(min(candidate, max_probes) for candidate in candidates)
+    return min(candidates, key=lambda num_probes_k: false_positive_rate(num_bits_m, num_probes_k, num_elements_n))
+
+
+class BloomFilterPlan(object):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    Concrete parameters for a bloom filter, and what to expect from them.  backend_costs maps each backend name to a
+    dict of memory_bytes (resident when full), probes_per_hit, probes_per_miss, and io_per_hit and io_per_miss: the
+    expected number of random reads from disk or page cache per lookup.
+    """
+
+    def __init__(self, max_elements, num_bits_m, num_probes_k, backend=None):
+        self.max_elements = max_elements
+        self.num_bits_m = num_bits_m
+        self.num_probes_k = num_probes_k
+        self.backend = backend
+        self.memory_bytes = (num_bits_m + 7) // 8
+        self.predicted_error_rate = false_positive_rate(num_bits_m, num_probes_k, max_elements)
+        self.probes_per_hit = num_probes_k
+        self.probes_per_miss = expected_probes_for_miss(num_bits_m, num_probes_k, max_elements)
+
+        self.backend_costs = {}
+        for name in BACKENDS if backend is None else (backend,):
+            self.backend_costs[name] = self._backend_cost(name)
+
+    def _backend_cost(self, name):
+        """Estimate memory and I/O for one backend"""
+        if name in ('array', 'sparse'):
+            io_per_probe = 0.0
+            memory_bytes = self.memory_bytes
+        elif name == 'mmap':
+            # Each probe lands on a random page, unless the whole filter fits in a few pages
+            io_per_probe = min(1.0, self.memory_bytes / (OS_PAGE_BYTES * self.num_probes_k))
+            memory_bytes = 0
+        elif name == 'seek':
+            io_per_probe = 1.0
+            memory_bytes = 0
+        else:
+            raise ValueError('Unknown backend: %r' % (name,))
+        return {
+            'memory_bytes': memory_bytes,
+            'probes_per_hit': self.probes_per_hit,
+            'probes_per_miss': self.probes_per_miss,
+            'io_per_hit': self.probes_per_hit * io_per_probe,
+            'io_per_miss': self.probes_per_miss * io_per_probe,
+        }
+
+    def __repr__(self):
+        return 'BloomFilterPlan(max_elements=%d, num_bits_m=%d, num_probes_k=%d, predicted_error_rate=%g)' % (
+            self.max_elements,
+            self.num_bits_m,
+            self.num_probes_k,
+            self.predicted_error_rate,
+        )
+
+
+def plan(max_elements, memory_bytes=None, error_rate=None, max_probes=None, backend=None):
+    """
+    Plan a filter for max_elements elements:
+        memory_bytes alone: the lowest error rate that fits in memory_bytes
+        error_rate alone: the least memory that reaches error_rate
+        both: the fewest probes per lookup that reach error_rate within memory_bytes
+    max_probes caps the number of probes; with error_rate alone, memory grows to compensate.
+    """
+    # pylint: disable=R0913
+    # R0913: We want a few arguments
+    if max_elements <= 0:
+        raise ValueError('max_elements must be > 0')
+    if error_rate is not None and not (0 < error_rate < 1):
+        raise ValueError('error_rate must be between 0 and 1 exclusive')
+    if memory_bytes is not None and memory_bytes <= 0:
+        raise ValueError('memory_bytes must be > 0')
+    if max_probes is not None and max_probes < 1:
+        raise ValueError('max_probes must be >= 1')
+    if backend is not None and backend not in BACKENDS:
+        raise ValueError('Unknown backend: %r' % (backend,))
+
+    if memory_bytes is None and error_rate is None:
+        raise ValueError('Please give memory_bytes, error_rate, or both')
+
+    if error_rate is None:
+        num_bits_m = memory_bytes * 8
+        num_probes_k = best_probes_for_bits(num_bits_m, max_elements, max_probes)
+    elif memory_bytes is None:
+        num_probes_k = best_probes_for_bits(-max_elements * math.log(error_rate) / math.log(2) ** 2, max_elements,
+                                            max_probes)
+        num_bits_m = bits_for_error_rate(max_elements, error_rate, num_probes_k)
+    else:
+        num_bits_m = memory_bytes * 8
+        most_probes = best_probes_for_bits(num_bits_m, max_elements, max_probes)
+        for num_probes_k in range(1, most_probes + 1):
+            if false_positive_rate(num_bits_m, num_probes_k, max_elements) <= error_rate:
+                break
+        else:
+            raise ValueError('%d bytes cannot hold %d elements at an error rate of %g%s' % (
+                memory_bytes,
+                max_elements,
+                error_rate,
+                '' if max_probes is None else ' with at most %d probes' % max_probes,
+            ))
+
+    return BloomFilterPlan(max_elements, num_bits_m, num_probes_k, backend=backend)
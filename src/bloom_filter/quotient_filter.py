@@ -0,0 +1,501 @@
+# coding=utf-8
+
+"""Quotient filters: compact approximate multisets that, unlike bloom filters, can be resized and merged"""
+
+# Each key hashes to a fingerprint_bits bit fingerprint.  Its top quotient_bits bits (the quotient) pick a slot in a
+# table of 2 ** quotient_bits slots, and the remaining remainder_bits bits (the remainder) are what we store.  All
+# the remainders with the same quotient form a sorted run; runs are stored in quotient order, each starting at its
+# quotient's slot or, if that's taken, shifted to the right of it.  Three metadata bits per slot say how:
+#   OCCUPIED     - some key has this slot's number as its quotient (its run may be stored further right)
+#   CONTINUATION - this slot holds a remainder that isn't the first of its run
+#   SHIFTED      - this slot holds a remainder that isn't in its quotient's slot
+# A slot is stored as (remainder << 3) | metadata, in an array of the narrowest unsigned type that fits.
+#
+# A lookup finds the run for its quotient by walking left to the start of the cluster and then right, and then
+# scans that one contiguous run.  Because the table holds whole fingerprints, it can be rebuilt at twice the size
+# without the original keys - each fingerprint just moves one bit from its remainder to its quotient - and two
+# tables can be merged by merging their sorted fingerprints.  Equal fingerprints are stored once per add, so
+# remove() removes one of them and never disturbs a different key that happens to collide.
+#
+# With a filename, the table is kept in a file via mmap.  The file is HEADER_BYTES of header, then the slots as
+# little-endian integers.
+
+import os
+import sys
+import math
+import heapq
+import array
+import struct
+import hashlib
+
+try:
+    import mmap as mmap_mod
+except ImportError:
+    # Jython lacks mmap()
+    HAVE_MMAP = False
+else:
+    HAVE_MMAP = True
+
+from .key_codec import encode_key
+
+MAGIC = b'BLOOMQF1'
+HEADER = struct.Struct('<8sBBd')
+HEADER_BYTES = 64
+
+OCCUPIED = 1
+CONTINUATION = 2
+SHIFTED = 4
+METADATA = OCCUPIED | CONTINUATION | SHIFTED
+
+
+def fingerprint(key, fingerprint_bits):
+    """Return a fingerprint_bits bit hash of key"""
+    digest = hashlib.blake2b(encode_key(key), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> (64 - fingerprint_bits)
+
+
+def slot_typecode(remainder_bits):
+    """Return the narrowest array typecode that holds remainder_bits bits plus our three metadata bits"""
+    for typecode in 'BHIQ':
+        if remainder_bits + 3 <= array.array(typecode).itemsize * 8:
+            return typecode
+    raise ValueError('remainder_bits must be at most 61')
+
+
+def _walk(slots, mask, start, num_slots):
+    """Generate (quotient, remainder) for the entries in num_slots slots from start, which must start a cluster"""
+    quotient = start
+    for step in range(num_slots):
+        slotno = (start + step) & mask
+        slot = slots[slotno]
+        if not slot & METADATA:
+            continue
+        if not slot & CONTINUATION:
+            if slot & SHIFTED:
+                # The start of the next occupied quotient's run
+                quotient = (quotient + 1) & mask
+                while not slots[quotient] & OCCUPIED:
+                    quotient = (quotient + 1) & mask
+            else:
+                quotient = slotno
+        yield quotient, slot >> 3
+
+
+def _is_cluster_start(slot):
+    """Return true iff slot holds the first entry of a cluster"""
+    return slot & OCCUPIED and not slot & (CONTINUATION | SHIFTED)
+
+
+def iter_fingerprints(slots, quotient_bits, remainder_bits):
+    """Generate the fingerprints stored in a table of slots, in ascending order"""
+    size = 1 << quotient_bits
+    mask = size - 1
+    first_start = next((slotno for slotno in range(size) if _is_cluster_start(slots[slotno])), None)
+    if first_start is None:
+        return
+    if slots[0] & METADATA and not _is_cluster_start(slots[0]):
+        # The last cluster wraps around past the last slot, and may hold the smallest quotients: those go first
+        last_start = next(slotno for slotno in range(size - 1, -1, -1) if _is_cluster_start(slots[slotno]))
+        for quotient, remainder in _walk(slots, mask, last_start, ((first_start - last_start - 1) & mask) + 1):
+            if quotient < first_start:
+                yield (quotient << remainder_bits) | remainder
+    for quotient, remainder in _walk(slots, mask, first_start, size):
+        if quotient >= first_start:
+            yield (quotient << remainder_bits) | remainder
+
+
+class QuotientFilter(object):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    An approximate multiset of keys, sized for max_elements at error_rate.  It grows automatically once more than
+    max_load of its slots are in use: each doubling costs one remainder bit, so a filled-up doubled table has about
+    twice the error rate; spare_doublings reserves bits for that many doublings up front.  With a filename, the
+    table lives in that file via mmap, and is reopened if the file exists and start_fresh is false.
+    """
+
+    def __init__(self,
+                 max_elements=10000,
+                 error_rate=0.01,
+                 filename=None,
+                 start_fresh=False,
+                 spare_doublings=0,
+                 max_load=0.9):
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        if filename is not None and not HAVE_MMAP:
+            raise ValueError('A file-backed QuotientFilter needs mmap')
+        if filename is not None and sys.byteorder == 'big':
+            raise ValueError('A file-backed QuotientFilter needs a little-endian machine')
+        self.filename = filename
+        self.slots = self._mmap = self._file = None
+
+        if filename is not None and not start_fresh and os.path.exists(filename):
+            self._open_file()
+            return
+
+        if max_elements <= 0:
+            raise ValueError('max_elements must be > 0')
+        if not (0 < error_rate < 1):
+            raise ValueError('error_rate must be between 0 and 1 exclusive')
+        if not (0 < max_load < 1):
+            raise ValueError('max_load must be between 0 and 1 exclusive')
+        self.max_load = max_load
+        quotient_bits = max(1, int(math.ceil(math.log(max_elements / max_load, 2))))
+        # An absent key matches a stored remainder with probability about load / 2 ** remainder_bits
+        remainder_bits = max(1, int(math.ceil(math.log(1.0 / error_rate, 2)))) + spare_doublings
+        self.fingerprint_bits = quotient_bits + remainder_bits
+        if self.fingerprint_bits > 64:
+            raise ValueError('max_elements and error_rate need more than 64 bits of fingerprint')
+        self._set_table(quotient_bits, *self._allocate(quotient_bits, remainder_bits, filename))
+        self.num_elements = 0
+
+    def _allocate(self, quotient_bits, remainder_bits, path):
+        """Return (slots, mmap, file descriptor) for an empty table; the latter two are None unless path is given"""
+        typecode = slot_typecode(remainder_bits)
+        size = 1 << quotient_bits
+        if path is None:
+            return array.array(typecode, [0]) * size, None, None
+        total_bytes = HEADER_BYTES + size * array.array(typecode).itemsize
+        file_ = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.ftruncate(file_, total_bytes)
+        mmap_ = mmap_mod.mmap(file_, total_bytes)
+        mmap_[:HEADER.size] = HEADER.pack(MAGIC, quotient_bits, remainder_bits, self.max_load)
+        return memoryview(mmap_)[HEADER_BYTES:].cast(typecode), mmap_, file_
+
+    def _open_file(self):
+        """Map an existing file-backed filter"""
+        file_ = os.open(self.filename, os.O_RDWR)
+        total_bytes = os.fstat(file_).st_size
+        if total_bytes < HEADER_BYTES:
+            os.close(file_)
+            raise ValueError('%s is not a quotient filter' % self.filename)
+        mmap_ = mmap_mod.mmap(file_, total_bytes)
+        magic, quotient_bits, remainder_bits, self.max_load = HEADER.unpack_from(mmap_, 0)
+        typecode = slot_typecode(remainder_bits)
+        if magic != MAGIC or total_bytes != HEADER_BYTES + (1 << quotient_bits) * array.array(typecode).itemsize:
+            mmap_.close()
+            os.close(file_)
+            raise ValueError('%s is not a quotient filter' % self.filename)
+        self.fingerprint_bits = quotient_bits + remainder_bits
+        self._set_table(quotient_bits, memoryview(mmap_)[HEADER_BYTES:].cast(typecode), mmap_, file_)
+        self.num_elements = sum(1 for slot in self.slots if slot & METADATA)
+
+    def _set_table(self, quotient_bits, slots, mmap_, file_):
+        """Start using a new table"""
+        self.quotient_bits = quotient_bits
+        self.remainder_bits = self.fingerprint_bits - quotient_bits
+        self.num_slots = 1 << quotient_bits
+        self._mask = self.num_slots - 1
+        self._remainder_mask = (1 << self.remainder_bits) - 1
+        self.slots = slots
+        self._mmap = mmap_
+        self._file = file_
+
+    @staticmethod
+    def _release_table(slots, mmap_, file_):
+        """Let go of a table that's no longer in use"""
+        if mmap_ is not None:
+            slots.release()
+            mmap_.close()
+            os.close(file_)
+
+    def __repr__(self):
+        return 'QuotientFilter(num_elements=%d, quotient_bits=%d, remainder_bits=%d)' % (
+            self.num_elements,
+            self.quotient_bits,
+            self.remainder_bits,
+        )
+
+    def __len__(self):
+        return self.num_elements
+
+    def load_factor(self):
+        """Return the fraction of slots in use"""
+        return self.num_elements / self.num_slots
+
+    def predicted_error_rate(self):
+        """Return the probability that an absent key is reported present, at our current load"""
+        return 1.0 - math.exp(-self.load_factor() / 2.0 ** self.remainder_bits)
+
+    def _split(self, key):
+        """Return the (quotient, remainder) of key"""
+        fingerprint_ = fingerprint(key, self.fingerprint_bits)
+        return fingerprint_ >> self.remainder_bits, fingerprint_ & self._remainder_mask
+
+    def _find_run_index(self, quotient):
+        """Return the slot where quotient's run starts, or would start"""
+        slots = self.slots
+        mask = self._mask
+        # Walk back to the start of the cluster, then forward a run per occupied quotient
+        cluster_slotno = quotient
+        while slots[cluster_slotno] & SHIFTED:
+            cluster_slotno = (cluster_slotno - 1) & mask
+        run_slotno = cluster_slotno
+        while cluster_slotno != quotient:
+            run_slotno = (run_slotno + 1) & mask
+            while slots[run_slotno] & CONTINUATION:
+                run_slotno = (run_slotno + 1) & mask
+            cluster_slotno = (cluster_slotno + 1) & mask
+            while not slots[cluster_slotno] & OCCUPIED:
+                cluster_slotno = (cluster_slotno + 1) & mask
+        return run_slotno
+
+    def _count(self, quotient, remainder, first_only=False):
+        """Return the number of times remainder appears in quotient's run"""
+        slots = self.slots
+        if not slots[quotient] & OCCUPIED:
+            return 0
+        mask = self._mask
+        slotno = self._find_run_index(quotient)
+        matches = 0
+        while True:
+            stored = slots[slotno] >> 3
+            if stored > remainder:
+                break
+            if stored == remainder:
+                matches += 1
+                if first_only:
+                    break
+            slotno = (slotno + 1) & mask
+            if not slots[slotno] & CONTINUATION:
+                break
+        return matches
+
+    def __contains__(self, key):
+        quotient, remainder = self._split(key)
+        return self._count(quotient, remainder, first_only=True) > 0
+
+    def count(self, key):
+        """Return how many times key (or a key with the same fingerprint) has been added and not removed"""
+        quotient, remainder = self._split(key)
+        return self._count(quotient, remainder)
+
+    def _insert_into(self, slotno, entry):
+        """Put entry at slotno, shifting everything up to the next empty slot one slot to the right"""
+        slots = self.slots
+        mask = self._mask
+        current = entry
+        while True:
+            previous = slots[slotno]
+            empty = not previous & METADATA
+            if not empty:
+                previous |= SHIFTED
+                # OCCUPIED describes the slot, not the remainder in it, so it stays put
+                if previous & OCCUPIED:
+                    current |= OCCUPIED
+                    previous ^= OCCUPIED
+            slots[slotno] = current
+            if empty:
+                return
+            current = previous
+            slotno = (slotno + 1) & mask
+
+    def _insert(self, quotient, remainder):
+        """Add one fingerprint"""
+        slots = self.slots
+        entry = remainder << 3
+        canonical = slots[quotient]
+        if not canonical & METADATA:
+            slots[quotient] = entry | OCCUPIED
+            self.num_elements += 1
+            return
+        was_occupied = canonical & OCCUPIED
+        if not was_occupied:
+            slots[quotient] = canonical | OCCUPIED
+        start = self._find_run_index(quotient)
+        slotno = start
+        if was_occupied:
+            # Keep the run sorted, with equal remainders after the ones already there
+            mask = self._mask
+            while slots[slotno] >> 3 <= remainder:
+                slotno = (slotno + 1) & mask
+                if not slots[slotno] & CONTINUATION:
+                    break
+            if slotno == start:
+                # We're the new head of the run, so the old head becomes a continuation
+                slots[start] |= CONTINUATION
+            else:
+                entry |= CONTINUATION
+        if slotno != quotient:
+            entry |= SHIFTED
+        self._insert_into(slotno, entry)
+        self.num_elements += 1
+
+    def add(self, key):
+        """Add an element, growing the table first if it's too full"""
+        if self.num_elements + 1 > self.max_load * self.num_slots and self.remainder_bits > 1:
+            self.resize()
+        if self.num_elements + 1 >= self.num_slots:
+            raise ValueError('QuotientFilter is full, and has no remainder bits left to grow with')
+        self._insert(*self._split(key))
+
+    def __iadd__(self, key):
+        self.add(key)
+        return self
+
+    def _delete_entry(self, slotno, quotient):
+        """Remove the entry at slotno, shifting the rest of its cluster one slot to the left"""
+        slots = self.slots
+        mask = self._mask
+        current = slots[slotno]
+        following_slotno = (slotno + 1) & mask
+        original_slotno = slotno
+        while True:
+            following = slots[following_slotno]
+            current_occupied = current & OCCUPIED
+            cluster_start = following & OCCUPIED and not following & (CONTINUATION | SHIFTED)
+            if not following & METADATA or cluster_start or following_slotno == original_slotno:
+                slots[slotno] = 0
+                return
+            updated = following
+            if not following & CONTINUATION:
+                # following starts a run; it's no longer shifted if it lands in its quotient's slot
+                quotient = (quotient + 1) & mask
+                while not slots[quotient] & OCCUPIED:
+                    quotient = (quotient + 1) & mask
+                if current_occupied and quotient == slotno:
+                    updated &= ~SHIFTED
+            slots[slotno] = (updated | OCCUPIED) if current_occupied else (updated & ~OCCUPIED)
+            slotno = following_slotno
+            following_slotno = (following_slotno + 1) & mask
+            current = following
+
+    def remove(self, key):
+        """Remove one copy of key; return False if it wasn't there"""
+        quotient, remainder = self._split(key)
+        slots = self.slots
+        mask = self._mask
+        if not slots[quotient] & OCCUPIED:
+            return False
+        slotno = self._find_run_index(quotient)
+        while True:
+            stored = slots[slotno] >> 3
+            if stored == remainder:
+                break
+            if stored > remainder:
+                return False
+            slotno = (slotno + 1) & mask
+            if not slots[slotno] & CONTINUATION:
+                return False
+
+        run_start = not slots[slotno] & CONTINUATION
+        if run_start and not slots[(slotno + 1) & mask] & CONTINUATION:
+            # That was the only entry of its run
+            slots[quotient] &= ~OCCUPIED
+        self._delete_entry(slotno, quotient)
+        if run_start:
+            following = slots[slotno]
+            updated = following & ~CONTINUATION
+            if slotno == quotient and updated & (OCCUPIED | SHIFTED):
+                # The new head of the run is in its quotient's slot
+                updated &= ~SHIFTED
+            if updated != following:
+                slots[slotno] = updated
+        self.num_elements -= 1
+        return True
+
+    def _load_sorted(self, fingerprints):
+        """Fill an empty table from ascending fingerprints, writing each slot once"""
+        slots = self.slots
+        remainder_bits = self.remainder_bits
+        remainder_mask = self._remainder_mask
+        next_free = 0
+        previous_quotient = None
+        for fingerprint_ in fingerprints:
+            quotient = fingerprint_ >> remainder_bits
+            remainder = fingerprint_ & remainder_mask
+            slotno = max(quotient, next_free)
+            if slotno >= self.num_slots:
+                # The last cluster runs off the end and wraps around: do the rest the usual way
+                self._insert(quotient, remainder)
+                continue
+            entry = remainder << 3
+            if quotient == previous_quotient:
+                entry |= CONTINUATION
+            if slotno != quotient:
+                entry |= SHIFTED
+            slots[slotno] = entry
+            slots[quotient] |= OCCUPIED
+            next_free = slotno + 1
+            previous_quotient = quotient
+            self.num_elements += 1
+
+    def _rebuild(self, quotient_bits, fingerprints):
+        """Replace our table with one of 2 ** quotient_bits slots holding the ascending fingerprints"""
+        old_table = self.slots, self._mmap, self._file
+        temp_path = None if self.filename is None else '%s.tmp' % self.filename
+        self._set_table(quotient_bits, *self._allocate(quotient_bits, self.fingerprint_bits - quotient_bits,
+                                                       temp_path))
+        self.num_elements = 0
+        self._load_sorted(fingerprints)
+        if temp_path is not None:
+            self._mmap.flush()
+            os.replace(temp_path, self.filename)
+        self._release_table(*old_table)
+
+    def fingerprints(self):
+        """Generate our fingerprints, in ascending order"""
+        return iter_fingerprints(self.slots, self.quotient_bits, self.remainder_bits)
+
+    def resize(self):
+        """
+        Double the number of slots, without needing the original keys: every fingerprint gives one bit of its
+        remainder to its quotient.  The error rate for what's already stored is unchanged, but each element added
+        from now on costs twice as much of it.
+        """
+        if self.remainder_bits <= 1:
+            raise ValueError('No remainder bits left to grow with')
+        self._rebuild(self.quotient_bits + 1, self.fingerprints())
+
+    def merge(self, other):
+        """Add every element of other, in one sorted pass over both tables, growing as needed"""
+        if other.fingerprint_bits != self.fingerprint_bits:
+            raise ValueError('Filters must have the same fingerprint_bits')
+        total = self.num_elements + other.num_elements
+        quotient_bits = max(self.quotient_bits, other.quotient_bits)
+        while total > self.max_load * (1 << quotient_bits) and self.fingerprint_bits - quotient_bits > 1:
+            quotient_bits += 1
+        if total >= 1 << quotient_bits:
+            raise ValueError('The merged filter would be too full')
+        self._rebuild(quotient_bits, heapq.merge(self.fingerprints(), other.fingerprints()))
+
+    def tobytes(self):
+        """Serialize the filter, in the same layout as the file of a file-backed filter"""
+        header = HEADER.pack(MAGIC, self.quotient_bits, self.remainder_bits, self.max_load)
+        slots = array.array(slot_typecode(self.remainder_bits), self.slots)
+        if sys.byteorder == 'big':
+            slots.byteswap()
+        return header + bytes(HEADER_BYTES - len(header)) + slots.tobytes()
+
+    @classmethod
+    def frombytes(cls, data):
+        """Return an in-memory filter from the output of tobytes(), or the contents of a filter's file"""
+        magic, quotient_bits, remainder_bits, max_load = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a serialized quotient filter')
+        slots = array.array(slot_typecode(remainder_bits))
+        slots.frombytes(bytes(data[HEADER_BYTES:]))
+        if sys.byteorder == 'big':
+            slots.byteswap()
+        if len(slots) != 1 << quotient_bits:
+            raise ValueError('Serialized quotient filter has the wrong length')
+        result = cls.__new__(cls)
+        result.filename = None
+        result.max_load = max_load
+        result.fingerprint_bits = quotient_bits + remainder_bits
+        result._set_table(quotient_bits, slots, None, None)
+        result.num_elements = sum(1 for slot in slots if slot & METADATA)
+        return result
+
+    def flush(self):
+        """Make sure a file-backed filter's changes have reached its file"""
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        """Flush and unmap a file-backed filter"""
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._release_table(self.slots, self._mmap, self._file)
+            self._mmap = self._file = None
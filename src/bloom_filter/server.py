@@ -0,0 +1,397 @@
+# coding=utf-8
+
+"""Host named bloom filters behind a Unix domain socket, so many local processes can share one warm copy"""
+
+# The protocol is deliberately small, so that a client in any language can speak it.
+#
+# Every message in either direction is a frame: a 4 byte big-endian length followed by that many bytes of payload.
+#
+# A request payload is:
+#   1 byte opcode (OP_ADD, OP_CHECK or OP_STATS)
+#   2 byte big-endian length of the filter name, then the name in utf-8
+#   4 byte big-endian count of keys, then for each key a 4 byte big-endian length and the key's bytes
+#   (OP_STATS sends a count of 0)
+# A key whose length has its top bit (KEY_STR_FLAG) set is a str, sent as utf-8, and the server decodes it before
+# hashing: a BloomFilter hashes a str differently from its utf-8 bytes, so this keeps a str key added locally and
+# checked over the socket, or the other way round, giving the same answer.
+#
+# A response payload is 1 byte of status (STATUS_OK or STATUS_ERROR) followed by:
+#   OP_ADD: nothing
+#   OP_CHECK: one byte per key, 1 if the key is (probably) present, 0 if it's definitely absent
+#   OP_STATS: a utf-8 JSON object
+#   STATUS_ERROR: a utf-8 error message
+#
+# Clients may pipeline: send any number of requests before reading responses.  Responses on a connection come
+# back in request order.
+#
+# Requests run one at a time on a worker thread rather than on the event loop, so a filter waiting on its file
+# doesn't stop the server reading and answering other connections meanwhile.  One at a time, because filters aren't
+# safe to change from several threads at once.
+
+import os
+import json
+import queue
+import socket
+import struct
+import asyncio
+import threading
+import contextlib
+import concurrent.futures
+
+from .bloom_filter import BloomFilter
+
+OP_ADD = 1
+OP_CHECK = 2
+OP_STATS = 3
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+MAX_FRAME_BYTES = 2 ** 30
+
+KEY_STR_FLAG = 0x80000000
+
+_LENGTH = struct.Struct('>I')
+_HEADER = struct.Struct('>BH')
+
+
+class ProtocolError(Exception):
+    """Raised when a frame can't be decoded, or the connection breaks mid-frame"""
+    pass
+
+
+class ServerError(ProtocolError):
+    """Raised when the server answers a request with an error; the connection remains usable"""
+    pass
+
+
+def encode_request(opcode, name, keys=()):
+    """Build one request frame"""
+    name_bytes = name.encode('utf-8')
+    parts = [_HEADER.pack(opcode, len(name_bytes)), name_bytes, _LENGTH.pack(len(keys))]
+    for key in keys:
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+            parts.append(_LENGTH.pack(len(key) | KEY_STR_FLAG))
+        else:
+            parts.append(_LENGTH.pack(len(key)))
+        parts.append(key)
+    payload = b''.join(parts)
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def decode_request(payload):
+    """Split a request payload into (opcode, name, keys)"""
+    try:
+        opcode, name_length = _HEADER.unpack_from(payload, 0)
+        offset = _HEADER.size
+        name = bytes(payload[offset:offset + name_length]).decode('utf-8')
+        offset += name_length
+        (count,) = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        keys = []
+        for dummy in range(count):
+            (key_length,) = _LENGTH.unpack_from(payload, offset)
+            offset += _LENGTH.size
+            is_str = key_length & KEY_STR_FLAG
+            key_length &= ~KEY_STR_FLAG
+            key = bytes(payload[offset:offset + key_length])
+            keys.append(key.decode('utf-8') if is_str else key)
+            offset += key_length
+    except (struct.error, UnicodeDecodeError) as exc:
+        raise ProtocolError('malformed request: %s' % exc)
+    if offset != len(payload):
+        raise ProtocolError('malformed request: %d trailing bytes' % (len(payload) - offset))
+    return opcode, name, keys
+
+
+def _add_many(bloom, keys):
+    """Add keys to bloom, one at a time if it has no add_many()"""
+    if hasattr(bloom, 'add_many'):
+        bloom.add_many(keys)
+    else:
+        for key in keys:
+            bloom.add(key)
+
+
+def _contains_many(bloom, keys):
+    """Return a list of bools saying whether each of keys is (probably) in bloom"""
+    if hasattr(bloom, 'contains_many'):
+        return bloom.contains_many(keys)
+    return [key in bloom for key in keys]
+
+
+def _frame(status, body=b''):
+    """Build one response frame"""
+    return _LENGTH.pack(len(body) + 1) + bytes([status]) + body
+
+
+class BloomFilterServer(object):
+    """Serve a dict of named BloomFilters (with any backend) over a Unix domain socket, using asyncio"""
+
+    def __init__(self, socket_path, filters):
+        self.socket_path = socket_path
+        self.filters = dict(filters)
+        self.requests_served = 0
+        self.keys_served = 0
+        self._server = None
+        self._executor = None
+
+    def handle_request(self, payload):
+        """Execute one request payload, returning the response frame"""
+        try:
+            opcode, name, keys = decode_request(payload)
+            try:
+                bloom = self.filters[name]
+            except KeyError:
+                raise ProtocolError('no such filter: %s' % name)
+            if opcode == OP_ADD:
+                _add_many(bloom, keys)
+                body = b''
+            elif opcode == OP_CHECK:
+                body = bytes(_contains_many(bloom, keys))
+            elif opcode == OP_STATS:
+                body = json.dumps(self.stats(name)).encode('utf-8')
+            else:
+                raise ProtocolError('unknown opcode: %d' % opcode)
+        except Exception as exc:  # pylint: disable=W0703
+            # Whatever the hosted filter raised, answer with it, so the requests pipelined behind this one still get
+            # their answers
+            return _frame(STATUS_ERROR, str(exc).encode('utf-8'))
+        self.requests_served += 1
+        self.keys_served += len(keys)
+        return _frame(STATUS_OK, body)
+
+    def stats(self, name):
+        """Describe filter name, plus some server-wide counters"""
+        bloom = self.filters[name]
+        # Filters that manage their own storage, like TieredBloomFilter, have no single backend, and may not know
+        # every one of these; report None for what they don't
+        return {
+            'name': name,
+            'backend': type(getattr(bloom, 'backend', bloom)).__name__,
+            'ideal_num_elements_n': getattr(bloom, 'ideal_num_elements_n', None),
+            'error_rate_p': getattr(bloom, 'error_rate_p', None),
+            'num_bits_m': getattr(bloom, 'num_bits_m', None),
+            'num_probes_k': getattr(bloom, 'num_probes_k', None),
+            'requests_served': self.requests_served,
+            'keys_served': self.keys_served,
+        }
+
+    def close_filters(self):
+        """Close every hosted filter: through its own close() if it has one, otherwise through its backend's, if any"""
+        for bloom in self.filters.values():
+            if hasattr(bloom, 'close'):
+                bloom.close()
+            elif hasattr(bloom, 'backend'):
+                bloom.backend.close()
+
+    async def _serve_connection(self, reader, writer):
+        """Answer requests on one connection, in order, until the client hangs up"""
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_LENGTH.size)
+                except asyncio.IncompleteReadError:
+                    break
+                (length,) = _LENGTH.unpack(header)
+                if length > MAX_FRAME_BYTES:
+                    writer.write(_frame(STATUS_ERROR, b'frame too large'))
+                    break
+                payload = await reader.readexactly(length)
+                response = await asyncio.get_running_loop().run_in_executor(self._executor, self.handle_request,
+                                                                            payload)
+                writer.write(response)
+                # drain() only blocks once the write buffer is past its high-water mark, so pipelined requests
+                # keep flowing
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Start listening; returns once the socket is bound"""
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='bloom-filter-server')
+        self._server = await asyncio.start_unix_server(self._serve_connection, path=self.socket_path)
+
+    async def serve_forever(self):
+        """Start listening and serve until cancelled"""
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        """Stop listening and remove the socket"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+
+def _recv_exactly(sock, length):
+    """Read exactly length bytes from a blocking socket"""
+    buffer_ = bytearray(length)
+    view = memoryview(buffer_)
+    offset = 0
+    while offset < length:
+        received = sock.recv_into(view[offset:])
+        if not received:
+            raise ProtocolError('server closed the connection')
+        offset += received
+    return buffer_
+
+
+def _recv_response(sock):
+    """Read one response frame; return its body, or raise ServerError if the server reported an error"""
+    (length,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    payload = _recv_exactly(sock, length)
+    if payload[0] != STATUS_OK:
+        raise ServerError(bytes(payload[1:]).decode('utf-8', 'replace'))
+    return bytes(payload[1:])
+
+
+class BloomFilterClient(object):
+    """A blocking client for BloomFilterServer, keeping a pool of connections so it can be shared by threads"""
+
+    def __init__(self, socket_path, pool_size=4):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._num_connections = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open a new connection to the server"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        return sock
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Borrow a connection from the pool, opening one if the pool isn't full yet"""
+        try:
+            sock = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                may_open = self._num_connections < self.pool_size
+                if may_open:
+                    self._num_connections += 1
+            if may_open:
+                try:
+                    sock = self._connect()
+                except OSError:
+                    self._forget_connection()
+                    raise
+            else:
+                sock = self._pool.get()
+        try:
+            yield sock
+        except ServerError:
+            self._pool.put(sock)
+            raise
+        except BaseException:
+            # We might have been interrupted mid-frame, so this connection can't be trusted any more
+            sock.close()
+            self._forget_connection()
+            raise
+        else:
+            self._pool.put(sock)
+
+    def _forget_connection(self):
+        """Account for a connection that has been closed"""
+        with self._lock:
+            self._num_connections -= 1
+
+    def pipeline(self, requests):
+        """
+        Send a list of (opcode, name, keys) requests in one go, then collect all the responses.
+        Returns a list of response bodies, in request order.
+        """
+        with self._connection() as sock:
+            sock.sendall(b''.join(encode_request(opcode, name, keys) for opcode, name, keys in requests))
+            results = []
+            error = None
+            for dummy in requests:
+                try:
+                    results.append(_recv_response(sock))
+                except ServerError as exc:
+                    # Keep reading, so the connection stays in sync for the next user
+                    error = error or exc
+                    results.append(None)
+            if error is not None:
+                raise error
+            return results
+
+    def add(self, name, keys):
+        """Add a batch of keys (bytes or str) to filter name"""
+        self.pipeline([(OP_ADD, name, keys)])
+
+    def check(self, name, keys):
+        """Return a list of bools, one per key, saying whether each key is (probably) in filter name"""
+        (body,) = self.pipeline([(OP_CHECK, name, keys)])
+        return [bool(byte) for byte in body]
+
+    def check_batches(self, name, batches):
+        """Check many batches of keys with one round trip, returning a list of lists of bools"""
+        bodies = self.pipeline([(OP_CHECK, name, keys) for keys in batches])
+        return [[bool(byte) for byte in body] for body in bodies]
+
+    def stats(self, name):
+        """Return the server's description of filter name, as a dict"""
+        (body,) = self.pipeline([(OP_STATS, name, ())])
+        return json.loads(body.decode('utf-8'))
+
+    def close(self):
+        """Close all pooled connections"""
+        while True:
+            try:
+                sock = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            sock.close()
+            self._forget_connection()
+
+
+def parse_filter_spec(spec):
+    """Parse a name:max_elements:error_rate[:filename[:max_bytes_in_memory]] command line filter spec"""
+    fields = spec.split(':')
+    if not 3 <= len(fields) <= 5:
+        raise ValueError('filter spec should be name:max_elements:error_rate[:filename[:max_bytes]]: %s' % spec)
+    name = fields[0]
+    filename = None
+    if len(fields) >= 4:
+        filename = fields[3]
+        if len(fields) == 5:
+            filename = (filename, int(fields[4]))
+    return name, BloomFilter(max_elements=int(fields[1]), error_rate=float(fields[2]), filename=filename)
+
+
+def main(argv=None):
+    """Run a server from the command line"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve bloom filters over a Unix domain socket')
+    parser.add_argument('--socket', required=True, help='path of the Unix domain socket to listen on')
+    parser.add_argument('--filter', action='append', required=True, dest='filters',
+                        help='name:max_elements:error_rate[:filename[:max_bytes_in_memory]]; may be repeated')
+    args = parser.parse_args(argv)
+
+    server = BloomFilterServer(args.socket, [parse_filter_spec(spec) for spec in args.filters])
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close_filters()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# coding=utf-8
+
+"""Tiered bloom filters: inserts land in an in-memory delta, which is merged into the disk filter in one pass"""
+
+# Adding a key to a file-backed filter costs num_probes_k random read-modify-writes of single bytes.  A
+# TieredBloomFilter instead sets the key's bits in a delta: an in-memory filter with the same template as the disk
+# filter, using the sparse backend with OS-page-sized pages, so it only takes memory for the pages inserts touched.
+# Once the delta's pages pass delta_bytes, they are ORed into the disk filter in ascending order, a run of adjacent
+# pages at a time - one sequential pass over the file instead of millions of scattered writes.
+#
+# A lookup asks the deltas first, and only goes to disk for the probe bits they don't have.  That is the same
+# answer the merged filter will give, so merging never changes what a key looks like.
+#
+# With background_merge, a full delta is handed to a merging thread and a fresh delta takes the inserts; lookups
+# consult both until the merge finishes.  If the next delta fills before that, inserts wait for it.
+
+import threading
+
+from .bloom_filter import (
+    BloomFilter,
+    Sparse_array_backend,
+    MERGE_BLOCK_BYTES,
+    get_filter_bitno_probes,
+)
+from .checkpoint import page_runs
+
+DELTA_PAGE_BYTES = 2 ** 12
+
+
+class TieredBloomFilter(object):
+    # pylint: disable=R0902
+    # R0902: We kinda need a bunch of instance attributes
+    """
+    A disk-backed BloomFilter (filename as for BloomFilter) that buffers inserts in memory.  The buffer is merged
+    into the disk filter whenever it passes delta_bytes, in a background thread if background_merge is true, and
+    on merge() and close().
+    """
+
+    def __init__(self,
+                 filename,
+                 max_elements=10000,
+                 error_rate=0.1,
+                 probe_bitnoer=get_filter_bitno_probes,
+                 start_fresh=False,
+                 delta_bytes=2 ** 24,
+                 background_merge=False):
+        # pylint: disable=R0913
+        # R0913: We want a few arguments
+        if delta_bytes < DELTA_PAGE_BYTES:
+            raise ValueError('delta_bytes must be at least %d' % DELTA_PAGE_BYTES)
+        self.disk = BloomFilter(
+            max_elements=max_elements,
+            error_rate=error_rate,
+            probe_bitnoer=probe_bitnoer,
+            filename=filename,
+            start_fresh=start_fresh,
+        )
+        self.delta_bytes = delta_bytes
+        self.background_merge = background_merge
+        self.merges = 0
+
+        self._lock = threading.Lock()
+        # Serializes access to the disk backend, whose file position is shared between merges and lookups
+        self._disk_lock = threading.Lock()
+        self._delta = self._new_delta()
+        self._merging = None
+        self._merger = None
+
+    def _new_delta(self):
+        """Return an empty in-memory filter with the disk filter's template"""
+        return self.disk._with_backend(Sparse_array_backend(self.disk.num_bits_m, page_bytes=DELTA_PAGE_BYTES))
+
+    @property
+    def num_bits_m(self):
+        """The number of bits in the filter"""
+        return self.disk.num_bits_m
+
+    @property
+    def num_probes_k(self):
+        """The number of probes per key"""
+        return self.disk.num_probes_k
+
+    def _set_bits(self, bitnos):
+        """Set bitnos in the current delta, rotating it out if it is now full"""
+        with self._lock:
+            self._set_bits_locked(bitnos)
+
+    def _set_bits_locked(self, bitnos):
+        """Set bitnos in the current delta, rotating it out if it is now full; lock must be held"""
+        backend = self._delta.backend
+        backend.set_many(bitnos)
+        if backend.resident_bytes() >= self.delta_bytes:
+            self._rotate()
+
+    def add(self, key):
+        """Add an element to the filter"""
+        self._set_bits(list(self.disk.probe_bitnoer(self.disk, key)))
+
+    def __iadd__(self, key):
+        self.add(key)
+        return self
+
+    def __contains__(self, key):
+        deltas = [delta for delta in (self._delta, self._merging) if delta is not None]
+        missing = [
+            bitno for bitno in self.disk.probe_bitnoer(self.disk, key)
+            if not any(delta.backend.is_set(bitno) for delta in deltas)
+        ]
+        if not missing:
+            return True
+        with self._disk_lock:
+            return all(self.disk.backend.is_set(bitno) for bitno in missing)
+
+    def add_many(self, keys):
+        """Add many elements"""
+        self._set_bits([bitno for key in keys for bitno in self.disk.probe_bitnoer(self.disk, key)])
+
+    def contains_many(self, keys, fadvise=False):
+        """Return a list of bools, one per key; probes the deltas lack are read from disk in one coalesced pass"""
+        deltas = [delta for delta in (self._delta, self._merging) if delta is not None]
+        probes = [list(self.disk.probe_bitnoer(self.disk, key)) for key in keys]
+        missing = sorted(set(
+            bitno for key_probes in probes for bitno in key_probes
+            if not any(delta.backend.is_set(bitno) for delta in deltas)
+        ))
+        with self._disk_lock:
+            on_disk = self.disk.backend.is_set_many(missing, fadvise=fadvise)
+        unset = set(bitno for bitno, is_set in zip(missing, on_disk) if not is_set)
+        return [not unset.intersection(key_probes) for key_probes in probes]
+
+    def add_if_absent(self, key):
+        """Add key; return true iff it wasn't already (probably) in the filter.  Atomic with respect to other adds."""
+        return self.add_if_absent_many([key])[0]
+
+    def add_if_absent_many(self, keys):
+        """
+        add_if_absent() each of keys in turn, returning a list of bools.  Probes the deltas lack are read from disk in
+        one coalesced pass, and only the bits that were newly set go into the delta.
+        """
+        probes = [list(self.disk.probe_bitnoer(self.disk, key)) for key in keys]
+        with self._lock:
+            deltas = [delta for delta in (self._delta, self._merging) if delta is not None]
+            missing = sorted(set(
+                bitno for key_probes in probes for bitno in key_probes
+                if not any(delta.backend.is_set(bitno) for delta in deltas)
+            ))
+            with self._disk_lock:
+                on_disk = self.disk.backend.is_set_many(missing)
+            unset = set(bitno for bitno, is_set in zip(missing, on_disk) if not is_set)
+            results = []
+            newly_set = []
+            for key_probes in probes:
+                key_unset = unset.intersection(key_probes)
+                unset -= key_unset
+                newly_set.extend(key_unset)
+                results.append(bool(key_unset))
+            self._set_bits_locked(newly_set)
+        return results
+
+    def pending_bytes(self):
+        """Return the memory the unmerged inserts are using, in bytes"""
+        deltas = [delta for delta in (self._delta, self._merging) if delta is not None]
+        return sum(delta.backend.resident_bytes() for delta in deltas)
+
+    def _rotate(self):
+        """Start merging the current delta, and give inserts a fresh one; lock must be held"""
+        delta = self._delta
+        if not self.background_merge:
+            self._merge_into_disk(delta)
+            self._delta = self._new_delta()
+            return
+        self._wait_for_merger()
+        self._merging = delta
+        self._delta = self._new_delta()
+        self._merger = threading.Thread(target=self._merge_in_background, args=(delta,), name='bloom-filter-merge')
+        self._merger.daemon = True
+        self._merger.start()
+
+    def _merge_in_background(self, delta):
+        """Body of the merging thread"""
+        self._merge_into_disk(delta)
+        # Only now that the disk has every bit may lookups stop asking this delta
+        self._merging = None
+
+    def _wait_for_merger(self):
+        """Wait for a background merge, if there is one, to finish"""
+        if self._merger is not None:
+            self._merger.join()
+            self._merger = None
+
+    def _merge_into_disk(self, delta):
+        """OR delta into the disk filter, visiting its pages in ascending order, a run of adjacent pages at a time"""
+        backend = delta.backend
+        disk_backend = self.disk.backend
+        for first_pageno, last_pageno in page_runs(sorted(backend.pages)):
+            start = first_pageno * backend.page_bytes
+            end = min(last_pageno * backend.page_bytes, backend.num_chars)
+            for byteno in range(start, end, MERGE_BLOCK_BYTES):
+                length = min(MERGE_BLOCK_BYTES, end - byteno)
+                theirs = int.from_bytes(backend.read_block(byteno, length), 'little')
+                with self._disk_lock:
+                    ours = int.from_bytes(disk_backend.read_block(byteno, length), 'little')
+                    disk_backend.write_block(byteno, (ours | theirs).to_bytes(length, 'little'))
+        self.merges += 1
+
+    def merge(self):
+        """Merge every pending insert into the disk filter now, on this thread"""
+        with self._lock:
+            self._wait_for_merger()
+            if self._delta.backend.pages:
+                self._merge_into_disk(self._delta)
+                self._delta = self._new_delta()
+
+    def close(self):
+        """Merge pending inserts and close the disk filter"""
+        self.merge()
+        self.disk.backend.close()
@@ -6,7 +6,8 @@
 
 """Unit tests for bloom_filter_mod"""
 
-# mport os
+import io
+import os
 import sys
 import math
 import time
@@ -16,9 +17,24 @@ try:
 except ImportError:
     import dbm as anydbm
 
+import dbm.dumb as dbm_dumb
+
+import uuid
+import array
+import pickle
 import random
+import shutil
+import struct
+import asyncio
+import datetime
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
 
 import bloom_filter
+from bloom_filter import server as server_mod
+from bloom_filter import columnar as columnar_mod
 
 CHARACTERS = 'abcdefghijklmnopqrstuvwxyz1234567890'
 
@@ -268,6 +284,1651 @@ def or_test():
     return all_good
 
 
+def sparse_test():
+    """Test the lazily-allocated sparse backend, including unions with the dense array backend"""
+
+    all_good = True
+
+    sparse = bloom_filter.BloomFilter(max_elements=1000000, error_rate=0.01, backend='sparse')
+    if sparse.backend.resident_bytes() != 0:
+        sys.stderr.write('sparse backend allocated pages before any write\n')
+        all_good = False
+    if 'a' in sparse:
+        sys.stderr.write('a in empty sparse filter, but should not be\n')
+        all_good = False
+    if sparse.backend.resident_bytes() != 0:
+        sys.stderr.write('sparse backend allocated pages on read\n')
+        all_good = False
+
+    for character in ['a', 'b', 'c']:
+        sparse += character
+    resident = sparse.backend.resident_bytes()
+    if not 0 < resident < (sparse.num_bits_m + 7) // 8:
+        sys.stderr.write('sparse backend resident size unexpected: %d\n' % resident)
+        all_good = False
+    if sparse.backend.popcount() != sum(sparse.backend.page_popcount(pageno) for pageno in sparse.backend.pages):
+        sys.stderr.write('sparse backend popcount disagrees with page popcounts\n')
+        all_good = False
+
+    dense = bloom_filter.BloomFilter(max_elements=1000000, error_rate=0.01)
+    for character in ['b', 'c', 'd']:
+        dense += character
+
+    sparse_or_dense = bloom_filter.BloomFilter(max_elements=1000000, error_rate=0.01, backend='sparse')
+    sparse_or_dense |= sparse
+    sparse_or_dense |= dense
+    for character in ['a', 'b', 'c', 'd']:
+        if character not in sparse_or_dense:
+            sys.stderr.write('%s not in sparse_or_dense, but should be\n' % character)
+            all_good = False
+
+    dense |= sparse
+    if 'a' not in dense:
+        sys.stderr.write('a not in dense after union with sparse, but should be\n')
+        all_good = False
+
+    sparse &= dense
+    if 'a' not in sparse or 'd' in sparse:
+        sys.stderr.write('sparse intersection with dense is wrong\n')
+        all_good = False
+
+    return all_good
+
+
+def freeze_test():
+    """Test FrozenBloomFilter"""
+
+    all_good = True
+
+    bloom = bloom_filter.BloomFilter(max_elements=100, error_rate=0.01)
+    for character in ['a', 'b', 'c']:
+        bloom += character
+
+    frozen = bloom.freeze()
+    for character in ['a', 'b', 'c']:
+        if character not in frozen:
+            sys.stderr.write('%s not in frozen, but should be\n' % character)
+            all_good = False
+    if 'd' in frozen:
+        sys.stderr.write('d in frozen, but should not be\n')
+        all_good = False
+
+    try:
+        frozen.num_bits_m = 1
+    except AttributeError:
+        pass
+    else:
+        sys.stderr.write('frozen filter allowed an attribute to be set\n')
+        all_good = False
+
+    # Later additions to the live filter must not show through, and equal content must hash equal
+    bloom += 'd'
+    if 'd' in frozen:
+        sys.stderr.write('d in frozen after adding it to the live filter\n')
+        all_good = False
+    sparse = bloom_filter.BloomFilter(max_elements=100, error_rate=0.01, backend='sparse')
+    for character in ['a', 'b', 'c', 'd']:
+        sparse += character
+    if bloom.freeze() != sparse.freeze() or len(set([bloom.freeze(), sparse.freeze(), frozen])) != 2:
+        sys.stderr.write('frozen filters with the same content compare unequal\n')
+        all_good = False
+
+    return all_good
+
+
+def server_test():
+    """Test the Unix domain socket filter server and its client"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    try:
+        socket_path = os.path.join(directory, 'bloom.sock')
+        bloom = bloom_filter.BloomFilter(max_elements=100, error_rate=0.01)
+        tiered = bloom_filter.TieredBloomFilter(os.path.join(directory, 'tiered'), max_elements=100, error_rate=0.01,
+                                                start_fresh=True)
+        durable = bloom_filter.DurableBloomFilter(os.path.join(directory, 'durable'), max_elements=100,
+                                                  error_rate=0.01)
+        server = server_mod.BloomFilterServer(socket_path, {
+            'states': bloom,
+            'frozen': bloom.freeze(),
+            'tiered': tiered,
+            'durable': durable,
+        })
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start())
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+        client = server_mod.BloomFilterClient(socket_path, pool_size=2)
+        try:
+            client.add('states', ['Alabama', b'Alaska'])
+            if client.check('states', ['Alabama', 'Alaska', 'Arizona']) != [True, True, False]:
+                sys.stderr.write('server check gave the wrong answer\n')
+                all_good = False
+            if client.check_batches('states', [['Alabama'], ['Arizona'], []]) != [[True], [False], []]:
+                sys.stderr.write('server pipelined check gave the wrong answer\n')
+                all_good = False
+            if 'Alaska' not in bloom:
+                sys.stderr.write('server did not add to the hosted filter\n')
+                all_good = False
+            stats = client.stats('states')
+            if stats['num_bits_m'] != bloom.num_bits_m or stats['keys_served'] != 7:
+                sys.stderr.write('server stats are wrong: %r\n' % (stats,))
+                all_good = False
+            # str keys hash the same locally and over the socket, even when they aren't ASCII
+            bloom.add('Añasco')
+            client.add('states', ['Mayagüez'])
+            if client.check('states', ['Añasco']) != [True] or 'Mayagüez' not in bloom:
+                sys.stderr.write('server hashed str keys differently from a local filter\n')
+                all_good = False
+            for name, hosted in [('tiered', tiered), ('durable', durable)]:
+                client.add(name, ['Alabama', b'Alaska', 'Añasco'])
+                if client.check(name, ['Alabama', 'Alaska', 'Añasco', 'Arizona']) != [True, True, True, False] or \
+                        'Añasco' not in hosted:
+                    sys.stderr.write('server gave the wrong answer for a %s filter\n' % name)
+                    all_good = False
+                stats = client.stats(name)
+                if stats['backend'] != type(hosted).__name__:
+                    sys.stderr.write('server stats are wrong for a %s filter: %r\n' % (name, stats))
+                    all_good = False
+            try:
+                client.check('no-such-filter', ['Alabama'])
+            except server_mod.ServerError:
+                pass
+            else:
+                sys.stderr.write('server did not report a missing filter\n')
+                all_good = False
+            # The connection that saw the error must still be in sync
+            if client.check('states', ['Alabama']) != [True]:
+                sys.stderr.write('server connection out of sync after an error\n')
+                all_good = False
+            # A filter raising something unexpected must not cost the requests pipelined behind it their answers
+            single = server_mod.BloomFilterClient(socket_path, pool_size=1)
+            try:
+                try:
+                    single.pipeline([
+                        (server_mod.OP_ADD, 'frozen', ['Arizona']),
+                        (server_mod.OP_CHECK, 'states', ['Alabama']),
+                    ])
+                except server_mod.ServerError:
+                    pass
+                else:
+                    sys.stderr.write('server did not report a failing filter\n')
+                    all_good = False
+                if single.check('states', ['Alabama', 'Arizona']) != [True, False]:
+                    sys.stderr.write('server dropped the connection after a failing filter\n')
+                    all_good = False
+            finally:
+                single.close()
+        finally:
+            client.close()
+            asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            server.close_filters()
+    finally:
+        shutil.rmtree(directory)
+
+    return all_good
+
+
+def checkpoint_test():
+    """Test incremental checkpoints of the in-memory backends"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'checkpoint')
+
+    for backend in [None, 'sparse']:
+        bloom = bloom_filter.BloomFilter(max_elements=100000, error_rate=0.01, backend=backend)
+        for state in States.states[:25]:
+            bloom.add(state)
+        bloom.checkpoint(path)
+
+        for state in States.states[25:]:
+            bloom.add(state)
+        pages_written = bloom.checkpoint(path)
+        if not 0 < pages_written <= bloom.num_probes_k * (len(States.states) - 25):
+            sys.stderr.write('incremental checkpoint wrote %d pages\n' % pages_written)
+            all_good = False
+
+        restored = bloom_filter.BloomFilter.from_checkpoint(path, backend=backend)
+        if restored.freeze() != bloom.freeze():
+            sys.stderr.write('checkpoint did not restore the same filter for backend %s\n' % backend)
+            all_good = False
+
+        # Once a bit has been cleared, we must not be able to tear the file, so the whole thing gets rewritten
+        restored.backend.clear(0)
+        if restored.checkpoint(path) != restored.backend.num_pages:
+            sys.stderr.write('checkpoint after a clear was not a full rewrite\n')
+            all_good = False
+
+    # A torn write of the newest header slot must leave the previous generation in charge
+    restored.add('Puerto Rico')
+    restored.checkpoint(path)
+    generation = bloom_filter.checkpoint.read_checkpoint(path)[0]
+    file_ = os.open(path, os.O_RDWR)
+    os.pwrite(file_, b'torn', generation % 2 * bloom_filter.checkpoint.SLOT_BYTES + 8)
+    os.close(file_)
+    if bloom_filter.checkpoint.read_checkpoint(path)[0] != generation - 1:
+        sys.stderr.write('checkpoint header picked a torn slot\n')
+        all_good = False
+
+    # A key added while a checkpoint is writing its pages must make it into the next checkpoint
+    module = bloom_filter.checkpoint
+    bloom = bloom_filter.BloomFilter(max_elements=100000, error_rate=0.01)
+    bloom.add('Alabama')
+    bloom.checkpoint(path)
+    original_commit = module._commit
+
+    def commit(file_, generation, template):
+        """Add a key once the pages have been written, before the checkpoint is committed"""
+        bloom.add('Puerto Rico')
+        original_commit(file_, generation, template)
+
+    bloom.add('Alaska')
+    module._commit = commit
+    try:
+        bloom.checkpoint(path)
+    finally:
+        module._commit = original_commit
+    bloom.checkpoint(path)
+    if 'Puerto Rico' not in bloom_filter.BloomFilter.from_checkpoint(path):
+        sys.stderr.write('a key added during a checkpoint was missing from the next one\n')
+        all_good = False
+
+    # The hybrid backend writes its dirty in-memory pages back on close
+    filename = (os.path.join(directory, 'hybrid'), 2 ** 20)
+    hybrid = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, filename=filename, start_fresh=True)
+    hybrid.add('Alabama')
+    hybrid.backend.close()
+    hybrid = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, filename=filename)
+    if 'Alabama' not in hybrid:
+        sys.stderr.write('hybrid backend lost its in-memory bits on close\n')
+        all_good = False
+    hybrid.backend.close()
+
+    return all_good
+
+
+def insert_log_test():
+    """Test DurableBloomFilter's log replay, torn-tail recovery and compaction"""
+
+    all_good = True
+
+    path = os.path.join(tempfile.mkdtemp(), 'durable')
+
+    durable = bloom_filter.DurableBloomFilter(path, max_elements=1000, error_rate=0.01, batch_size=10,
+                                              fsync_interval=0, compact_bytes=2 ** 30)
+    for state in States.states:
+        durable.add(state)
+    durable.flush()
+    log_bytes = durable.log_bytes()
+    # Simulate a crash: leave the log as it is, without closing, plus a torn record at its end
+    file_ = os.open(durable.log_path, os.O_WRONLY | os.O_APPEND)
+    os.write(file_, b'\xff\x00\x00\x00torn')
+    os.close(file_)
+
+    reopened = bloom_filter.DurableBloomFilter(path, max_elements=1000, error_rate=0.01)
+    if reopened.inserts_replayed != len(States.states) or reopened.log_bytes() != log_bytes:
+        sys.stderr.write('insert log replayed %d inserts\n' % reopened.inserts_replayed)
+        all_good = False
+    if not all(state in reopened for state in States.states):
+        sys.stderr.write('insert log replay lost inserts\n')
+        all_good = False
+
+    reopened.compact()
+    reopened.add('Puerto Rico')
+    reopened.close()
+
+    compacted = bloom_filter.DurableBloomFilter(path, max_elements=1000, error_rate=0.01)
+    if compacted.inserts_replayed != 1:
+        sys.stderr.write('insert log was not emptied by compaction\n')
+        all_good = False
+    if not all(state in compacted for state in States.states + ['Puerto Rico']):
+        sys.stderr.write('compaction lost inserts\n')
+        all_good = False
+    compacted.close()
+
+    # Inserts that never fill a batch must still be fsynced within fsync_interval, with no further calls
+    idle_path = os.path.join(os.path.dirname(path), 'idle')
+    idle = bloom_filter.DurableBloomFilter(idle_path, max_elements=1000, error_rate=0.01, batch_size=1000,
+                                           fsync_interval=0.1)
+    for number in range(100):
+        idle.add('idle key %d' % number)
+    time.sleep(1)
+    # Reopen without closing, as after a crash
+    recovered = bloom_filter.DurableBloomFilter(idle_path, max_elements=1000, error_rate=0.01)
+    if recovered.inserts_replayed != 100:
+        sys.stderr.write('an idle insert log recovered %d of 100 inserts\n' % recovered.inserts_replayed)
+        all_good = False
+    recovered.close()
+    idle.close()
+
+    # Inserts made while a background compaction writes the snapshot end up in the snapshot or the log
+    busy_path = os.path.join(os.path.dirname(path), 'busy')
+    busy = bloom_filter.DurableBloomFilter(busy_path, max_elements=100000, error_rate=0.01, batch_size=16,
+                                           fsync_interval=0, compact_bytes=2 ** 12, background_compaction=True)
+    keys = ['busy key %d' % number for number in range(5000)]
+    for key in keys:
+        busy.add(key)
+    busy.close()
+    reopened = bloom_filter.DurableBloomFilter(busy_path, max_elements=100000, error_rate=0.01)
+    if not all(key in reopened for key in keys):
+        sys.stderr.write('background compaction lost inserts\n')
+        all_good = False
+    reopened.close()
+    # Closing twice is harmless
+    reopened.close()
+
+    # Adds must not wait for a group commit's fsync
+    stalled_path = os.path.join(os.path.dirname(path), 'stalled')
+    stalled = bloom_filter.DurableBloomFilter(stalled_path, max_elements=1000, error_rate=0.01, batch_size=1000,
+                                              fsync_interval=60)
+    stalled.add('before the fsync')
+    in_fsync = threading.Event()
+    release_fsync = threading.Event()
+    original_fsync = os.fsync
+
+    def slow_fsync(file_):
+        """fsync, but only once the test lets us"""
+        in_fsync.set()
+        release_fsync.wait(10)
+        original_fsync(file_)
+
+    os.fsync = slow_fsync
+    flusher = threading.Thread(target=stalled.flush)
+    try:
+        flusher.start()
+        in_fsync.wait(10)
+        adder = threading.Thread(target=stalled.add, args=('during the fsync',))
+        adder.start()
+        adder.join(5)
+        if adder.is_alive():
+            sys.stderr.write('DurableBloomFilter.add waited for an fsync\n')
+            all_good = False
+    finally:
+        release_fsync.set()
+        flusher.join()
+        os.fsync = original_fsync
+    adder.join()
+    stalled.close()
+    reopened = bloom_filter.DurableBloomFilter(stalled_path, max_elements=1000, error_rate=0.01)
+    if 'before the fsync' not in reopened or 'during the fsync' not in reopened:
+        sys.stderr.write('inserts made during an fsync were lost\n')
+        all_good = False
+    reopened.close()
+
+    return all_good
+
+
+def tiered_test():
+    """Test TieredBloomFilter's delta, merges and background merging"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    keys = [str(number) for number in range(3000)]
+    for background_merge in [False, True]:
+        for filename in [os.path.join(directory, 'seek'), (os.path.join(directory, 'hybrid'), 2 ** 10)]:
+            tiered = bloom_filter.TieredBloomFilter(filename, max_elements=5000, error_rate=0.01, start_fresh=True,
+                                                    delta_bytes=2 ** 13, background_merge=background_merge)
+            reference = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01)
+            for key in keys:
+                tiered.add(key)
+                reference.add(key)
+            if tiered.merges == 0:
+                sys.stderr.write('tiered filter never merged its delta\n')
+                all_good = False
+            if not all(key in tiered for key in keys):
+                sys.stderr.write('tiered filter lost keys before merging, background %s\n' % background_merge)
+                all_good = False
+            if tiered.contains_many(keys + ['absent']) != [True] * len(keys) + ['absent' in reference]:
+                sys.stderr.write('tiered contains_many gave the wrong answers\n')
+                all_good = False
+            tiered.merge()
+            if tiered.pending_bytes() != 0 or tiered.disk != reference:
+                sys.stderr.write('tiered merge gave the wrong bits, background %s\n' % background_merge)
+                all_good = False
+            tiered.close()
+
+            reopened = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, filename=filename)
+            if not all(key in reopened for key in keys):
+                sys.stderr.write('tiered filter lost keys on disk\n')
+                all_good = False
+            reopened.backend.close()
+
+    return all_good
+
+
+def batch_io_test():
+    """Test the coalesced batch paths of the file backends"""
+
+    all_good = True
+
+    if list(bloom_filter.bloom_filter.coalesce_bytenos([0, 1, 5, 10000, 10001], max_gap=16)) != \
+            [(0, 6), (10000, 10002)]:
+        sys.stderr.write('coalesce_bytenos gave the wrong ranges\n')
+        all_good = False
+
+    directory = tempfile.mkdtemp()
+    keys = [str(number) for number in range(2000)]
+    absent = [str(number) for number in range(2000, 4000)]
+    for filename in [os.path.join(directory, 'seek'), (os.path.join(directory, 'hybrid'), 2 ** 8)]:
+        batched = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, filename=filename, start_fresh=True)
+        batched.add_many(keys)
+        reference = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01)
+        for key in keys:
+            reference.add(key)
+        if batched != reference:
+            sys.stderr.write('add_many set the wrong bits, %s\n' % give_description(filename))
+            all_good = False
+        for fadvise in [False, True]:
+            if batched.contains_many(keys + absent, fadvise=fadvise) != [key in reference for key in keys + absent]:
+                sys.stderr.write('contains_many gave the wrong answers, %s\n' % give_description(filename))
+                all_good = False
+        batched.backend.close()
+
+    return all_good
+
+
+def backend_conformance_test():
+    """Check that every backend follows the same protocol, against a plain bytearray doing the same things"""
+
+    all_good = True
+
+    module = bloom_filter.bloom_filter
+    directory = tempfile.mkdtemp()
+    num_bits = 1001
+    num_chars = (num_bits + 7) // 8
+    factories = [
+        ('array', lambda: module.Array_backend(num_bits)),
+        ('sparse', lambda: module.Sparse_array_backend(num_bits, page_bytes=32)),
+        ('seek', lambda: module.File_seek_backend(num_bits, os.path.join(directory, 'seek'))),
+        ('mmap', lambda: module.Mmap_backend(num_bits, os.path.join(directory, 'mmap'))),
+        ('hybrid', lambda: module.Array_then_file_seek_backend(num_bits, os.path.join(directory, 'hybrid'), 16)),
+    ]
+    rng = random.Random(42)
+    for name, factory in factories:
+        backend = factory()
+        expected = bytearray(num_chars)
+
+        def is_set(bitno):
+            """Our reference is_set()"""
+            return bool(expected[bitno >> 3] & (1 << (bitno & 7)))
+
+        def mismatch(what):
+            """Report a difference between backend and our reference"""
+            sys.stderr.write('%s backend: %s disagrees with the reference\n' % (name, what))
+
+        if not isinstance(backend, module.Base_backend):
+            sys.stderr.write('%s backend is not a Base_backend\n' % name)
+            all_good = False
+        if backend.tobytes() != bytes(num_chars):
+            mismatch('a fresh tobytes()')
+            all_good = False
+
+        for dummy in range(500):
+            bitno = rng.randrange(num_bits)
+            if rng.random() < 0.7:
+                backend.set(bitno)
+                expected[bitno >> 3] |= 1 << (bitno & 7)
+            else:
+                backend.clear(bitno)
+                expected[bitno >> 3] &= 0xff ^ (1 << (bitno & 7))
+        if [bool(backend.is_set(bitno)) for bitno in range(num_bits)] != [is_set(bitno) for bitno in range(num_bits)]:
+            mismatch('is_set() after set() and clear()')
+            all_good = False
+
+        bitnos = [rng.randrange(num_bits) for dummy in range(200)]
+        backend.set_many(bitnos[:100])
+        backend.clear_many(bitnos[100:])
+        for bitno in bitnos[:100]:
+            expected[bitno >> 3] |= 1 << (bitno & 7)
+        for bitno in bitnos[100:]:
+            expected[bitno >> 3] &= 0xff ^ (1 << (bitno & 7))
+        if [bool(value) for value in backend.is_set_many(range(num_bits))] != \
+                [is_set(bitno) for bitno in range(num_bits)]:
+            mismatch('is_set_many() after set_many() and clear_many()')
+            all_good = False
+
+        for byteno, length in [(0, num_chars), (3, 17), (num_chars - 5, 100)]:
+            if backend.read_block(byteno, length) != bytes(expected[byteno:byteno + length]):
+                mismatch('read_block(%d, %d)' % (byteno, length))
+                all_good = False
+        data = bytes(rng.randrange(256) for dummy in range(21))
+        backend.write_block(20, data)
+        expected[20:20 + len(data)] = data
+
+        other = module.Array_backend(num_bits)
+        other.frombytes(bytes(rng.randrange(256) for dummy in range(num_chars)))
+        other_bytes = other.tobytes()
+        backend |= other
+        expected = bytearray(ours | theirs for ours, theirs in zip(expected, other_bytes))
+        if backend.tobytes() != bytes(expected):
+            mismatch('|=')
+            all_good = False
+        other.frombytes(bytes(rng.randrange(256) for dummy in range(num_chars)))
+        other_bytes = other.tobytes()
+        backend &= other
+        expected = bytearray(ours & theirs for ours, theirs in zip(expected, other_bytes))
+        if backend.tobytes() != bytes(expected):
+            mismatch('&=')
+            all_good = False
+
+        backend.close()
+        if name not in ['array', 'sparse'] and factory().tobytes() != bytes(expected):
+            mismatch('reopening after close()')
+            all_good = False
+
+    return all_good
+
+
+def columnar_test():
+    """Test add_array and contains_array against add() and in, on every backend"""
+
+    all_good = True
+
+    if bloom_filter.bloom_filter.fnv1a64(b'a') != 0xaf63dc4c8601ec8c:
+        sys.stderr.write('fnv1a64 gave the wrong hash\n')
+        all_good = False
+
+    if not columnar_mod.HAVE_NUMPY:
+        return all_good
+    numpy = columnar_mod.numpy
+
+    columns = [numpy.array([-5, 0, 1, 2 ** 40, -2 ** 63] + list(range(100, 1100)), dtype=numpy.int64),
+               numpy.arange(50, dtype=numpy.uint8)]
+    if columnar_mod.HAVE_ARROW:
+        pyarrow = columnar_mod.pyarrow
+        columns += [
+            pyarrow.chunked_array([pyarrow.array(['a', '', None, 'hello w\xf6rld']), pyarrow.array(['x' * 30, 'yy'])]),
+            pyarrow.array(['x' * 31, 'yyy'], type=pyarrow.large_string()),
+            pyarrow.array([b'\x00\x01', b'zz', None, b'q' * 9]).slice(1),
+            pyarrow.array([7, None, -7], type=pyarrow.int32()),
+        ]
+
+    directory = tempfile.mkdtemp()
+    filenames = [None, 'sparse', os.path.join(directory, 'seek'), (os.path.join(directory, 'mmap'), -1),
+                 (os.path.join(directory, 'hybrid'), 2 ** 6)]
+    for probe_bitnoer in [bloom_filter.get_bitno_fnv64, bloom_filter.get_filter_bitno_probes]:
+        for filename in filenames:
+            if filename == 'sparse':
+                vectorized = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, probe_bitnoer=probe_bitnoer,
+                                                      backend='sparse')
+            else:
+                vectorized = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, probe_bitnoer=probe_bitnoer,
+                                                      filename=filename, start_fresh=True)
+            one_at_a_time = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, probe_bitnoer=probe_bitnoer)
+            for column in columns:
+                vectorized.add_array(column)
+                values = column.tolist() if isinstance(column, numpy.ndarray) else column.to_pylist()
+                for value in values:
+                    if value is not None:
+                        one_at_a_time.add(value)
+            if vectorized != one_at_a_time:
+                sys.stderr.write('add_array set the wrong bits, %s\n' % give_description(filename))
+                all_good = False
+            for column in columns:
+                values = column.tolist() if isinstance(column, numpy.ndarray) else column.to_pylist()
+                if vectorized.contains_array(column).tolist() != [value is not None for value in values]:
+                    sys.stderr.write('contains_array missed keys, %s\n' % give_description(filename))
+                    all_good = False
+            absent = numpy.arange(10000, 10200)
+            if vectorized.contains_array(absent).sum() > 10:
+                sys.stderr.write('contains_array found too many absent keys, %s\n' % give_description(filename))
+                all_good = False
+            if filename not in [None, 'sparse']:
+                vectorized.backend.close()
+
+    return all_good
+
+
+def pipeline_test():
+    """Test filter_iter, partition_iter and filter_lines"""
+
+    all_good = True
+
+    bloom = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.001)
+    for number in range(0, 1000, 3):
+        bloom.add(str(number))
+    rows = [(number, str(number)) for number in range(1000)]
+    expected = [row for row in rows if row[1] in bloom]
+
+    for workers in [0, 3]:
+        stats = bloom_filter.PipelineStats()
+        passed = list(bloom.filter_iter(rows, key=lambda row: row[1], batch_rows=64, workers=workers, stats=stats))
+        if passed != expected:
+            sys.stderr.write('filter_iter passed the wrong rows, workers=%d\n' % workers)
+            all_good = False
+        if (stats.rows_in, stats.rows_out, stats.batches) != (1000, len(expected), 16) or \
+                abs(stats.selectivity - len(expected) / 1000.0) > 1e-9:
+            sys.stderr.write('filter_iter kept the wrong stats: %r\n' % stats)
+            all_good = False
+
+    def slow_rows():
+        """Take 0.05s to produce 10 rows, so the true rate is at most 200 rows/s"""
+        time.sleep(0.05)
+        for number in range(10):
+            yield str(number)
+
+    stats = bloom_filter.PipelineStats()
+    list(bloom.filter_iter(slow_rows(), batch_rows=10, stats=stats))
+    if not 0 < stats.rows_per_second <= 200:
+        sys.stderr.write('filter_iter measured the wrong rate: %r\n' % stats)
+        all_good = False
+
+    partitioned = list(bloom.partition_iter((row[1] for row in rows), batch_rows=100))
+    if partitioned != [(row[1] in bloom, row[1]) for row in rows]:
+        sys.stderr.write('partition_iter gave the wrong answers\n')
+        all_good = False
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'rows.csv')
+    with open(path, 'w') as file_:
+        for number, key in rows:
+            file_.write('%s,%d\n' % (key, number * 2))
+    lines = list(bloom.filter_lines(path, lambda line: line.split(',')[0], batch_rows=50))
+    if lines != ['%s,%d\n' % (key, number * 2) for number, key in expected]:
+        sys.stderr.write('filter_lines passed the wrong lines\n')
+        all_good = False
+    lines = list(bloom.filter_lines(path, lambda line: line.split(b',')[0], encoding=None, workers=2))
+    if len(lines) != len(expected) or not all(isinstance(line, bytes) for line in lines):
+        sys.stderr.write('filter_lines mishandled bytes lines\n')
+        all_good = False
+
+    return all_good
+
+
+def add_if_absent_test():
+    """Test add_if_absent and add_if_absent_many on every backend, and their atomicity in the thread-safe filters"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    keys = [str(number % 300) for number in range(500)]
+    first_times = [index == keys.index(key) for index, key in enumerate(keys)]
+    filenames = [None, 'sparse', os.path.join(directory, 'seek'), (os.path.join(directory, 'mmap'), -1),
+                 (os.path.join(directory, 'hybrid'), 2 ** 6)]
+    for filename in filenames:
+        reference = bloom_filter.BloomFilter(max_elements=1000, error_rate=1e-6)
+        reference.add_many(keys)
+        for batched in [False, True]:
+            if filename == 'sparse':
+                bloom = bloom_filter.BloomFilter(max_elements=1000, error_rate=1e-6, backend='sparse')
+            else:
+                bloom = bloom_filter.BloomFilter(max_elements=1000, error_rate=1e-6, filename=filename,
+                                                 start_fresh=True)
+            if batched:
+                results = bloom.add_if_absent_many(keys)
+            else:
+                results = [bloom.add_if_absent(key) for key in keys]
+            if results != first_times:
+                sys.stderr.write('add_if_absent%s gave the wrong answers, %s\n' % ('_many' if batched else '',
+                                                                                 filename))
+                all_good = False
+            if bloom != reference:
+                sys.stderr.write('add_if_absent set the wrong bits, %s\n' % (filename,))
+                all_good = False
+            if filename not in [None, 'sparse']:
+                bloom.backend.close()
+
+    durable = bloom_filter.DurableBloomFilter(os.path.join(directory, 'durable'), max_elements=1000,
+                                              error_rate=1e-6)
+    tiered = bloom_filter.TieredBloomFilter(os.path.join(directory, 'tiered'), max_elements=1000, error_rate=1e-6,
+                                            start_fresh=True, delta_bytes=2 ** 12)
+    for name, bloom in [('DurableBloomFilter', durable), ('TieredBloomFilter', tiered)]:
+        counts = []
+
+        def dedup():
+            """Count the keys this thread was first to add"""
+            counts.append(sum(bloom.add_if_absent(key) for key in keys))
+
+        threads = [threading.Thread(target=dedup) for dummy in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if sum(counts) != 300 or not all(key in bloom for key in keys):
+            sys.stderr.write('%s.add_if_absent was not atomic: %d keys were new\n' % (name, sum(counts)))
+            all_good = False
+        if bloom.add_if_absent_many(['new', '1', 'new']) != [True, False, False]:
+            sys.stderr.write('%s.add_if_absent_many gave the wrong answers\n' % name)
+            all_good = False
+        bloom.close()
+
+    return all_good
+
+
+def delta_test():
+    """Test that replicas catch up incrementally through deltas, over a file and over a pipe"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    source = bloom_filter.BloomFilter(max_elements=100000, error_rate=0.01)
+    replicas = [
+        bloom_filter.BloomFilter(max_elements=100000, error_rate=0.01),
+        bloom_filter.BloomFilter(max_elements=100000, error_rate=0.01, backend='sparse'),
+    ]
+    source.add_many(str(number) for number in range(1000))
+
+    path = os.path.join(directory, 'delta')
+    with open(path, 'wb') as file_:
+        since_version = source.export_delta(file_)
+    full_bytes = os.path.getsize(path)
+    for replica in replicas:
+        with open(path, 'rb') as file_:
+            if replica.apply_delta(file_) != since_version or replica != source:
+                sys.stderr.write('a full delta did not bring a replica up to date\n')
+                all_good = False
+
+    source.add_many(str(number) for number in range(1000, 1010))
+    with open(path, 'wb') as file_:
+        next_version = source.export_delta(file_, since_version)
+    if next_version <= since_version or os.path.getsize(path) * 10 > full_bytes:
+        sys.stderr.write('an incremental delta was not small: %d bytes\n' % os.path.getsize(path))
+        all_good = False
+    for replica in replicas:
+        # Applying a delta twice changes nothing
+        for dummy in range(2):
+            with open(path, 'rb') as file_:
+                replica.apply_delta(file_)
+        if replica != source or not replica.backend.dirty.monotone:
+            sys.stderr.write('an incremental delta did not bring a replica up to date\n')
+            all_good = False
+
+    source.add('over a pipe')
+    read_fd, write_fd = os.pipe()
+    writer = threading.Thread(target=lambda: source.export_delta(os.fdopen(write_fd, 'wb'), next_version))
+    writer.start()
+    with os.fdopen(read_fd, 'rb') as file_:
+        replicas[0].apply_delta(file_)
+    writer.join()
+    if replicas[0] != source:
+        sys.stderr.write('a delta over a pipe did not bring a replica up to date\n')
+        all_good = False
+
+    # Replicas catching up in turn each keep getting word-level deltas, not whole pages
+    versions = []
+    for replica in replicas:
+        stream = io.BytesIO()
+        versions.append(source.export_delta(stream))
+        stream.seek(0)
+        replica.apply_delta(stream)
+    for round_ in range(3):
+        for index, replica in enumerate(replicas):
+            source.add('replica %d round %d' % (index, round_))
+            stream = io.BytesIO()
+            versions[index] = source.export_delta(stream, versions[index])
+            if len(stream.getvalue()) * 10 > full_bytes:
+                sys.stderr.write('replicas exporting in turn got a %d byte delta\n' % len(stream.getvalue()))
+                all_good = False
+            stream.seek(0)
+            replica.apply_delta(stream)
+            if replica != source:
+                sys.stderr.write('a replica exporting in turn did not catch up\n')
+                all_good = False
+
+    stream = io.BytesIO()
+    source.export_delta(stream, since_version)
+    corrupt = bytearray(stream.getvalue())
+    corrupt[-20] ^= 0xff
+    other = bloom_filter.BloomFilter(max_elements=10, error_rate=0.01)
+    for bloom, data in [(replicas[0], bytes(corrupt)), (other, stream.getvalue()), (replicas[0], corrupt[:50])]:
+        try:
+            bloom.apply_delta(io.BytesIO(data))
+        except bloom_filter.DeltaError:
+            pass
+        else:
+            sys.stderr.write('a bad delta was applied\n')
+            all_good = False
+
+    return all_good
+
+
+def word_layout_test(performance_test):
+    """Test that the array backend fills its 64 bit words, migrates 32 bit word pickles, and passes 2 ** 32 bits"""
+
+    all_good = True
+
+    module = bloom_filter.bloom_filter
+    num_bits = 100003
+    backend = module.Array_backend(num_bits)
+    if len(backend.array_) * backend.array_.itemsize != (num_bits + 63) // 64 * 8:
+        sys.stderr.write('array backend uses %d bytes for %d bits\n' % (len(backend.array_) * backend.array_.itemsize,
+                                                                        num_bits))
+        all_good = False
+
+    rng = random.Random(47)
+    backend.set_many(rng.randrange(num_bits) for dummy in range(3000))
+    expected = backend.tobytes()
+    old_words = struct.unpack('<%dI' % ((num_bits + 31) // 32), expected + bytes(-len(expected) % 4))
+    for typecode in ['I', 'Q']:
+        for byteorder in ['little', 'big']:
+            # A protocol 5 pickle from before words held 64 bits: 32 bits in each word, whatever its itemsize
+            foreign = array.array(typecode, old_words)
+            if byteorder != sys.byteorder:
+                foreign.byteswap()
+            migrated = module.unpickle_array_backend(num_bits, 2 ** 12, foreign.itemsize, byteorder,
+                                                     foreign.tobytes())
+            if migrated.tobytes() != expected:
+                sys.stderr.write('a pickle of %s words, %s-endian, was not migrated\n' % (typecode, byteorder))
+                all_good = False
+
+    # Bit numbers past 2 ** 32 must get 64 bit words of their own, not alias low ones
+    if module.word_masks([2 ** 32 - 1, 2 ** 32, 2 ** 32 + 63, 2 ** 33 + 5]) != \
+            {2 ** 26 - 1: 1 << 63, 2 ** 26: 1 | 1 << 63, 2 ** 27: 1 << 5}:
+        sys.stderr.write('word_masks gave the wrong words for bit numbers past 2 ** 32\n')
+        all_good = False
+
+    # A filter past 2 ** 32 bits in an array takes over 500MB, so only the performance test makes one; a sparse
+    # one costs only the pages we touch, so we touch few
+    for backend in ['sparse', None] if performance_test else ['sparse']:
+        bloom = bloom_filter.BloomFilter(max_elements=460 * 10 ** 6, error_rate=0.01,
+                                         probe_bitnoer=bloom_filter.get_bitno_fnv64, backend=backend)
+        description = backend or 'array'
+        high_bitnos = [2 ** 32 - 1, 2 ** 32, 2 ** 32 + 63, bloom.num_bits_m - 1]
+        bloom.backend.set_many(high_bitnos)
+        if bloom.num_bits_m <= 2 ** 32 or not all(bloom.backend.is_set_many(high_bitnos)) or \
+                bloom.backend.is_set(2 ** 32 + 1) or bloom.backend.is_set(2 ** 32 + 63 - 2 ** 32):
+            sys.stderr.write('bit numbers past 2 ** 32 collided, %s backend\n' % description)
+            all_good = False
+        tail = bloom.backend.read_block(bloom.backend.num_chars - 1, 1)
+        if tail != bytes([1 << ((bloom.num_bits_m - 1) & 7)]):
+            sys.stderr.write('the last byte of a %s filter past 2 ** 32 bits reads as %r\n' % (description, tail))
+            all_good = False
+        keys = ['key %d' % number for number in range(1000 if backend is None else 10)]
+        bloom.add_many(keys)
+        if not all(bloom.contains_many(keys)):
+            sys.stderr.write('a %s filter past 2 ** 32 bits lost keys\n' % description)
+            all_good = False
+        if columnar_mod.HAVE_NUMPY and backend is None:
+            numbers = columnar_mod.numpy.arange(10 ** 5, dtype=columnar_mod.numpy.int64) * 7919
+            bloom.add_array(numbers)
+            if not bloom.contains_array(numbers).all() or not all(bloom.contains_many(numbers[:100].tolist())):
+                sys.stderr.write('add_array lost keys in a filter past 2 ** 32 bits\n')
+                all_good = False
+        bloom.backend.close()
+
+    return all_good
+
+
+def guarded_store_test():
+    """Test that BloomGuardedStore answers like its store, skips it for most misses, and recovers its filter"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    store_path = os.path.join(directory, 'store')
+    filter_path = os.path.join(directory, 'store.bloom')
+
+    def open_store():
+        """Open our dbm, behind a filter persisted next to it"""
+        return bloom_filter.BloomGuardedStore(lambda: dbm_dumb.open(store_path, 'c'), filter_path=filter_path,
+                                              max_elements=1000, error_rate=1e-4)
+
+    store = open_store()
+    for number in range(500):
+        store['key %d' % number] = 'value %d' % number
+    misses = ['missing %d' % number for number in range(1000)]
+    if store['key 7'] != b'value 7' or 'key 8' not in store or store.get('key 9') != b'value 9':
+        sys.stderr.write('BloomGuardedStore lost a stored key\n')
+        all_good = False
+    if any(key in store for key in misses) or any(store.get(key) is not None for key in misses):
+        sys.stderr.write('BloomGuardedStore found a key that was never stored\n')
+        all_good = False
+    stats = store.stats()
+    if stats['lookups'] != 2003 or stats['lookups_avoided'] < 1990 or \
+            stats['lookups_avoided'] + stats['false_positives'] != 2000:
+        sys.stderr.write('BloomGuardedStore avoided the wrong lookups: %s\n' % (stats,))
+        all_good = False
+    del store['key 7']
+    if 'key 7' in store or store.stats()['deletes_since_rebuild'] != 1:
+        sys.stderr.write('BloomGuardedStore did not delete\n')
+        all_good = False
+    store.rebuild()
+    if 'key 7' in store or store.stats()['false_positives'] != stats['false_positives'] + 1:
+        sys.stderr.write('rebuild() kept the bits of a deleted key\n')
+        all_good = False
+    store.close()
+
+    store = open_store()
+    if store.rebuilds or len(store) != 499 or not all('key %d' % number in store for number in range(8, 500)):
+        sys.stderr.write('BloomGuardedStore did not reload its saved filter\n')
+        all_good = False
+    store['late key'] = 'late value'
+    # Crash without saving the filter: the next open must not trust the stale one
+    store.store.close()
+    store = open_store()
+    if store.rebuilds != 1 or store.get('late key') != b'late value':
+        sys.stderr.write('BloomGuardedStore trusted a filter that was not saved cleanly\n')
+        all_good = False
+    store.close()
+
+    return all_good
+
+
+def placement_test():
+    """Test backend='auto', BackendPolicy, rebalance(), and migrate() while other threads use the filter"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'placed')
+    small = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, backend='auto', filename=path)
+    if small.backend.kind != 'array' or len(small.placement_stats()['decisions']) != 1:
+        sys.stderr.write('backend="auto" did not keep a small filter in memory\n')
+        all_good = False
+
+    policy = bloom_filter.BackendPolicy(memory_budget_bytes=2 ** 16, path=path)
+    bloom = bloom_filter.BloomFilter(max_elements=100000, error_rate=0.01, backend=policy, start_fresh=True)
+    keys = ['key %d' % number for number in range(2000)]
+    bloom.add_many(keys)
+    if bloom.backend.kind not in ['mmap', 'seek'] or bloom.rebalance(hot=True) is not None:
+        sys.stderr.write('a BackendPolicy let a filter over budget into memory\n')
+        all_good = False
+
+    policy.memory_budget_bytes = 2 ** 20
+    on_disk = bloom.backend
+    promoted_from = bloom.rebalance(hot=True)
+    if promoted_from is not on_disk or bloom.backend.kind != 'array' or not all(bloom.contains_many(keys)):
+        sys.stderr.write('rebalance() did not promote a hot filter into memory\n')
+        all_good = False
+    # rebalance() leaves the old backend open for readers still using it
+    try:
+        still_readable = all(on_disk.is_set(bitno) for bitno in bloom.probe_bitnoer(bloom, keys[0]))
+    except (ValueError, OSError):
+        still_readable = False
+    if not still_readable:
+        sys.stderr.write('rebalance() closed the old backend under its readers\n')
+        all_good = False
+    on_disk.close()
+    demoted_from = bloom.rebalance(hot=False)
+    if demoted_from is None or bloom.backend.kind == 'array' or not all(bloom.contains_many(keys)):
+        sys.stderr.write('rebalance() did not demote a cold filter to disk\n')
+        all_good = False
+    if demoted_from is not None:
+        demoted_from.close()
+    stats = bloom.placement_stats()
+    if stats['migrations'] != 2 or [decision['reason'] for decision in stats['decisions']][2] != 'cold':
+        sys.stderr.write('placement_stats() missed decisions: %s\n' % (stats,))
+        all_good = False
+
+    # Migrate back and forth while one thread adds keys and another looks up ones already added.  Each block copy
+    # waits until the writer has made progress, so the writer is inserting while every copy runs, and then pauses
+    # between reading the target and writing it back, giving the writer every chance to set a bit the copy would lose.
+    module = bloom_filter.bloom_filter
+    late_keys = []
+    started = threading.Event()
+    done = threading.Event()
+    missing = []
+
+    def writer():
+        """Add late keys until the migrations are done"""
+        number = 0
+        while not done.is_set():
+            key = 'late key %d' % number
+            bloom.add(key)
+            late_keys.append(key)
+            number += 1
+            started.set()
+
+    def reader():
+        """Keys added before the migrations must always be found"""
+        while not done.is_set():
+            if not all(bloom.contains_many(keys[:200])):
+                missing.append(True)
+
+    def wait_for_writer(keys_wanted, timeout):
+        """Wait until the writer has added keys_wanted more keys, or timeout seconds have passed"""
+        before = len(late_keys)
+        deadline = time.time() + timeout
+        while len(late_keys) < before + keys_wanted and time.time() < deadline:
+            time.sleep(0.0001)
+        return len(late_keys) - before
+
+    original_copy_block = module.Migrating_backend.copy_block
+    copies = []
+
+    def copy_block(migrating, byteno, length):
+        """Copy a block only once the writer has added a few more keys, and note how many it added meanwhile"""
+        target_read_block = migrating.target.read_block
+
+        def slow_read_block(block_byteno, block_length):
+            """Read the target as or_block() does, then give the writer time to get in before it writes back"""
+            data = target_read_block(block_byteno, block_length)
+            wait_for_writer(5, 0.02)
+            return data
+
+        copies.append(wait_for_writer(20, 10))
+        migrating.target.read_block = slow_read_block
+        try:
+            original_copy_block(migrating, byteno, length)
+        finally:
+            del migrating.target.read_block
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    module.Migrating_backend.copy_block = copy_block
+    threads = [threading.Thread(target=writer), threading.Thread(target=reader)]
+    # The threads may still be using an old backend just after we switch away from it, so close them all at the end
+    old_backends = []
+    try:
+        for thread in threads:
+            thread.start()
+        started.wait()
+        for to_backend in ['sparse', 'array', 'seek', module.Array_backend(bloom.num_bits_m)]:
+            migrated = os.path.join(directory, 'migrated')
+            old_backends.append(bloom.migrate(to_backend, filename=migrated))
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+        module.Migrating_backend.copy_block = original_copy_block
+        sys.setswitchinterval(switch_interval)
+        for old_backend in old_backends:
+            old_backend.close()
+    if not copies or min(copies) < 20:
+        sys.stderr.write('the writer was not inserting during every block copy\n')
+        all_good = False
+    absent = sum(1 for present in bloom.contains_many(late_keys) if not present)
+    if missing or absent or not all(bloom.contains_many(keys)) or bloom.backend.kind != 'array':
+        sys.stderr.write('migrate() lost %d of %d keys added while the filter was in use\n' % (absent,
+                                                                                             len(late_keys)))
+        all_good = False
+
+    class Sparse_policy(bloom_filter.BackendPolicy):
+        """A policy hook that always wants a sparse backend"""
+
+        def choose(self, num_bits, hot=None):
+            return 'sparse', 'testing'
+
+    hooked = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, backend=Sparse_policy())
+    if hooked.backend.kind != 'sparse' or hooked.placement_stats()['decisions'][0]['reason'] != 'testing':
+        sys.stderr.write('a BackendPolicy subclass was not consulted\n')
+        all_good = False
+
+    return all_good
+
+
+def quotient_filter_test():
+    """Test QuotientFilter's add/remove, resizing, merging and persistence"""
+
+    all_good = True
+
+    quotient = bloom_filter.QuotientFilter(max_elements=20, error_rate=0.001, spare_doublings=4)
+    for state in States.states:
+        quotient.add(state)
+    quotient.add('Alabama')
+    if quotient.quotient_bits <= 5 or not all(state in quotient for state in States.states):
+        sys.stderr.write('quotient filter lost keys while growing\n')
+        all_good = False
+    if quotient.count('Alabama') != 2 or not quotient.remove('Alabama') or 'Alabama' not in quotient:
+        sys.stderr.write('quotient filter does not count duplicates\n')
+        all_good = False
+    if not quotient.remove('Alabama') or 'Alabama' in quotient or quotient.remove('Alabama'):
+        sys.stderr.write('quotient filter remove is wrong\n')
+        all_good = False
+    fingerprints = list(quotient.fingerprints())
+    if fingerprints != sorted(fingerprints) or len(fingerprints) != len(quotient):
+        sys.stderr.write('quotient filter fingerprints are not sorted\n')
+        all_good = False
+
+    path = os.path.join(tempfile.mkdtemp(), 'quotient')
+    on_disk = bloom_filter.QuotientFilter(max_elements=20, error_rate=0.001, spare_doublings=4, filename=path)
+    numbers = [str(number) for number in range(500)]
+    for number in numbers:
+        on_disk.add(number)
+    on_disk.merge(quotient)
+    on_disk.close()
+
+    reopened = bloom_filter.QuotientFilter(filename=path)
+    members = [state for state in States.states if state != 'Alabama'] + numbers
+    if len(reopened) != len(members) or not all(member in reopened for member in members):
+        sys.stderr.write('merged, file-backed quotient filter lost keys\n')
+        all_good = False
+    copied = bloom_filter.QuotientFilter.frombytes(reopened.tobytes())
+    if list(copied.fingerprints()) != list(reopened.fingerprints()):
+        sys.stderr.write('quotient filter serialization is wrong\n')
+        all_good = False
+    reopened.close()
+
+    false_positives = sum(str(number) in copied for number in range(500, 10500))
+    if false_positives > 10000 * copied.predicted_error_rate() * 3 + 5:
+        sys.stderr.write('quotient filter has %d false positives\n' % false_positives)
+        all_good = False
+
+    return all_good
+
+
+def _count_min_adder(shared_memory_name, lock, key, times):
+    """Run in a child process: add key times times to a shared memory CountMinSketch"""
+    sketch = bloom_filter.CountMinSketch(error_rate=0.01, failure_rate=0.01, shared_memory_name=shared_memory_name,
+                                         lock=lock)
+    for dummy in range(times):
+        sketch.add(key)
+    sketch.close()
+
+
+def count_min_test():
+    """Test CountMinSketch estimates, conservative updates, merging, storage and heavy hitters"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    true_counts = dict((state, index + 1) for index, state in enumerate(States.states))
+    for storage in ['array', 'file', 'shared']:
+        for conservative in [False, True]:
+            kwargs = dict(error_rate=0.01, failure_rate=0.01, conservative=conservative, top_k=5, start_fresh=True)
+            if storage == 'file':
+                kwargs['filename'] = os.path.join(directory, 'sketch')
+            elif storage == 'shared':
+                kwargs['shared_memory_name'] = 'bloom-filter-test-%d' % os.getpid()
+            sketch = bloom_filter.CountMinSketch(**kwargs)
+            sketch.add_many(list(true_counts), [count - 1 for count in true_counts.values()])
+            sketch.add_many(list(true_counts))
+            total = sum(true_counts.values())
+            if sketch.total != total:
+                sys.stderr.write('count-min total is %d, not %d\n' % (sketch.total, total))
+                all_good = False
+            for state, count in true_counts.items():
+                if not count <= sketch.estimate(state) <= count + sketch.error_rate * total:
+                    sys.stderr.write('count-min estimate for %s is %d, not %d\n' % (state, sketch.estimate(state),
+                                                                                   count))
+                    all_good = False
+            expected_top = sorted(true_counts, key=true_counts.get, reverse=True)[:5]
+            if [key for key, dummy in sketch.heavy_hitters()] != expected_top:
+                sys.stderr.write('count-min heavy hitters are wrong: %s\n' % sketch.heavy_hitters())
+                all_good = False
+
+            other = bloom_filter.CountMinSketch(error_rate=0.01, failure_rate=0.01, top_k=5)
+            other.add('Puerto Rico', 1000)
+            sketch.merge(other)
+            if sketch.estimate('Puerto Rico') < 1000 or sketch.heavy_hitters()[0][0] != 'Puerto Rico':
+                sys.stderr.write('count-min merge is wrong\n')
+                all_good = False
+
+            if storage == 'array':
+                sketch.close()
+                continue
+            sketch.close()
+            if sketch.total != total + 1000:
+                sys.stderr.write('count-min %s storage lost its total on close\n' % storage)
+                all_good = False
+            kwargs['start_fresh'] = False
+            reopened = bloom_filter.CountMinSketch(**kwargs)
+            if reopened.total != total + 1000 or reopened.estimate('Wyoming') < true_counts['Wyoming']:
+                sys.stderr.write('count-min %s storage did not persist\n' % storage)
+                all_good = False
+            if storage == 'shared':
+                reopened.unlink()
+            else:
+                reopened.close()
+
+    # Processes adding to the same shared counters under one lock lose no adds
+    context = multiprocessing.get_context()
+    lock = context.Lock()
+    name = 'bloom-filter-test-locked-%d' % os.getpid()
+    sketch = bloom_filter.CountMinSketch(error_rate=0.01, failure_rate=0.01, shared_memory_name=name, lock=lock,
+                                         start_fresh=True)
+    processes = [context.Process(target=_count_min_adder, args=(name, lock, 'Ohio', 2000)) for dummy in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    if sketch.estimate('Ohio') < 8000 or sketch.total != 8000:
+        sys.stderr.write('count-min lost adds from processes sharing a lock: %r\n' % sketch)
+        all_good = False
+    sketch.unlink()
+
+    # Heavy hitters stay right through many updates and evictions
+    sketch = bloom_filter.CountMinSketch(error_rate=0.001, failure_rate=0.01, conservative=True, top_k=3)
+    stream = [number for number in range(100) for dummy in range(20)] + [0] * 300 + [1] * 200 + [2] * 100
+    random.Random(0).shuffle(stream)
+    for key in stream:
+        sketch.add(key)
+    if [key for key, dummy in sketch.heavy_hitters()] != [0, 1, 2]:
+        sys.stderr.write('count-min lost heavy hitters: %s\n' % (sketch.heavy_hitters(),))
+        all_good = False
+
+    return all_good
+
+
+def pickle_test():
+    """Test pickling filters in and out of band, and file-backed filters by reference"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    filenames = [None, 'sparse', os.path.join(directory, 'seek'), (os.path.join(directory, 'mmap'), -1),
+                 (os.path.join(directory, 'hybrid'), 2 ** 8)]
+    for filename in filenames:
+        if filename == 'sparse':
+            original = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, backend='sparse')
+        else:
+            original = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01, filename=filename,
+                                                start_fresh=True)
+        source = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01)
+        for state in States.states:
+            source.add(state)
+        original |= source
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            buffers = []
+            if protocol >= 5:
+                data = pickle.dumps(original, protocol=protocol, buffer_callback=buffers.append)
+                copied = pickle.loads(data, buffers=buffers)
+            else:
+                copied = pickle.loads(pickle.dumps(original, protocol=protocol))
+            if copied != original or not all(state in copied for state in States.states):
+                sys.stderr.write('pickling lost bits, protocol %d, %s\n' % (protocol, filename))
+                all_good = False
+            if filename is None and protocol >= 5 and not buffers:
+                sys.stderr.write('array filter was not pickled out of band\n')
+                all_good = False
+            if filename not in [None, 'sparse'] and 'Puerto Rico' not in copied:
+                extra = bloom_filter.BloomFilter(max_elements=5000, error_rate=0.01)
+                extra.add('Puerto Rico')
+                copied |= extra
+                if 'Puerto Rico' not in original:
+                    sys.stderr.write('a file-backed filter was not pickled by reference\n')
+                    all_good = False
+            if filename not in [None, 'sparse']:
+                copied.backend.close()
+
+        frozen = original.freeze()
+        if pickle.loads(pickle.dumps(frozen, protocol=pickle.HIGHEST_PROTOCOL)) != frozen:
+            sys.stderr.write('pickling a frozen filter changed it\n')
+            all_good = False
+        if filename not in [None, 'sparse']:
+            original.backend.close()
+
+    return all_good
+
+
+def plan_test():
+    """Test BloomFilter.plan() and BloomFilter.from_plan()"""
+
+    all_good = True
+
+    # The default sizing and the planner should agree on the bits needed for an error rate
+    classic = bloom_filter.BloomFilter(max_elements=10000, error_rate=0.01)
+    by_rate = bloom_filter.BloomFilter.plan(max_elements=10000, error_rate=0.01)
+    if not 0.99 < by_rate.num_bits_m / float(classic.num_bits_m) < 1.01 or by_rate.predicted_error_rate > 0.01:
+        sys.stderr.write('planner disagrees with default sizing: %r\n' % (by_rate,))
+        all_good = False
+
+    # Fewer probes at the same error rate costs memory, and saves I/O per lookup
+    few_probes = bloom_filter.BloomFilter.plan(max_elements=10000, error_rate=0.01, max_probes=3)
+    if few_probes.num_probes_k != 3 or few_probes.num_bits_m <= by_rate.num_bits_m:
+        sys.stderr.write('planner did not trade memory for probes: %r\n' % (few_probes,))
+        all_good = False
+    if few_probes.backend_costs['seek']['io_per_hit'] >= by_rate.backend_costs['seek']['io_per_hit']:
+        sys.stderr.write('planner did not predict less I/O with fewer probes\n')
+        all_good = False
+
+    # With both a budget and an error rate, we want the fewest probes that still fit
+    budget = bloom_filter.BloomFilter.plan(max_elements=10000, memory_bytes=few_probes.memory_bytes, error_rate=0.01)
+    if budget.num_probes_k > 3 or budget.predicted_error_rate > 0.01:
+        sys.stderr.write('planner did not minimize probes within a budget: %r\n' % (budget,))
+        all_good = False
+
+    try:
+        bloom_filter.BloomFilter.plan(max_elements=10000, memory_bytes=100, error_rate=0.01)
+    except ValueError:
+        pass
+    else:
+        sys.stderr.write('planner accepted an impossible budget\n')
+        all_good = False
+
+    by_memory = bloom_filter.BloomFilter.plan(max_elements=1000, memory_bytes=1200, backend='sparse')
+    bloom = bloom_filter.BloomFilter.from_plan(by_memory)
+    if (bloom.num_bits_m, bloom.num_probes_k) != (9600, by_memory.num_probes_k) or \
+            not isinstance(bloom.backend, bloom_filter.bloom_filter.Sparse_array_backend):
+        sys.stderr.write('from_plan did not follow the plan\n')
+        all_good = False
+    bloom.add('Alabama')
+    if 'Alabama' not in bloom:
+        sys.stderr.write('Alabama not in planned filter, but should be\n')
+        all_good = False
+
+    few_probes_mmap = bloom_filter.BloomFilter.plan(max_elements=1000, error_rate=0.01, max_probes=3, backend='mmap')
+    directory = tempfile.mkdtemp()
+    try:
+        bloom = bloom_filter.BloomFilter.from_plan(few_probes_mmap, filename=os.path.join(directory, 'mmap'),
+                                                   start_fresh=True)
+        if not isinstance(bloom.backend, bloom_filter.bloom_filter.Mmap_backend) or bloom.num_probes_k != 3:
+            sys.stderr.write('from_plan did not build an mmap filter from an mmap plan\n')
+            all_good = False
+        bloom.add('Alabama')
+        if 'Alabama' not in bloom:
+            sys.stderr.write('Alabama not in planned mmap filter, but should be\n')
+            all_good = False
+        bloom.backend.close()
+    finally:
+        shutil.rmtree(directory)
+
+    try:
+        bloom_filter.BloomFilter.from_plan(few_probes_mmap)
+    except ValueError:
+        pass
+    else:
+        sys.stderr.write('from_plan built an mmap plan without a filename\n')
+        all_good = False
+
+    return all_good
+
+
+def combine_all_test():
+    """Test the out-of-place, many-way union_all and intersection_all"""
+
+    all_good = True
+
+    directory = tempfile.mkdtemp()
+    filters = [
+        bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01),
+        bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, backend='sparse'),
+        bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, filename=os.path.join(directory, 'seek'),
+                                 start_fresh=True),
+        bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01,
+                                 filename=(os.path.join(directory, 'hybrid'), 100), start_fresh=True),
+    ]
+    for filterno, bloom in enumerate(filters):
+        for state in States.states[filterno * 10:filterno * 10 + 20] + ['Puerto Rico']:
+            bloom.add(state)
+    before = [bloom.freeze() for bloom in filters]
+
+    # A small, unaligned block size makes sure block boundaries are handled
+    union = bloom_filter.BloomFilter.union_all(filters, block_bytes=103)
+    if not all(state in union for state in States.states[:50]):
+        sys.stderr.write('union_all lost members\n')
+        all_good = False
+
+    intersection = bloom_filter.BloomFilter.intersection_all(filters, block_bytes=103, backend='sparse')
+    if 'Puerto Rico' not in intersection or 'Alabama' in intersection:
+        sys.stderr.write('intersection_all is wrong\n')
+        all_good = False
+
+    if [bloom.freeze() for bloom in filters] != before:
+        sys.stderr.write('union_all or intersection_all modified its inputs\n')
+        all_good = False
+
+    expected = 0
+    for bloom in filters:
+        expected |= int.from_bytes(bloom.backend.tobytes(), 'little')
+    if int.from_bytes(union.backend.tobytes(), 'little') != expected:
+        sys.stderr.write('union_all disagrees with a whole-filter union\n')
+        all_good = False
+
+    for bloom in filters:
+        bloom.backend.close()
+
+    return all_good
+
+
+def bloom_index_test():
+    """Test BloomIndex, in memory and persisted"""
+
+    all_good = True
+
+    filename = os.path.join(tempfile.mkdtemp(), 'index')
+    for persist in [False, True]:
+        index = bloom_filter.BloomIndex(max_elements=100, error_rate=0.01, capacity=20,
+                                        filename=filename if persist else None, start_fresh=True)
+        for partitionno in range(10):
+            bloom = bloom_filter.BloomFilter(max_elements=100, error_rate=0.01)
+            for state in States.states[partitionno * 5:partitionno * 5 + 5]:
+                bloom.add(state)
+            index.add_filter('partition-%d' % partitionno, bloom)
+
+        if persist:
+            index.close()
+            index = bloom_filter.BloomIndex(filename=filename)
+
+        for stateno, state in enumerate(States.states):
+            if 'partition-%d' % (stateno // 5) not in index.query(state):
+                sys.stderr.write('%s not found in its partition\n' % state)
+                all_good = False
+        if index.query_many(['Alabama', 'Puerto Rico']) != [['partition-0'], []]:
+            sys.stderr.write('index batch query is wrong: %r\n' % (index.query_many(['Alabama', 'Puerto Rico']),))
+            all_good = False
+        index.close()
+
+    try:
+        index.add_filter('mismatch', bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01))
+    except ValueError:
+        pass
+    else:
+        sys.stderr.write('index accepted a filter with a different template\n')
+        all_good = False
+
+    return all_good
+
+
+def set_algebra_test():
+    """Test copy, clear, equality, subset and the non-mutating operators"""
+
+    all_good = True
+
+    filename = os.path.join(tempfile.mkdtemp(), 'seek')
+    for backend, other_filename in [(None, None), ('sparse', None), (None, filename)]:
+        abc = bloom_filter.BloomFilter(max_elements=100, error_rate=0.01, backend=backend)
+        for character in ['a', 'b', 'c']:
+            abc += character
+        ab = bloom_filter.BloomFilter(max_elements=100, error_rate=0.01, filename=other_filename, start_fresh=True)
+        for character in ['a', 'b']:
+            ab += character
+
+        if not ab.issubset(abc) or not abc.issuperset(ab) or abc <= ab or ab == abc:
+            sys.stderr.write('subset or equality tests are wrong for backend %s\n' % backend)
+            all_good = False
+
+        abc_copy = abc.copy()
+        if abc_copy != abc or abc_copy.backend is abc.backend:
+            sys.stderr.write('copy is not an equal, independent filter\n')
+            all_good = False
+
+        abc_or_ab = abc | ab
+        abc_and_ab = abc & ab
+        if abc_or_ab != abc or abc_and_ab != ab:
+            sys.stderr.write('| or & gave the wrong answer for backend %s\n' % backend)
+            all_good = False
+
+        changes = abc ^ ab
+        if 'c' not in changes or changes.popcount() == 0 or (abc ^ abc_copy).popcount() != 0:
+            sys.stderr.write('symmetric difference is wrong for backend %s\n' % backend)
+            all_good = False
+
+        # None of that should have changed abc
+        if abc != abc_copy:
+            sys.stderr.write('a non-mutating operator mutated its operand\n')
+            all_good = False
+
+        abc_copy.clear()
+        if abc_copy.popcount() != 0 or 'a' not in abc:
+            sys.stderr.write('clear did not clear just the copy\n')
+            all_good = False
+
+        ab.backend.close()
+
+    # Whole-array operations on an array backend work a block at a time: they must get every block right, mark just
+    # the pages that change dirty, and never need more than a fraction of the filter's size in temporaries
+    module = bloom_filter.bloom_filter
+    num_bits = 2 ** 27
+    rng = random.Random(34)
+    left_bitnos = set(rng.randrange(num_bits) for dummy in range(2000))
+    right_bitnos = set(rng.randrange(num_bits) for dummy in range(2000))
+    left = module.Array_backend(num_bits)
+    left.set_many(left_bitnos)
+    right = module.Array_backend(num_bits)
+    right.set_many(right_bitnos)
+    left.dirty.reset()
+    tracemalloc.start()
+    try:
+        left |= right
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    expected_pages = set(bitno // 8 // left.page_bytes for bitno in right_bitnos - left_bitnos)
+    if set(left.dirty) != expected_pages or not all(left.is_set_many(sorted(left_bitnos | right_bitnos))) or \
+            sum(map(popcount_word, left.array_)) != len(left_bitnos | right_bitnos):
+        sys.stderr.write('a blockwise |= on an array backend set or marked the wrong bits\n')
+        all_good = False
+    if peak > 12 * module.MERGE_BLOCK_BYTES:
+        sys.stderr.write('|= on a %d byte array backend peaked at %d bytes\n' % (num_bits // 8, peak))
+        all_good = False
+    if not right.issubset(left) or left.issubset(right):
+        sys.stderr.write('a blockwise issubset gave the wrong answer\n')
+        all_good = False
+    left ^= right
+    if sum(map(popcount_word, left.array_)) != len(left_bitnos - right_bitnos):
+        sys.stderr.write('a blockwise ^= gave the wrong answer\n')
+        all_good = False
+
+    return all_good
+
+
+def popcount_word(word):
+    """Count the set bits in an integer"""
+    return bin(word).count('1')
+
+
+def snapshot_test():
+    """Test copy-on-write snapshots"""
+
+    all_good = True
+
+    for backend in [None, 'sparse']:
+        live = bloom_filter.BloomFilter(max_elements=10000, error_rate=0.01, backend=backend)
+        for state in States.states[:25]:
+            live.add(state)
+        expected = live.freeze()
+
+        snapshot = live.snapshot()
+        if live.snapshot_overhead_bytes() != 0:
+            sys.stderr.write('taking a snapshot copied pages\n')
+            all_good = False
+
+        # Keep writing from another thread while we read the snapshot
+        writer = threading.Thread(target=lambda: [live.add(str(number)) for number in range(2000)])
+        writer.start()
+        frozen_during_writes = snapshot.freeze()
+        writer.join()
+
+        if frozen_during_writes != expected or snapshot.freeze() != expected:
+            sys.stderr.write('snapshot changed while the live filter was written, backend %s\n' % backend)
+            all_good = False
+        if 'Alabama' not in snapshot or '1999' in snapshot or '1999' not in live:
+            sys.stderr.write('snapshot membership is wrong, backend %s\n' % backend)
+            all_good = False
+        if not 0 < live.snapshot_overhead_bytes() <= (live.num_bits_m + 7) // 8:
+            sys.stderr.write('snapshot overhead is wrong: %d\n' % live.snapshot_overhead_bytes())
+            all_good = False
+
+        union = bloom_filter.BloomFilter.union_all([snapshot, live])
+        if union != live:
+            sys.stderr.write('union of a snapshot with its live filter is wrong\n')
+            all_good = False
+
+        try:
+            snapshot.add('Puerto Rico')
+        except TypeError:
+            pass
+        else:
+            sys.stderr.write('snapshot allowed a write\n')
+            all_good = False
+
+        snapshot.backend.release()
+        if live.snapshot_overhead_bytes() != 0 or live.backend.dirty.watchers:
+            sys.stderr.write('releasing a snapshot did not free it\n')
+            all_good = False
+
+    return all_good
+
+
+def key_codec_test():
+    """Test structured keys: tuples, UUIDs, datetimes and registered types"""
+
+    all_good = True
+
+    structured = [
+        ('tenant-7', 1234),
+        uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        datetime.datetime(2024, 2, 29, 12, 30, tzinfo=datetime.timezone.utc),
+        (None, 1.5, b'raw', ('nested', -3)),
+        -42,
+    ]
+    for probe_bitnoer in [bloom_filter.get_filter_bitno_probes, bloom_filter.get_bitno_seed_rnd]:
+        bloom = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01, probe_bitnoer=probe_bitnoer)
+        for key in structured:
+            bloom.add(key)
+        if not all(key in bloom for key in structured):
+            sys.stderr.write('structured key not found\n')
+            all_good = False
+        if ('tenant-7', 1235) in bloom or ('tenant-7', '1234') in bloom:
+            sys.stderr.write('structured key false positive\n')
+            all_good = False
+
+    # Equal keys must encode the same, whatever their representation
+    same_instant = datetime.datetime(2024, 2, 29, 13, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=1)))
+    if bloom_filter.encode_key(same_instant) != bloom_filter.encode_key(structured[2]):
+        sys.stderr.write('equal datetimes encoded differently\n')
+        all_good = False
+    if bloom_filter.encode_key(('a', 1)) == bloom_filter.encode_key(('a', '1')):
+        sys.stderr.write('differently typed keys encoded the same\n')
+        all_good = False
+
+    # The legacy key types must keep hashing as they always have
+    bloom = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01)
+    legacy = {
+        'Alabama': [ord(char) for char in 'Alabama'],
+        b'Alabama': [ord(char) for char in 'Alabama'],
+        65537: [1, 0, 1],
+        (1, 2, 3): [1, 2, 3],
+    }
+    for key, int_list in legacy.items():
+        expected = bloom_filter.BloomFilter(max_elements=1000, error_rate=0.01)
+        if list(bloom.probe_bitnoer(bloom, key)) != list(expected.probe_bitnoer(expected, int_list)):
+            sys.stderr.write('hashing of %r changed\n' % (key,))
+            all_good = False
+
+    class Point(object):
+        """A user type with a codec"""
+        def __init__(self, x_value, y_value):
+            self.x_value = x_value
+            self.y_value = y_value
+
+    bloom_filter.register_key_codec(Point, 0x80, lambda point: struct.pack('<dd', point.x_value, point.y_value))
+    bloom.add(Point(1.0, 2.0))
+    if Point(1.0, 2.0) not in bloom:
+        sys.stderr.write('registered key type not found\n')
+        all_good = False
+
+    for tag in [0x7f, 0x80]:
+        try:
+            bloom_filter.register_key_codec(complex, tag, lambda value: b'')
+        except ValueError:
+            pass
+        else:
+            sys.stderr.write('register_key_codec accepted tag 0x%x\n' % tag)
+            all_good = False
+
+    try:
+        bloom.add(object())
+    except TypeError:
+        pass
+    else:
+        sys.stderr.write('an unhashable key type was accepted\n')
+        all_good = False
+
+    return all_good
+
+
 def give_description(filename):
     """Return a description of the filename type - could be array, file or hybrid"""
     if filename is None:
@@ -305,6 +1966,54 @@ def test_bloom_filter():
 
     all_good &= or_test()
 
+    all_good &= sparse_test()
+
+    all_good &= freeze_test()
+
+    all_good &= server_test()
+
+    all_good &= checkpoint_test()
+
+    all_good &= insert_log_test()
+
+    all_good &= plan_test()
+
+    all_good &= combine_all_test()
+
+    all_good &= bloom_index_test()
+
+    all_good &= set_algebra_test()
+
+    all_good &= snapshot_test()
+
+    all_good &= key_codec_test()
+
+    all_good &= tiered_test()
+
+    all_good &= batch_io_test()
+
+    all_good &= backend_conformance_test()
+
+    all_good &= columnar_test()
+
+    all_good &= pipeline_test()
+
+    all_good &= add_if_absent_test()
+
+    all_good &= delta_test()
+
+    all_good &= word_layout_test(performance_test)
+
+    all_good &= guarded_store_test()
+
+    all_good &= placement_test()
+
+    all_good &= quotient_filter_test()
+
+    all_good &= count_min_test()
+
+    all_good &= pickle_test()
+
     if performance_test:
         sqrt_of_10 = math.sqrt(10)
         # for exponent in range(5): # this is a lot, but probably not unreasonable